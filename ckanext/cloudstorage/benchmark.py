@@ -0,0 +1,631 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the storage, run by the `benchmark` command.
+
+By default, they run against a temporary container of the `S3` driver,
+on an S3-compatible server running in this process (see `fake_s3`), which
+replaces the configured one for the duration of the run. A temporary
+container of the libcloud `LOCAL` driver can be used instead (to measure
+the front-end server offloads), or the configured container, ex: to
+measure an S3-compatible server running locally (ex: MinIO).
+
+Every case works on objects of its own, stored under made-up resource IDs
+starting with `benchmark-`, or under the resources of datasets named
+`benchmark-<run>-<case>`, which are removed (and purged) once the case is
+done.
+"""
+import datetime
+import logging
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from StringIO import StringIO
+from contextlib import contextmanager
+
+from ckan import model
+from ckanapi import LocalCKAN
+from libcloud.storage.providers import get_driver
+from libcloud.storage.types import Provider
+from pylons import config
+
+from ckanext.cloudstorage import metrics, storage
+from ckanext.cloudstorage.fake_s3 import FakeS3Server
+from ckanext.cloudstorage.cli import (
+    FakeFileStorage,
+    _iter_batches,
+    _list_missing_uploads,
+    _list_unlinked_uploads,
+    _migrate,
+    _sync_prefixes
+)
+from ckanext.cloudstorage.model import InventoryObject, remove_inventory
+from ckanext.cloudstorage.storage import (
+    ResourceCloudStorage,
+    S3_MIN_PART_SIZE,
+    _keep_alive
+)
+
+log = logging.getLogger(__name__)
+
+# The file sizes `upload` is measured with, in bytes.
+DEFAULT_SIZES = (1024 * 1024, 16 * 1024 * 1024, 128 * 1024 * 1024)
+# The number of objects the audit and migrate commands are timed on.
+DEFAULT_OBJECTS = (10000,)
+# The number of download URLs `download_url` is measured with.
+DEFAULT_ITERATIONS = 1000
+# The number of parts sent by `upload_multipart`.
+MULTIPART_PARTS = 4
+# The number of requests `keep_alive` makes with and without keep-alive.
+KEEP_ALIVE_REQUESTS = 100
+# The number of requests `resource_download` makes in each mode.
+DOWNLOAD_REQUESTS = 200
+# The name of the container in temporary storage.
+TEMPORARY_CONTAINER = 'benchmark'
+# The drivers `signed_urls` signs download URLs for, with the credentials of
+# a local S3-compatible server and of the Azure storage emulator. No request
+# is made with them.
+SIGNING_DRIVERS = (
+    ('S3', {
+        'key': 'benchmark',
+        'secret': 'benchmark',
+        'host': '127.0.0.1',
+        'port': 9000,
+        'secure': False
+    }),
+    ('AZURE_BLOBS', {
+        'key': 'devstoreaccount1',
+        'secret': (
+            'Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq'
+            '/K1SZFPTOtr/KBHBeksoGMGw=='
+        ),
+        'host': '127.0.0.1',
+        'port': 10000,
+        'secure': False
+    })
+)
+# The sizes of the signed URL cache `signed_urls` is measured with, where 0
+# disables it.
+SIGNED_URL_CACHE_SIZES = (0, 1000)
+
+
+def run(sizes=DEFAULT_SIZES, objects=DEFAULT_OBJECTS,
+        iterations=DEFAULT_ITERATIONS, workers=1, configured=False,
+        local=False):
+    """
+    Run every benchmark.
+
+    :param sizes: The file sizes to measure uploads with, in bytes.
+    :param objects: The numbers of objects to time the audit and migrate
+                    commands on.
+    :param iterations: The number of download URLs to measure, for each
+                       driver and cache size of `signed_urls`.
+    :param workers: The number of files uploaded at the same time by
+                    `migrate`, as with `migrate --workers`.
+    :param configured: Use the configured container instead of a temporary
+                       one.
+    :param local: Use a temporary container of the `LOCAL` driver instead
+                  of the in-process S3 server.
+    :returns: A dict of results, which can be saved as JSON.
+    """
+    if configured:
+        return _run(sizes, objects, iterations, workers)
+    with _temporary_storage(local):
+        return _run(sizes, objects, iterations, workers)
+
+
+def _run(sizes, objects, iterations, workers):
+    uploader = ResourceCloudStorage({})
+    run_id = uuid.uuid4().hex[:8]
+    metrics.registry.reset()
+
+    results = {
+        'started': datetime.datetime.utcnow().isoformat(),
+        'driver': uploader.driver_name,
+        'container': uploader.container_name,
+        'python': platform.python_version(),
+        'upload': [bench_upload(run_id, size) for size in sizes],
+        'download_url': bench_download_url(run_id, iterations),
+        'signed_urls': bench_signed_urls(run_id, iterations),
+        'proxy_download': [
+            bench_proxy_download(run_id, size) for size in sizes
+        ],
+        'resource_download': bench_resource_download(run_id),
+        'upload_multipart': bench_upload_multipart(run_id),
+        'keep_alive': bench_keep_alive(run_id),
+        'commands': [
+            bench_commands(run_id, count, workers) for count in objects
+        ]
+    }
+    results['metrics'] = metrics.registry.snapshot()
+    return results
+
+
+def bench_upload(run_id, size):
+    """
+    Measure the throughput of `ResourceCloudStorage.upload` with a file of
+    `size` random bytes.
+    """
+    resource_id = _resource_id(run_id, 'upload-{0}'.format(size))
+    with _random_file(size) as f:
+        rss = _max_rss()
+        started = time.time()
+        try:
+            _upload(resource_id, f, 'data.bin')
+            elapsed = time.time() - started
+        finally:
+            _cleanup(resource_id)
+
+    return {
+        'size': size,
+        'seconds': elapsed,
+        'mb_per_second': _mb_per_second(size, elapsed),
+        'max_rss_growth_kb': _max_rss() - rss
+    }
+
+
+def bench_download_url(run_id, iterations):
+    """
+    Measure the latency of building a download URL, which is what
+    `resource_download` does before redirecting, `iterations` times.
+    """
+    resource_id = _resource_id(run_id, 'download')
+    _upload(resource_id, StringIO(resource_id), 'data.txt')
+    try:
+        uploader = ResourceCloudStorage({})
+        latencies = []
+        for _ in range(iterations):
+            started = time.time()
+            uploader.get_url_from_filename(resource_id, 'data.txt')
+            latencies.append(time.time() - started)
+    finally:
+        _cleanup(resource_id)
+
+    return _latencies(latencies)
+
+
+def bench_signed_urls(run_id, iterations):
+    """
+    Measure the latency of building signed download URLs on S3 and Azure,
+    as `resource_download` does with `use_secure_urls`, `iterations` times,
+    with the cache of signed URLs disabled and enabled.
+    """
+    resource_id = _resource_id(run_id, 'signed')
+    results = []
+    for driver_name, driver_options in SIGNING_DRIVERS:
+        for cache_size in SIGNED_URL_CACHE_SIZES:
+            with _configured({
+                'ckanext.cloudstorage.driver': driver_name,
+                'ckanext.cloudstorage.driver_options': repr(driver_options),
+                'ckanext.cloudstorage.use_secure_urls': 'true',
+                'ckanext.cloudstorage.secure_url_cache_size': str(
+                    cache_size),
+                'ckanext.cloudstorage.s3_region': 'us-east-1',
+                # Only the URLs are built: the objects don't exist.
+                'ckanext.cloudstorage.check_exists': 'false',
+                'ckanext.cloudstorage.dedupe': 'false'
+            }):
+                uploader = ResourceCloudStorage({})
+                latencies = []
+                for _ in range(iterations):
+                    started = time.time()
+                    uploader.get_url_from_filename(resource_id, 'data.txt')
+                    latencies.append(time.time() - started)
+            result = _latencies(latencies)
+            result.update({
+                'driver': driver_name,
+                'secure_url_cache_size': cache_size
+            })
+            results.append(result)
+    return results
+
+
+def bench_proxy_download(run_id, size):
+    """
+    Measure the throughput and memory use of streaming a file of `size`
+    random bytes from the provider, as `resource_download` does in proxy
+    mode, and the time to its first byte.
+    """
+    resource_id = _resource_id(run_id, 'proxy-{0}'.format(size))
+    with _random_file(size) as f:
+        _upload(resource_id, f, 'data.bin')
+    try:
+        uploader = ResourceCloudStorage({})
+        rss = _max_rss()
+        started = time.time()
+        first_byte = None
+        received = 0
+        status, _headers, body = uploader.open_object(
+            uploader.path_from_filename(resource_id, 'data.bin'))
+        for chunk in body:
+            if first_byte is None:
+                first_byte = time.time() - started
+            received += len(chunk)
+        elapsed = time.time() - started
+    finally:
+        _cleanup(resource_id)
+
+    if status != 200 or received != size:
+        raise IOError('Download failed: status {0}, {1} of {2} bytes'.format(
+            status, received, size))
+    return {
+        'size': size,
+        'seconds': elapsed,
+        'first_byte_ms': 1000 * (first_byte or elapsed),
+        'mb_per_second': _mb_per_second(size, elapsed),
+        'max_rss_growth_kb': _max_rss() - rss
+    }
+
+
+def bench_upload_multipart(run_id):
+    """
+    Measure the throughput and memory use of streaming parts to the
+    provider, as `cloudstorage_upload_multipart` does. S3 only.
+    """
+    uploader = ResourceCloudStorage({})
+    if 'S3' not in uploader.driver_name:
+        return {'skipped': 'Multipart uploads are only supported on S3'}
+
+    part_size = max(uploader.multipart_part_size, S3_MIN_PART_SIZE)
+    name = uploader.path_from_filename(
+        _resource_id(run_id, 'multipart'), 'data.bin')
+    upload_id = uploader.initiate_multipart_upload(name)
+    try:
+        with _random_file(part_size) as f:
+            rss = _max_rss()
+            started = time.time()
+            for n in range(1, MULTIPART_PARTS + 1):
+                f.seek(0)
+                resp = uploader.stream_request(
+                    uploader.object_path(name) +
+                    '?partNumber={0}&uploadId={1}'.format(n, upload_id),
+                    f,
+                    part_size,
+                    operation='upload_part'
+                )
+                if resp.status != 200:
+                    raise IOError('Upload failed: part {0}'.format(n))
+            elapsed = time.time() - started
+    finally:
+        uploader.abort_multipart_upload(name, upload_id)
+
+    return {
+        'parts': MULTIPART_PARTS,
+        'part_size': part_size,
+        'seconds': elapsed,
+        'mb_per_second': _mb_per_second(
+            part_size * MULTIPART_PARTS, elapsed),
+        'max_rss_growth_kb': _max_rss() - rss
+    }
+
+
+def bench_keep_alive(run_id):
+    """
+    Compare the number of requests per second made to the provider with a
+    new connection for each request, as libcloud does, and with kept-alive
+    connections, by fetching the metadata of an object.
+    """
+    uploader = ResourceCloudStorage({})
+    if uploader.driver_name == 'LOCAL':
+        return {'skipped': 'The LOCAL driver makes no HTTP requests'}
+
+    resource_id = _resource_id(run_id, 'keep-alive')
+    _upload(resource_id, StringIO(resource_id), 'data.txt')
+    name = uploader.path_from_filename(resource_id, 'data.txt')
+    result = {'requests': KEEP_ALIVE_REQUESTS}
+    try:
+        for key, timeout in (('new_connections', 0), ('keep_alive', 15)):
+            driver = get_driver(getattr(Provider, uploader.driver_name))(
+                **uploader.driver_options)
+            if timeout:
+                _keep_alive(driver.connection, timeout)
+            started = time.time()
+            for _ in range(KEEP_ALIVE_REQUESTS):
+                driver.get_object(uploader.container_name, name)
+            result[key + '_per_second'] = KEEP_ALIVE_REQUESTS / max(
+                time.time() - started, 0.001)
+    finally:
+        _cleanup(resource_id)
+    return result
+
+
+def bench_resource_download(run_id):
+    """
+    Measure the latency of `resource_download` for an anonymous user,
+    through CKAN's WSGI application, in each download mode the driver
+    supports, with the download cache disabled and enabled.
+    """
+    try:
+        from webtest import TestApp
+        from ckan.config.middleware import make_app
+    except ImportError:
+        return {'skipped': 'webtest is not installed'}
+
+    uploader = ResourceCloudStorage({})
+    modes = ['redirect', 'proxy']
+    if uploader.driver_name == 'LOCAL':
+        modes.append('x-accel-redirect')
+
+    results = []
+    with _dataset(run_id, 'download', 1) as (package, resource_ids):
+        resource_id = resource_ids[0]
+        _upload(resource_id, StringIO(resource_id), 'data.txt')
+        url = '/dataset/{0}/resource/{1}/download/data.txt'.format(
+            package['id'], resource_id)
+        try:
+            app = TestApp(make_app(config.get('global_conf', {}), **config))
+            for mode in modes:
+                for cache_ttl in (0, 60):
+                    with _configured({
+                        'ckanext.cloudstorage.download_mode': mode,
+                        'ckanext.cloudstorage.download_cache_ttl': str(
+                            cache_ttl)
+                    }):
+                        latencies = []
+                        for _ in range(DOWNLOAD_REQUESTS):
+                            started = time.time()
+                            app.get(url, status=[200, 302])
+                            latencies.append(time.time() - started)
+                    result = _latencies(latencies)
+                    result.update({
+                        'mode': mode,
+                        'download_cache_ttl': cache_ttl,
+                        'requests_per_second': len(latencies) / max(
+                            sum(latencies), 0.001)
+                    })
+                    results.append(result)
+        finally:
+            _cleanup(resource_id)
+    return results
+
+
+def bench_commands(run_id, count, workers):
+    """
+    Time `migrate` on a storage directory of `count` small files, laid out
+    as CKAN does, for the resources of a dataset of their own. Then time
+    `list-unlinked-uploads`, `list-missing-uploads`, the `sync-inventory`
+    of these resources and their deletion.
+
+    The audit commands also go through the site's own resources (and its
+    inventory, if enabled), so their time depends on them too.
+    """
+    path = tempfile.mkdtemp(prefix='cloudstorage-benchmark-')
+    result = {'objects': count}
+    with _dataset(run_id, 'commands-{0}'.format(count), count) as (
+            _package, resource_ids):
+        try:
+            _write_storage_tree(path, resource_ids)
+            result['migrate_seconds'] = _time(
+                _migrate,
+                {'<path_to_storage>': path, '<resource_id>': None},
+                workers=workers
+            )
+            result['migrate_files_per_second'] = count / max(
+                result['migrate_seconds'], 0.001)
+            result['list_unlinked_uploads_seconds'] = _time(
+                _list_unlinked_uploads, None)
+            result['list_missing_uploads_seconds'] = _time(
+                _list_missing_uploads, None)
+            if InventoryObject.__table__.exists(bind=model.meta.engine):
+                result['sync_inventory_seconds'] = _time(
+                    _sync_prefixes,
+                    ResourceCloudStorage({}),
+                    [u'resources/{0}/'.format(id) for id in resource_ids],
+                    datetime.datetime.utcnow()
+                )
+            else:
+                result['sync_inventory_seconds'] = None
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+            started = time.time()
+            result['delete_errors'] = _cleanup_many(resource_ids)
+            result['delete_seconds'] = time.time() - started
+    return result
+
+
+def _upload(resource_id, f, filename):
+    uploader = ResourceCloudStorage({
+        'id': resource_id,
+        'url': filename,
+        'upload': FakeFileStorage(f, filename)
+    })
+    uploader.upload(resource_id)
+    model.Session.commit()
+
+
+def _cleanup(resource_id):
+    uploader = ResourceCloudStorage({})
+    uploader.release_resource_blob(resource_id)
+    model.Session.commit()
+    prefix = _prefix(uploader, resource_id) + '/'
+    for name, error in uploader.delete_objects(
+            obj.name for obj in uploader.iterate_objects(prefix)):
+        if error:
+            log.warning('Unable to delete %s: %s', name, error)
+
+
+def _cleanup_many(resource_ids):
+    # Delete the objects of resources with a file named `data.txt`, and
+    # their inventory rows. Returns the deletion errors.
+    uploader = ResourceCloudStorage({})
+    for resource_id in resource_ids:
+        uploader.release_resource_blob(resource_id)
+    model.Session.commit()
+
+    names = [
+        uploader.path_from_filename(resource_id, 'data.txt')
+        for resource_id in resource_ids
+    ]
+    errors = [
+        error for _name, error in uploader.delete_objects(names) if error
+    ]
+    if InventoryObject.__table__.exists(bind=model.meta.engine):
+        for batch in _iter_batches(names, 1000):
+            remove_inventory(batch)
+    return errors
+
+
+@contextmanager
+def _dataset(run_id, name, count):
+    # A public dataset with `count` resources of uploaded `data.txt` files
+    # (that aren't uploaded), purged on exit. Yields the dataset and the
+    # resource IDs. Resources are inserted directly, as creating thousands
+    # of them through the API would take longer than what is measured.
+    lc = LocalCKAN()
+    package = lc.action.package_create(
+        name=u'benchmark-{0}-{1}'.format(run_id, name))
+    try:
+        resource_ids = [unicode(uuid.uuid4()) for _ in range(count)]
+        now = datetime.datetime.utcnow()
+        position = 0
+        for batch in _iter_batches(resource_ids, 1000):
+            rows = []
+            for resource_id in batch:
+                rows.append({
+                    'id': resource_id,
+                    'package_id': package['id'],
+                    'name': u'data.txt',
+                    'url': u'data.txt',
+                    'url_type': u'upload',
+                    'position': position,
+                    'state': model.core.State.ACTIVE,
+                    'created': now,
+                    'last_modified': now
+                })
+                position += 1
+            model.Session.execute(model.resource_table.insert(), rows)
+        model.Session.commit()
+        yield package, resource_ids
+    finally:
+        model.Session.rollback()
+        lc.action.dataset_purge(id=package['id'])
+
+
+def _write_storage_tree(path, resource_ids):
+    # Files laid out as in CKAN's storage directory, see `migrate`.
+    for resource_id in resource_ids:
+        folder = os.path.join(path, resource_id[:3], resource_id[3:6])
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(os.path.join(folder, resource_id[6:]), 'w') as f:
+            f.write(resource_id)
+
+
+def _time(function, *args, **kwargs):
+    # Time a command, without its output.
+    stdout = sys.stdout
+    started = time.time()
+    with open(os.devnull, 'w') as sys.stdout:
+        try:
+            function(*args, **kwargs)
+        finally:
+            sys.stdout = stdout
+    return time.time() - started
+
+
+@contextmanager
+def _configured(options):
+    # Override CKAN settings, including the ones ckanext-cloudstorage
+    # parsed once, until exit.
+    saved = dict((key, config.get(key)) for key in options)
+    config.update(options)
+    storage.configure(config)
+    try:
+        yield
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                config.pop(key, None)
+            else:
+                config[key] = value
+        storage.configure(config)
+
+
+@contextmanager
+def _temporary_storage(local=False):
+    # A container in a temporary directory, used in place of the configured
+    # one until exit: on an in-process S3 server, or of the LOCAL driver.
+    # Downloads from the LOCAL driver redirect to a made-up public URL, as
+    # it has none.
+    path = tempfile.mkdtemp(prefix='cloudstorage-benchmark-')
+    server = None
+    try:
+        if local:
+            options = {
+                'ckanext.cloudstorage.driver': 'LOCAL',
+                'ckanext.cloudstorage.driver_options': repr({'key': path}),
+                'ckanext.cloudstorage.public_url_base':
+                    'http://localhost/' + TEMPORARY_CONTAINER
+            }
+        else:
+            server = FakeS3Server(path).start()
+            options = {
+                'ckanext.cloudstorage.driver': 'S3',
+                'ckanext.cloudstorage.driver_options': repr(
+                    server.driver_options),
+                'ckanext.cloudstorage.public_url_base': ''
+            }
+        options.update({
+            'ckanext.cloudstorage.container_name': TEMPORARY_CONTAINER,
+            'ckanext.cloudstorage.use_secure_urls': 'false'
+        })
+        with _configured(options):
+            ResourceCloudStorage({}).driver.create_container(
+                TEMPORARY_CONTAINER)
+            yield path
+    finally:
+        if server is not None:
+            server.stop()
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _resource_id(run_id, name):
+    return u'benchmark-{0}-{1}'.format(run_id, name)
+
+
+def _prefix(uploader, resource_id):
+    # The path of the resource's "folder", without the trailing slash.
+    return os.path.dirname(uploader.path_from_filename(resource_id, 'x'))
+
+
+@contextmanager
+def _random_file(size):
+    # A temporary file of `size` random bytes, removed on exit.
+    with tempfile.TemporaryFile() as f:
+        remaining = size
+        while remaining > 0:
+            chunk = os.urandom(min(remaining, 1024 * 1024))
+            f.write(chunk)
+            remaining -= len(chunk)
+        f.seek(0)
+        yield f
+
+
+def _max_rss():
+    # The peak memory use of the process so far, in kB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _mb_per_second(size, seconds):
+    return size / max(seconds, 0.001) / 1000000.0
+
+
+def _latencies(latencies):
+    latencies = sorted(latencies)
+    return {
+        'iterations': len(latencies),
+        'mean_ms': 1000 * sum(latencies) / max(len(latencies), 1),
+        'p50_ms': 1000 * _percentile(latencies, 0.5),
+        'p99_ms': 1000 * _percentile(latencies, 0.99)
+    }
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    return values[min(int(q * len(values)), len(values) - 1)]
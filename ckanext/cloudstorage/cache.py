@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A thread-safe, size-bounded cache whose entries expire.
+
+    When full, the least recently used entry is evicted.
+    """
+    def __init__(self, max_size):
+        """
+        :param max_size: The maximum number of entries to keep.
+        """
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Return the value stored for `key`, or `default` if there is none or
+        it has expired.
+        """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+
+            value, expires = entry
+            if expires < time.time():
+                return default
+
+            # Move it to the most recently used end.
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value, ttl):
+        """
+        Store `value` for `key` for `ttl` seconds.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + ttl)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Remove the entry for `key`, if any.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """
+        Remove every entry whose value `predicate` returns true for.
+        """
+        with self._lock:
+            for key in [
+                    key for key, (value, _expires) in self._data.items()
+                    if predicate(value)]:
+                del self._data[key]
+
+    def clear(self):
+        """
+        Remove every entry.
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
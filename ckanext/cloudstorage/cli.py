@@ -3,53 +3,105 @@
 import os
 import os.path
 import cgi
+import email.utils
+import hashlib
+import json
 import tempfile
+import threading
+import time
 import click
+from datetime import datetime
 import unicodecsv as csv
-from sqlalchemy import and_ as _and_
+from sqlalchemy import and_ as _and_, or_ as _or_
+from sqlalchemy import case, exists, func, literal
 
 from docopt import docopt
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 from ckan.lib.cli import CkanCommand
 from ckan.lib.munge import munge_filename
 from ckan import model
 
 from ckanapi import LocalCKAN
+from ckanext.cloudstorage import metrics
 from ckanext.cloudstorage.storage import (
+    BLOB_PREFIX,
     CloudStorage,
     ResourceCloudStorage
 )
 from ckanext.cloudstorage.model import (
-    create_tables,
-    drop_tables
+    upgrade_tables,
+    SCHEMA_VERSION,
+    InventoryObject,
+    InventorySync,
+    ResourceBlob,
+    upsert_inventory,
+    prune_inventory,
+    _resource_id_from_name
 )
 from ckan.logic import NotFound
+from libcloud.storage.types import ObjectDoesNotExistError
+from ckan.plugins import toolkit
 from ckan.plugins.toolkit import h
 
+# The number of resources looked up with a single query by `migrate`.
+MIGRATE_BATCH_SIZE = 2000
+# The number of objects written to the inventory at once by `sync-inventory`.
+INVENTORY_BATCH_SIZE = 1000
+
 USAGE = """ckanext-cloudstorage
 
 Commands:
     - fix-cors                  Update CORS rules where possible.
     - migrate                   Upload local storage to the remote.
     - migrate-file              Upload local file to the remote for a given resource.
-    - initdb                    Reinitalize database tables.
+    - initdb                    Create or upgrade database tables.
     - list-unlinked-uploads     Lists uploads in the storage container that do not match to any resources.
     - remove-unlinked-uploads   Permanently deletes uploads from the storage container that do not match to any resources.
     - list-missing-uploads      Lists resources IDs that are missing uploads in the storage container.
     - list-linked-uploads       Lists uploads in the storage container that do match to a resource.
+    - sync-inventory            Updates the database copy of the storage container listing.
+    - clean-multipart           Aborts expired multipart uploads, including the ones CKAN lost track of.
+    - benchmark                 Measures uploads, download URLs and bulk commands, and saves the results as JSON.
 
 Usage:
     cloudstorage fix-cors <domains>... [--c=<config>]
-    cloudstorage migrate <path_to_storage> [<resource_id>] [--c=<config>]
+    cloudstorage migrate <path_to_storage> [<resource_id>] [--workers=<n>] [--journal=<path>] [--skip-existing] [--metrics=<path>] [--c=<config>]
     cloudstorage migrate-file <path_to_file> <resource_id> [--c=<config>]
     cloudstorage initdb [--c=<config>]
-    cloudstorage list-unlinked-uploads [--o=<output>] [--c=<config>]
-    cloudstorage remove-unlinked-uploads [--c=<config>]
-    cloudstorage list-missing-uploads [--o=<output>] [--c=<config>]
-    cloudstorage list-linked-uploads [--o=<output>] [--c=<config>]
+    cloudstorage list-unlinked-uploads [--o=<output>] [--metrics=<path>] [--c=<config>]
+    cloudstorage remove-unlinked-uploads [--metrics=<path>] [--c=<config>]
+    cloudstorage list-missing-uploads [--o=<output>] [--metrics=<path>] [--c=<config>]
+    cloudstorage list-linked-uploads [--o=<output>] [--metrics=<path>] [--c=<config>]
+    cloudstorage sync-inventory [--full] [--metrics=<path>] [--c=<config>]
+    cloudstorage clean-multipart [--older-than=<days>] [--dry-run] [--metrics=<path>] [--c=<config>]
+    cloudstorage benchmark [--sizes=<bytes>] [--objects=<counts>] [--iterations=<n>] [--workers=<n>] [--configured-container] [--local] [--o=<output>] [--c=<config>]
 
 Options:
     -c=<config>       The CKAN configuration file.
     -o=<output>       The output file path.
+    --workers=<n>     The number of files uploaded at the same time [default: 1].
+    --journal=<path>  A file recording migrated resources, which are skipped
+                      when the migration is run again.
+    --skip-existing   Skip files already uploaded with the same size (and
+                      MD5, where the provider reports it).
+    --full            List the whole container instead of the resources
+                      of the datasets modified since the last sync.
+    --older-than=<days>  The lifetime of multipart uploads, in days.
+                      Defaults to max_multipart_lifetime.
+    --dry-run         Only report what would be removed.
+    --metrics=<path>  Write the metrics of the command, and of the calls it
+                      made to the provider, to this file in the Prometheus
+                      text format (ex: for node_exporter's textfile
+                      collector).
+    --sizes=<bytes>   Comma-separated file sizes to benchmark uploads with.
+    --objects=<counts>  Comma-separated numbers of objects to benchmark the
+                      audit and migrate commands on.
+    --iterations=<n>  The number of download URLs to benchmark.
+    --configured-container  Benchmark the configured container instead of
+                      a temporary one on an in-process S3 server.
+    --local           Benchmark a temporary container of the LOCAL driver
+                      instead of the in-process S3 server.
 """
 
 
@@ -67,15 +119,69 @@ class PasterCommand(CkanCommand):
         super(PasterCommand, self).__init__(name)
         self.parser.add_option('-o', '--output', dest='output', action='store',
                                default=None, help='The output file path.')
+        self.parser.add_option('--workers', dest='workers', action='store',
+                               type='int', default=1,
+                               help='The number of parallel uploads.')
+        self.parser.add_option('--journal', dest='journal', action='store',
+                               default=None,
+                               help='The migration journal file path.')
+        self.parser.add_option('--skip-existing', dest='skip_existing',
+                               action='store_true', default=False,
+                               help='Skip files that are already uploaded.')
+        self.parser.add_option('--full', dest='full', action='store_true',
+                               default=False,
+                               help='Sync the whole inventory.')
+        self.parser.add_option('--older-than', dest='older_than',
+                               action='store', type='float', default=None,
+                               help='The lifetime of multipart uploads.')
+        self.parser.add_option('--dry-run', dest='dry_run',
+                               action='store_true', default=False,
+                               help='Only report what would be removed.')
+        self.parser.add_option('--metrics', dest='metrics', action='store',
+                               default=None,
+                               help='The metrics output file path.')
+        self.parser.add_option('--sizes', dest='sizes', action='store',
+                               default=None,
+                               help='The file sizes to benchmark.')
+        self.parser.add_option('--objects', dest='objects', action='store',
+                               default=None,
+                               help='The numbers of objects to benchmark.')
+        self.parser.add_option('--iterations', dest='iterations',
+                               action='store', type='int', default=None,
+                               help='The number of download URLs.')
+        self.parser.add_option('--configured-container',
+                               dest='configured_container',
+                               action='store_true', default=False,
+                               help='Benchmark the configured container.')
+        self.parser.add_option('--local', dest='local',
+                               action='store_true', default=False,
+                               help='Benchmark a LOCAL container.')
 
     def command(self):
         self._load_config()
         args = docopt(USAGE, argv=self.args)
+        command = [
+            name for name, value in args.items()
+            if value is True and not name.startswith(('-', '<'))
+        ][0]
 
+        try:
+            with metrics.timed(
+                    'cli_' + command.replace('-', '_'),
+                    CloudStorage.driver_name.fget(None)):
+                self._run(args)
+        finally:
+            if self.options.metrics:
+                _write_metrics(self.options.metrics)
+
+    def _run(self, args):
         if args['fix-cors']:
             _fix_cors(args)
         elif args['migrate']:
-            _migrate(args)
+            _migrate(args,
+                     workers=self.options.workers,
+                     journal_path=self.options.journal,
+                     skip_existing=self.options.skip_existing)
         elif args['migrate-file']:
             _migrate_file(args)
         elif args['initdb']:
@@ -88,19 +194,103 @@ class PasterCommand(CkanCommand):
             _list_missing_uploads(self.options.output)
         elif args['list-linked-uploads']:
             _list_linked_uploads(self.options.output)
-
-
-def _migrate(args):
+        elif args['sync-inventory']:
+            _sync_inventory(full=self.options.full)
+        elif args['clean-multipart']:
+            _clean_multipart(older_than=self.options.older_than,
+                             dry_run=self.options.dry_run)
+        elif args['benchmark']:
+            _benchmark(self.options.output,
+                       sizes=self.options.sizes,
+                       objects=self.options.objects,
+                       iterations=self.options.iterations,
+                       workers=self.options.workers,
+                       configured=self.options.configured_container,
+                       local=self.options.local)
+
+
+def _migrate(args, workers=1, journal_path=None, skip_existing=False):
     path = args['<path_to_storage>']
     single_id = args['<resource_id>']
     if not os.path.isdir(path):
         print('The storage directory cannot be found.')
         return
 
-    lc = LocalCKAN()
-    resources = {}
     failed = []
+    completed = _read_journal(journal_path)
+    journal = open(journal_path, 'a') if journal_path else None
+    stats = {'uploaded': 0, 'skipped': 0, 'bytes': 0}
+
+    # Uploads run in a pool of workers while the tree is still being
+    # walked. A new file is only picked once a worker is free.
+    slots = threading.BoundedSemaphore(workers)
+
+    def done(result):
+        resource_id, status, size, message = result
+        if status == 'failed':
+            failed.append(resource_id)
+            print(u'\t{0}: {1}'.format(resource_id, message))
+        else:
+            stats[status] += 1
+            stats['bytes'] += size
+            if journal:
+                journal.write(resource_id + '\n')
+                journal.flush()
+        slots.release()
+
+    files = _iter_storage_files(path, single_id, completed)
+
+    started = time.time()
+    pool = ThreadPool(workers)
+    try:
+        i = 0
+        for batch in _iter_batches(files, MIGRATE_BATCH_SIZE):
+            resources = _get_resources(
+                [resource_id for resource_id, _ in batch]
+            )
+            # Don't keep a transaction open for the whole migration.
+            model.Session.remove()
+            for resource_id, file_path in batch:
+                i += 1
+                print('[{i}] Working on {id}'.format(i=i, id=resource_id))
+
+                resource = resources.get(resource_id)
+                if resource is None:
+                    print(u'\tResource not found')
+                    continue
+                if resource['url_type'] != 'upload':
+                    print(u'\t`url_type` is not `upload`. Skip')
+                    continue
+
+                slots.acquire()
+                pool.apply_async(
+                    _migrate_resource,
+                    (resource, file_path, skip_existing),
+                    callback=done
+                )
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+        if journal:
+            journal.close()
+
+    elapsed = max(time.time() - started, 0.001)
+    size, unit = _humanize_space(stats['bytes'] / 1000.0)
+    print(u'Uploaded {0} file(s) ({1:.2f} {2}), skipped {3}, failed {4} in '
+          u'{5:.1f}s: {6:.2f} files/s, {7:.2f} MB/s.'.format(
+              stats['uploaded'], size, unit, stats['skipped'], len(failed),
+              elapsed, stats['uploaded'] / elapsed,
+              stats['bytes'] / elapsed / 1000000.0))
 
+    if failed:
+        log_file = tempfile.NamedTemporaryFile(delete=False)
+        log_file.file.writelines(id + '\n' for id in failed)
+        print(u'ID of all failed uploads are saved to `{0}`'.format(log_file.name))
+
+
+def _iter_storage_files(path, single_id=None, completed=()):
+    # type: (str, str|None, set) -> iter
     # The resource folder is stuctured like so on disk:
     # - storage/
     #   - ...
@@ -124,45 +314,114 @@ def _migrate(args):
             ckan_res_id = resource_id + file_
             if single_id and ckan_res_id != single_id:
                 continue
+            if ckan_res_id in completed:
+                continue
 
-            resources[ckan_res_id] = os.path.join(
-                root,
-                file_
-            )
-
-    for i, resource in enumerate(resources.iteritems(), 1):
-        resource_id, file_path = resource
-        print('[{i}/{count}] Working on {id}'.format(
-            i=i,
-            count=len(resources),
-            id=resource_id
-        ))
-
-        try:
-            resource = lc.action.resource_show(id=resource_id)
-        except NotFound:
-            print(u'\tResource not found')
-            continue
-        if resource['url_type'] != 'upload':
-            print(u'\t`url_type` is not `upload`. Skip')
-            continue
+            yield ckan_res_id, os.path.join(root, file_)
+
+
+def _iter_batches(iterable, size):
+    # type: (iter, int) -> iter
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _get_resources(ids):
+    # type: (list) -> dict
+    """Return the fields `migrate` needs for the given resource IDs, with a
+    single query instead of one `resource_show` per resource."""
+    return dict(
+        (id, {
+            u'id': id,
+            u'url': url,
+            u'url_type': url_type,
+            u'package_id': package_id
+        })
+        for id, url, url_type, package_id in model.Session.query(
+            model.Resource.id,
+            model.Resource.url,
+            model.Resource.url_type,
+            model.Resource.package_id) \
+            .filter(model.Resource.id.in_(ids))
+    )
+
+
+def _read_journal(journal_path):
+    # type: (str|None) -> set
+    if not journal_path or not os.path.isfile(journal_path):
+        return set()
+    with open(journal_path) as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def _write_metrics(path):
+    # type: (str) -> None
+    # Written to a temporary file first, so that collectors never read a
+    # partial file.
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(metrics.registry.render_prometheus().encode('utf-8'))
+    os.rename(tmp_path, path)
+
+
+def _md5_file(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _is_uploaded(uploader, resource, file_path, size):
+    # type: (ResourceCloudStorage, dict, str, int) -> bool
+    try:
+        with uploader.checking_container('get_object'):
+            obj = uploader.container.get_object(uploader.resolve_path(
+                resource['id'], resource['url'].split('/')[-1]))
+    except ObjectDoesNotExistError:
+        return False
+    if obj.size != size:
+        return False
+
+    # The ETag is the MD5 of the object, unless it was uploaded in parts.
+    etag = (obj.hash or '').strip('"')
+    if len(etag) == 32 and '-' not in etag:
+        return etag == _md5_file(file_path)
+    return True
+
+
+def _migrate_resource(resource, file_path, skip_existing):
+    # Runs in a worker thread. Never raises, as exceptions would be lost by
+    # the pool.
+    try:
+        size = os.path.getsize(file_path)
+        if skip_existing:
+            if _is_uploaded(ResourceCloudStorage({}), resource, file_path,
+                            size):
+                return resource['id'], 'skipped', 0, None
 
         with open(file_path, 'rb') as fin:
             resource['upload'] = FakeFileStorage(
                 fin,
                 resource['url'].split('/')[-1]
             )
-            try:
-                uploader = ResourceCloudStorage(resource)
-                uploader.upload(resource['id'])
-            except Exception as e:
-                failed.append(resource_id)
-                print(u'\tError of type {0} during upload: {1}'.format(type(e), e))
-
-    if failed:
-        log_file = tempfile.NamedTemporaryFile(delete=False)
-        log_file.file.writelines(failed)
-        print(u'ID of all failed uploads are saved to `{0}`'.format(log_file.name))
+            uploader = ResourceCloudStorage(resource)
+            uploader.upload(resource['id'])
+        # Commit what the upload recorded (ex: the blob it links to).
+        model.Session.commit()
+        return resource['id'], 'uploaded', size, None
+    except Exception as e:
+        model.Session.rollback()
+        return resource['id'], 'failed', 0, \
+            u'Error of type {0} during upload: {1}'.format(type(e), e)
+    finally:
+        # Each worker thread has its own session, closed between files so
+        # that it doesn't hold a connection while waiting for the next one.
+        model.Session.remove()
 
 
 def _migrate_file(args):
@@ -193,6 +452,7 @@ def _migrate_file(args):
         try:
             uploader = ResourceCloudStorage(resource)
             uploader.upload(resource['id'])
+            model.Session.commit()
             head, tail = os.path.split(file_path)
             print(u'Uploaded file {0} successfully for resource {1}.'.format(
                     tail, resource_id))
@@ -210,15 +470,9 @@ def _fix_cors(args):
     cs = CloudStorage()
 
     if cs.can_use_advanced_azure:
-        from azure.storage import blob as azure_blob
         from azure.storage import CorsRule
 
-        blob_service = azure_blob.BlockBlobService(
-            cs.driver_options['key'],
-            cs.driver_options['secret']
-        )
-
-        blob_service.set_blob_service_properties(
+        cs.azure_blob_service.set_blob_service_properties(
             cors=[
                 CorsRule(
                     allowed_origins=args['<domains>'],
@@ -237,68 +491,128 @@ def _fix_cors(args):
         )
 
 
-def _get_uploads(get_linked = True, return_upload_objects_only = False):
-    # type: (bool, bool) -> tuple[float, list]
-    cs = CloudStorage()
-
-    resource_urls = set(os.path.join(
-                        u'resources',
-                        id,
-                        munge_filename(filename))
-                    for id, filename in
-                    model.Session.query(
-                        model.Resource.id,
-                        model.Resource.url) \
-                        .join(model.Package,
-                              model.Resource.package_id == model.Package.id) \
-                        .filter(_and_(model.Resource.url_type == u'upload',
-                                      model.Resource.state == model.core.State.ACTIVE,
-                                      model.Package.state == model.core.State.ACTIVE)) \
-                        .all())
-
-    uploads = cs.container.list_objects()
-
-    parsed_uploads = []
-    total_space_used = 0
-    for upload in uploads:
-        if (upload.name in resource_urls
-            if get_linked else
-            upload.name not in resource_urls):
+def _get_resource_index():
+    # type: () -> dict
+    """Map the ID of every uploaded resource to the fields the upload audit
+    commands need, with a single query."""
+    return dict(
+        (fields[0], fields)
+        for fields in model.Session.query(
+            model.Resource.id,
+            model.Resource.url,
+            model.Resource.package_id,
+            model.Resource.created,
+            model.Resource.last_modified,
+            model.Package.owner_org,
+            model.Package.state,
+            model.Resource.state) \
+            .join(model.Package,
+                  model.Resource.package_id == model.Package.id) \
+            .filter(model.Resource.url_type == u'upload') \
+            .yield_per(10000)
+    )
+
+
+def _expected_upload_name():
+    # type: () -> object
+    """The name of a resource's upload, as an SQL expression. The URL of an
+    uploaded resource is the munged name of its file, which `_is_linked`
+    checks, as `munge_filename` can't be done by the database."""
+    return literal(u'resources/') + model.Resource.id + u'/' + \
+        model.Resource.url
+
+
+def _get_inventory_uploads(get_linked):
+    # type: (bool) -> iter
+    """Yield `(upload, resource_fields)` for the objects in the inventory
+    that are (or may be) linked to an active resource, or that aren't,
+    joined with their resource and filtered by the database."""
+    linked = _and_(model.Resource.state == model.core.State.ACTIVE,
+                   model.Package.state == model.core.State.ACTIVE)
+    if not get_linked:
+        # An object named after a resource URL that isn't munged is
+        # considered linked, so that it is never deleted.
+        linked = _or_(model.Resource.id == None,  # noqa
+                      model.Resource.url == None,  # noqa
+                      ~_and_(linked,
+                             InventoryObject.name == _expected_upload_name()))
+
+    query = model.Session.query(
+            InventoryObject,
+            model.Resource.id,
+            model.Resource.url,
+            model.Resource.package_id,
+            model.Resource.created,
+            model.Resource.last_modified,
+            model.Package.owner_org,
+            model.Package.state,
+            model.Resource.state) \
+        .outerjoin(model.Resource,
+                   _and_(model.Resource.id == InventoryObject.resource_id,
+                         model.Resource.url_type == u'upload')) \
+        .outerjoin(model.Package,
+                   model.Resource.package_id == model.Package.id) \
+        .filter(~InventoryObject.name.startswith(BLOB_PREFIX),
+                linked) \
+        .yield_per(10000)
+
+    for row in query:
+        yield row[0], tuple(row[1:]) if row[1] is not None else None
+
+
+def _is_linked(upload_name, resource_fields):
+    # type: (str, tuple|None) -> bool
+    if resource_fields is None:
+        return False
+    (resource_id, filename, _, _, _, _,
+     package_state, resource_state) = resource_fields
+    return (package_state == model.core.State.ACTIVE and
+            resource_state == model.core.State.ACTIVE and
+            upload_name == os.path.join(
+                u'resources',
+                resource_id,
+                munge_filename(filename)))
 
-            if return_upload_objects_only:
-                parsed_uploads.append(upload)
-                continue
 
-            resource_id = upload.name.split('/')[1]
-            resource_fields = None
-            if resource_id:
-                resource_fields = model.Session.query(
-                                    model.Resource.id,
-                                    model.Resource.url,
-                                    model.Resource.package_id,
-                                    model.Resource.created,
-                                    model.Resource.last_modified,
-                                    model.Package.owner_org,
-                                    model.Package.state,
-                                    model.Resource.state) \
-                                    .join(model.Package, model.Resource.package_id == model.Package.id) \
-                                    .filter(_and_(model.Resource.url_type == u'upload',
-                                                  model.Resource.id == resource_id)) \
-                                    .first()
-            parsed_uploads.append({
-                u'resource_id': resource_fields[0] if resource_fields else None,
-                u'resource_filename': resource_fields[1] if resource_fields else None,
-                u'package_id': resource_fields[2] if resource_fields else None,
-                u'created': h.render_datetime(resource_fields[3]) if resource_fields else None,
-                u'last_modified': h.render_datetime(resource_fields[4]) if resource_fields else None,
-                u'organization_id': resource_fields[5] if resource_fields else None,
-                u'upload_url': upload.name,
-                u'upload_size': upload.size / 1000.0,
-                u'package_state': resource_fields[6] if resource_fields else None,
-                u'resource_state': resource_fields[7] if resource_fields else None})
-            total_space_used += upload.size / 1000.0
-
-    return total_space_used, parsed_uploads
+def _get_uploads(get_linked = True):
+    # type: (bool) -> iter
+    """Yield `(upload, resource_fields)` for every upload in the storage
+    container that is (or isn't) linked to an active resource. The listing
+    is consumed lazily, and read from the inventory if it is enabled."""
+    cs = CloudStorage()
+    if cs.use_inventory:
+        uploads = _get_inventory_uploads(get_linked)
+    else:
+        index = _get_resource_index()
+        uploads = (
+            (upload, index.get(_resource_id_from_name(upload.name)))
+            for upload in cs.iterate_objects())
+
+    for upload, resource_fields in uploads:
+        if upload.name.startswith(BLOB_PREFIX):
+            # Deduplicated blobs are reference counted, not linked.
+            continue
+        if _is_linked(upload.name, resource_fields) == get_linked:
+            yield upload, resource_fields
+
+
+def _upload_to_row(upload, resource_fields):
+    # type: (object, tuple|None) -> dict
+    if resource_fields is None:
+        resource_fields = (None,) * 8
+    (resource_id, filename, package_id, created, last_modified,
+     organization_id, package_state, resource_state) = resource_fields
+    return {
+        u'resource_id': resource_id,
+        u'resource_filename': filename,
+        u'package_id': package_id,
+        u'created': h.render_datetime(created) if resource_id else None,
+        u'last_modified': h.render_datetime(last_modified) if resource_id else None,
+        u'organization_id': organization_id,
+        u'upload_url': upload.name,
+        u'upload_size': (upload.size or 0) / 1000.0,
+        u'package_state': package_state,
+        u'resource_state': resource_state}
 
 
 def _humanize_space(space):
@@ -312,23 +626,25 @@ def _humanize_space(space):
 
 
 def _write_uploads_to_csv(output_path, uploads):
-    #type: (str, list) -> None
-    if not uploads:
-        click.echo(u"Nothing to write to {}".format(output_path))
-        return
-    with open(output_path, u'w') as f:
-        w = csv.writer(f, encoding='utf-8')
-        w.writerow((u'resource_id',
-                    u'package_id',
-                    u'organization_id',
-                    u'resource_filename',
-                    u'upload_url',
-                    u'upload_file_size_in_kb',
-                    u'resource_created',
-                    u'resource_last_modified',
-                    u'package_state',
-                    u'resource_state'))
+    #type: (str, iter) -> None
+    """Write rows to the CSV file as they are produced."""
+    f = None
+    count = 0
+    try:
         for upload in uploads:
+            if f is None:
+                f = open(output_path, u'w')
+                w = csv.writer(f, encoding='utf-8')
+                w.writerow((u'resource_id',
+                            u'package_id',
+                            u'organization_id',
+                            u'resource_filename',
+                            u'upload_url',
+                            u'upload_file_size_in_kb',
+                            u'resource_created',
+                            u'resource_last_modified',
+                            u'package_state',
+                            u'resource_state'))
             w.writerow((
                 upload[u'resource_id'],
                 upload[u'package_id'],
@@ -340,54 +656,77 @@ def _write_uploads_to_csv(output_path, uploads):
                 upload[u'last_modified'],
                 upload[u'package_state'],
                 upload[u'resource_state']))
-        click.echo(u"Wrote {} row(s) to {}"
-                    .format(len(uploads), output_path))
+            count += 1
+    finally:
+        if f is not None:
+            f.close()
 
+    if not count:
+        click.echo(u"Nothing to write to {}".format(output_path))
+        return
+    click.echo(u"Wrote {} row(s) to {}"
+                .format(count, output_path))
 
-def _list_linked_uploads(output_path):
-    # type: (str|None) -> None
-    used_space, good_uploads = _get_uploads()
 
+def _report_uploads(output_path, uploads, message):
+    # type: (str|None, iter, unicode) -> None
     if output_path:
-        _write_uploads_to_csv(output_path, good_uploads)
-    else:
-        used_space, unit = _humanize_space(used_space)
-        click.echo(u"Found {} uploads(s) with linked resources. Total space: {} {}."
-                    .format(len(good_uploads), used_space, unit))
+        _write_uploads_to_csv(output_path, uploads)
+        return
 
+    count = 0
+    used_space = 0
+    for upload in uploads:
+        count += 1
+        used_space += upload[u'upload_size'] or 0
+    used_space, unit = _humanize_space(used_space)
+    click.echo(message.format(count, used_space, unit))
 
-def _list_unlinked_uploads(output_path):
+
+def _list_linked_uploads(output_path):
     # type: (str|None) -> None
-    used_space, uploads_missing_resources = _get_uploads(get_linked = False)
+    _report_uploads(
+        output_path,
+        (_upload_to_row(*upload) for upload in _get_uploads()),
+        u"Found {} uploads(s) with linked resources. Total space: {} {}.")
 
-    if output_path:
-        _write_uploads_to_csv(output_path, uploads_missing_resources)
-    else:
-        used_space, unit = _humanize_space(used_space)
-        click.echo(u"Found {} upload(s) with missing or deleted resources. Total space: {} {}."
-                    .format(len(uploads_missing_resources), used_space, unit))
+
+def _list_unlinked_uploads(output_path):
+    # type: (str|None) -> None
+    _report_uploads(
+        output_path,
+        (_upload_to_row(*upload) for upload in _get_uploads(get_linked = False)),
+        u"Found {} upload(s) with missing or deleted resources. Total space: {} {}.")
 
 
 def _remove_unlinked_uploads():
     cs = CloudStorage()
 
-    used_space, uploads_missing_resources = _get_uploads(get_linked = False, return_upload_objects_only = True)
+    # Sizes of the uploads handed to `delete_objects` and not yet deleted.
+    sizes = {}
+
+    def names():
+        for upload, _ in _get_uploads(get_linked = False):
+            sizes[upload.name] = upload.size or 0
+            yield upload.name
 
     num_success = 0
     num_failures = 0
     saved_space = 0
-    for upload in uploads_missing_resources:
-        if cs.container.delete_object(upload):
-            click.echo(u"Deleted {}".format(upload.name))
+    used_space = 0
+    for name, error in cs.delete_objects(names()):
+        size = sizes.pop(name, 0) / 1000.0
+        if error is None:
+            click.echo(u"Deleted {}".format(name))
             num_success += 1
-            saved_space += upload.size / 1000.0
-            used_space -= upload.size / 1000.0
+            saved_space += size
         else:
-            click.echo(u"Failed to delete {}".format(upload.name))
+            click.echo(u"Failed to delete {}: {}".format(name, error))
             num_failures += 1
+            used_space += size
 
     if num_success:
-        saved_space, unit = _humanize_space(used_space)
+        saved_space, unit = _humanize_space(saved_space)
         click.echo(u"Deleted {} upload(s). Saved {} {}."
                     .format(num_success, saved_space, unit))
 
@@ -404,8 +743,6 @@ def _list_missing_uploads(output_path):
     # type: (str|None) -> None
     cs = CloudStorage()
 
-    upload_urls = set(u.name for u in cs.container.list_objects())
-
     resource_fields = model.Session.query(
                         model.Resource.id,
                         model.Resource.url,
@@ -417,37 +754,212 @@ def _list_missing_uploads(output_path):
                               model.Resource.package_id == model.Package.id) \
                         .filter(_and_(model.Resource.url_type == u'upload',
                                       model.Resource.state == model.core.State.ACTIVE,
-                                      model.Package.state == model.core.State.ACTIVE)) \
-                        .all()
-
-    resources_missing_uploads = []
-    for id, filename, package_id, created, last_modified, organization_id in resource_fields:
-        url = os.path.join(
-                u'resources',
-                id,
-                munge_filename(filename))
-
-        if url not in upload_urls:
-            resources_missing_uploads.append({
-                u'resource_id': id,
-                u'resource_filename': filename,
-                u'package_id': package_id,
-                u'created': h.render_datetime(created),
-                u'last_modified': h.render_datetime(last_modified),
-                u'organization_id': organization_id,
-                u'upload_url': None,
-                u'upload_size': None,
-                u'package_state': model.core.State.ACTIVE,
-                u'resource_state': model.core.State.ACTIVE})
+                                      model.Package.state == model.core.State.ACTIVE))
+    if cs.use_dedupe:
+        resource_fields = resource_fields \
+                        .add_column(ResourceBlob.sha256) \
+                        .outerjoin(ResourceBlob,
+                                   ResourceBlob.resource_id == model.Resource.id)
+
+    if cs.use_inventory:
+        missing = _get_inventory_missing(cs, resource_fields)
+    else:
+        # Expected upload URL -> fields of the resources using it (several
+        # for a deduplicated blob). Found uploads are removed while the
+        # listing is consumed, so memory depends on the number of
+        # resources, not on the size of the container.
+        expected = {}
+        for fields in resource_fields.yield_per(10000):
+            if cs.use_dedupe:
+                fields, sha256 = fields[:-1], fields[-1]
+            else:
+                sha256 = None
+            if sha256:
+                name = cs.blob_path(sha256)
+            else:
+                name = os.path.join(
+                    u'resources', fields[0], munge_filename(fields[1]))
+            expected.setdefault(name, []).append(fields)
+
+        for upload in cs.iterate_objects():
+            expected.pop(upload.name, None)
+
+        missing = [fields for resources in expected.itervalues()
+                   for fields in resources]
+
+    resources_missing_uploads = (
+        {
+            u'resource_id': id,
+            u'resource_filename': filename,
+            u'package_id': package_id,
+            u'created': h.render_datetime(created),
+            u'last_modified': h.render_datetime(last_modified),
+            u'organization_id': organization_id,
+            u'upload_url': None,
+            u'upload_size': None,
+            u'package_state': model.core.State.ACTIVE,
+            u'resource_state': model.core.State.ACTIVE}
+        for id, filename, package_id, created, last_modified, organization_id
+        in missing)
 
     if output_path:
         _write_uploads_to_csv(output_path, resources_missing_uploads)
     else:
         click.echo(u"Found {} resource(s) with missing uploads."
-                    .format(len(resources_missing_uploads)))
+                    .format(len(missing)))
+
+
+def _get_inventory_missing(cs, resource_fields):
+    # type: (CloudStorage, object) -> list
+    """Return the fields of the resources of `resource_fields` whose upload
+    isn't in the inventory, found by the database."""
+    name = _expected_upload_name()
+    if cs.use_dedupe:
+        name = case(
+            [(ResourceBlob.sha256 != None,  # noqa
+              literal(BLOB_PREFIX) + func.substr(ResourceBlob.sha256, 1, 2) +
+              u'/' + ResourceBlob.sha256)],
+            else_=name)
+    candidates = resource_fields.filter(
+        ~exists().where(InventoryObject.name == name)).all()
+
+    missing = []
+    for fields in candidates:
+        sha256 = fields[-1] if cs.use_dedupe else None
+        fields = fields[:6]
+        if not sha256 and fields[1] and \
+                munge_filename(fields[1]) != fields[1]:
+            # The upload of a resource whose URL isn't munged.
+            munged = os.path.join(
+                u'resources', fields[0], munge_filename(fields[1]))
+            if model.Session.query(InventoryObject.name).filter(
+                    InventoryObject.name == munged).first():
+                continue
+        missing.append(fields)
+    return missing
+
+
+def _parse_last_modified(value):
+    # type: (datetime|str|None) -> datetime|None
+    """Providers report modification times as datetimes, RFC 1123 dates
+    or ISO 8601 strings."""
+    if value is None or isinstance(value, datetime):
+        return value
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is not None:
+        return datetime.utcfromtimestamp(email.utils.mktime_tz(parsed))
+    try:
+        return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return None
+
+
+def _sync_inventory(full=False):
+    # type: (bool) -> None
+    """Copy the container listing to the inventory table.
+
+    An incremental sync only lists the resources of the datasets modified
+    since the last sync started, which is enough when the inventory is
+    also kept up to date by uploads and deletions."""
+    cs = CloudStorage()
+    last_sync = InventorySync.last_finished()
+    sync = InventorySync(full=full or last_sync is None)
+    sync.save()
+
+    if sync.full:
+        prefixes = [None]
+    else:
+        resource_ids = [
+            id for id, in model.Session.query(model.Resource.id)
+            .join(model.Package,
+                  model.Resource.package_id == model.Package.id)
+            .filter(model.Package.metadata_modified >= last_sync.started)]
+        prefixes = [u'resources/{0}/'.format(id) for id in resource_ids]
+        click.echo(u"Syncing the uploads of {} resource(s) modified since {}."
+                   .format(len(prefixes), last_sync.started))
+
+    synced, removed = _sync_prefixes(cs, prefixes, sync.started)
+
+    sync.finished = datetime.utcnow()
+    sync.save()
+    click.echo(u"Synced {} upload(s), removed {} from the inventory."
+               .format(synced, removed))
+
+
+def _sync_prefixes(cs, prefixes, started):
+    # type: (CloudStorage, list, datetime) -> tuple[int, int]
+    """Copy the listing of the objects under each prefix (`None` for the
+    whole container) to the inventory, and remove the rows of the objects
+    that weren't listed. Returns the numbers of rows synced and removed."""
+    synced = 0
+    removed = 0
+    for prefix in prefixes:
+        objects = (
+            (obj.name, obj.size, obj.hash,
+             _parse_last_modified(obj.extra.get('last_modified')))
+            for obj in cs.iterate_objects(prefix))
+        for batch in _iter_batches(objects, INVENTORY_BATCH_SIZE):
+            upsert_inventory(batch, started)
+            synced += len(batch)
+        # Whatever wasn't listed (or uploaded since) has been deleted.
+        removed += prune_inventory(started, prefix)
+    return synced, removed
+
+
+def _clean_multipart(older_than=None, dry_run=False):
+    # type: (float|None, bool) -> None
+    result = toolkit.get_action('cloudstorage_clean_multipart')(
+        {'ignore_auth': True},
+        {'older_than': older_than, 'dry_run': dry_run})
+
+    for error in result['errors']:
+        click.echo(u"Failed to abort {}".format(error))
+    reclaimed, unit = _humanize_space(result['reclaimed'] / 1000.0)
+    click.echo(u"{} {} of {} expired upload(s), {} of which CKAN had no "
+               u"record of. Reclaimed {} {}."
+               .format(u"Would abort" if dry_run else u"Aborted",
+                       result['removed'], result['total'],
+                       result['orphaned'], reclaimed, unit))
+    if result['stale']:
+        click.echo(u"{} {} record(s) of uploads that no longer exist."
+                   .format(u"Would remove" if dry_run else u"Removed",
+                           result['stale']))
+
+
+def _benchmark(output_path, sizes=None, objects=None, iterations=None,
+               workers=1, configured=False, local=False):
+    # type: (str|None, str|None, str|None, int|None, int, bool, bool) -> None
+    # Imported here, as it imports this module.
+    from ckanext.cloudstorage import benchmark
+
+    def counts(value, default):
+        if not value:
+            return default
+        return [int(count) for count in value.split(',')]
+
+    results = benchmark.run(
+        sizes=counts(sizes, benchmark.DEFAULT_SIZES),
+        objects=counts(objects, benchmark.DEFAULT_OBJECTS),
+        iterations=iterations or benchmark.DEFAULT_ITERATIONS,
+        workers=workers,
+        configured=configured,
+        local=local
+    )
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if output_path:
+        with open(output_path, 'w') as f:
+            f.write(output + '\n')
+        print(u'Results saved to {0}'.format(output_path))
+    else:
+        print(output)
 
 
 def _initdb():
-    drop_tables()
-    create_tables()
-    print("DB tables are reinitialized")
+    version = upgrade_tables()
+    if version is None:
+        print("DB tables are created")
+    elif version == SCHEMA_VERSION:
+        print("DB tables are up to date")
+    else:
+        print("DB tables are upgraded from version {0} to {1}".format(
+            version, SCHEMA_VERSION))
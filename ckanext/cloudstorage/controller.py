@@ -1,17 +1,51 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import hmac
+import logging
+import mimetypes
 import os.path
+import time
+import urllib
 
-from pylons import c
+from pylons import c, config, request, response
 from pylons.i18n import _
 
 from ckan import logic, model
 from ckan.lib import base, uploader
 import ckan.lib.helpers as h
 
+from ckanext.cloudstorage import metrics, storage
+
+log = logging.getLogger(__name__)
+
+# The resource fields cached for downloads.
+CACHED_RESOURCE_FIELDS = ('id', 'package_id', 'url', 'url_type')
+
+# Download modes where the front-end server sends the file, and the
+# header telling it which one.
+OFFLOAD_HEADERS = {
+    'x-accel-redirect': 'X-Accel-Redirect',
+    'x-sendfile': 'X-Sendfile'
+}
+
+# Provider statuses passed to the client in proxy mode, without a body:
+# the client's copy is current, or its conditions or range can't be met.
+PROXY_EMPTY_STATUSES = (304, 412, 416)
+
+# Request headers passed to the provider in proxy mode.
+PROXY_REQUEST_HEADERS = (
+    'If-Match',
+    'If-Modified-Since',
+    'If-None-Match',
+    'If-Range',
+    'If-Unmodified-Since',
+    'Range'
+)
+
 
 class StorageController(base.BaseController):
     def resource_download(self, id, resource_id, filename=None):
+        started = time.time()
         context = {
             'model': model,
             'session': model.Session,
@@ -19,17 +53,7 @@ class StorageController(base.BaseController):
             'auth_user_obj': c.userobj
         }
 
-        try:
-            resource = logic.get_action('resource_show')(
-                context,
-                {
-                    'id': resource_id
-                }
-            )
-        except logic.NotFound:
-            base.abort(404, _('Resource not found'))
-        except logic.NotAuthorized:
-            base.abort(401, _('Unauthorized to read resource {0}'.format(id)))
+        resource = self._get_resource(context, id, resource_id)
 
         # This isn't a file upload, so either redirect to the source
         # (if available) or error out.
@@ -44,7 +68,27 @@ class StorageController(base.BaseController):
             filename = os.path.basename(resource['url'])
 
         upload = uploader.get_resource_uploader(resource)
-        uploaded_url = upload.get_url_from_filename(resource['id'], filename)
+        download_mode = getattr(upload, 'download_mode', None)
+        if download_mode == 'proxy':
+            return self._proxy_download(upload, resource['id'], filename)
+        if (download_mode in OFFLOAD_HEADERS and
+                upload.driver_name == 'LOCAL'):
+            return self._offload_download(
+                upload, resource['id'], filename, download_mode, started)
+        if upload.needs_proxy(resource['id']):
+            return self._proxy_download(upload, resource['id'], filename)
+
+        try:
+            uploaded_url = upload.get_url_from_filename(
+                resource['id'], filename)
+        except Exception:
+            self._observe_redirect(upload, started, 'error')
+            raise
+        self._observe_redirect(
+            upload,
+            started,
+            'not_found' if uploaded_url is None else 'success'
+        )
 
         # The uploaded file is missing for some reason, such as the
         # provider being down.
@@ -52,3 +96,177 @@ class StorageController(base.BaseController):
             base.abort(404, _('No download is available'))
 
         h.redirect_to(uploaded_url)
+
+    def metrics(self):
+        """Return the metrics of this process in the Prometheus text
+        format, to sysadmins or to requests with the
+        `ckanext.cloudstorage.metrics_token` bearer token."""
+        token = config.get('ckanext.cloudstorage.metrics_token')
+        authorization = request.headers.get('Authorization', '')
+        if not (token and hmac.compare_digest(
+                str(authorization), str('Bearer ' + token))):
+            context = {
+                'model': model,
+                'user': c.user,
+                'auth_user_obj': c.userobj
+            }
+            try:
+                logic.check_access('cloudstorage_metrics', context, {})
+            except logic.NotAuthorized:
+                base.abort(403, _('Not authorized to see this page'))
+
+        response.headers['Content-Type'] = (
+            'text/plain; version=0.0.4; charset=utf-8')
+        return metrics.registry.render_prometheus()
+
+    def _observe_redirect(self, upload, started, outcome,
+                          operation='download_redirect'):
+        # The whole time it took to answer with a redirect, including the
+        # resource lookup.
+        metrics.observe(
+            operation,
+            getattr(upload, 'driver_name', None),
+            time.time() - started,
+            outcome
+        )
+
+    def _offload_download(self, upload, resource_id, filename, mode,
+                          started):
+        """Have the front-end server send the file from the `LOCAL`
+        driver's directory, so that CKAN never reads it."""
+        name = upload.resolve_path(resource_id, filename)
+        path = upload.local_path(name)
+        if path is None or not os.path.isfile(path):
+            self._observe_redirect(
+                upload, started, 'not_found', 'download_offload')
+            base.abort(404, _('No download is available'))
+
+        if mode == 'x-accel-redirect':
+            # A URI under nginx's internal location, not a path.
+            target = '{0}/{1}/{2}'.format(
+                upload.accel_redirect_prefix.rstrip('/'),
+                urllib.quote(upload.container_name),
+                urllib.quote(
+                    name.encode('utf-8') if isinstance(name, unicode)
+                    else name,
+                    safe='/-_.~'
+                )
+            )
+        else:
+            target = path.encode('utf-8') if isinstance(path, unicode) \
+                else path
+
+        content_type, _encoding = mimetypes.guess_type(filename)
+        response.headers['Content-Type'] = (
+            content_type or 'application/octet-stream')
+        response.headers.pop('Content-Length', None)
+        if name.startswith(storage.BLOB_PREFIX):
+            response.headers['Content-Disposition'] = (
+                storage.content_disposition(filename))
+        response.headers[OFFLOAD_HEADERS[mode]] = target
+        self._observe_redirect(
+            upload, started, 'success', 'download_offload')
+        return ''
+
+    def _proxy_download(self, upload, resource_id, filename):
+        """Stream the file through CKAN instead of redirecting to it."""
+        if not storage.acquire_proxy_slot():
+            base.abort(503, _('Too many downloads in progress'),
+                       headers={'Retry-After': '1'})
+
+        headers = dict(
+            (header, request.headers[header])
+            for header in PROXY_REQUEST_HEADERS
+            if header in request.headers
+        )
+        name = upload.resolve_path(resource_id, filename)
+        try:
+            status, response_headers, body = upload.open_object(
+                name,
+                headers,
+                on_close=storage.release_proxy_slot
+            )
+        except Exception:
+            storage.release_proxy_slot()
+            log.exception('Unable to download resource %s', resource_id)
+            base.abort(502, _('No download is available'))
+
+        if status == 404:
+            body.close()
+            base.abort(404, _('No download is available'))
+        elif status in PROXY_EMPTY_STATUSES:
+            body.close()
+            response.status_int = status
+            response_headers.pop('Content-Length', None)
+            response.headers.update(response_headers)
+            return ''
+        elif status >= 400:
+            log.error('Download of resource %s failed with status %s: %s',
+                      resource_id, status, body.read_all())
+            base.abort(502, _('No download is available'))
+
+        response.status_int = status
+        # Setting the body clears the length, so it is set here rather than
+        # by Pylons once the action returns, and the provider's headers
+        # applied after it.
+        response.headers.pop('Content-Length', None)
+        response.app_iter = body
+        response.headers.update(response_headers)
+        if name.startswith(storage.BLOB_PREFIX):
+            # Deduplicated blobs are named after their hash.
+            response.headers['Content-Disposition'] = (
+                storage.content_disposition(filename))
+        if 'Content-Length' in response_headers:
+            response.content_length = int(response_headers['Content-Length'])
+        # `None` makes Pylons send `response` as it is.
+        return None
+
+    def _get_resource(self, context, id, resource_id):
+        """Return the resource, from the cache if it is enabled.
+
+        The cache only holds what downloads need, and whether the resource
+        belongs to an active, public dataset. Access to other resources is
+        still checked on every download."""
+        ttl = storage.CloudStorage.download_cache_ttl.fget(None)
+
+        cached = storage.resource_cache.get(resource_id) if ttl > 0 else None
+        if cached is not None:
+            resource, public = cached
+            if not public:
+                try:
+                    logic.check_access(
+                        'resource_show', context.copy(), {'id': resource_id})
+                except logic.NotAuthorized:
+                    base.abort(
+                        401,
+                        _('Unauthorized to read resource {0}'.format(id))
+                    )
+            return dict(resource)
+
+        try:
+            resource = logic.get_action('resource_show')(
+                context,
+                {
+                    'id': resource_id
+                }
+            )
+        except logic.NotFound:
+            base.abort(404, _('Resource not found'))
+        except logic.NotAuthorized:
+            base.abort(401, _('Unauthorized to read resource {0}'.format(id)))
+
+        if ttl > 0:
+            package = model.Package.get(resource['package_id'])
+            storage.resource_cache.set(
+                resource_id,
+                (
+                    dict(
+                        (field, resource.get(field))
+                        for field in CACHED_RESOURCE_FIELDS
+                    ),
+                    package is not None and package.state == 'active' and
+                    not package.private
+                ),
+                ttl
+            )
+        return resource
@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A minimal S3-compatible server, run in a thread of the current process, so
+that the benchmarks can measure the S3 code paths (multipart uploads,
+kept-alive connections, batch deletes) without a provider.
+
+Objects are kept in files of a directory, so that the memory use of the
+process doesn't depend on their size. Requests aren't authenticated, and
+only what ckanext-cloudstorage and libcloud's S3 driver use is supported:
+
+- buckets: HEAD, PUT, DELETE and GET (listing objects, or multipart
+  uploads with `?uploads`);
+- objects: PUT, GET, HEAD and DELETE;
+- multipart uploads: initiate, upload part, list parts, complete and abort;
+- DeleteObjects (`POST /<bucket>?delete`).
+"""
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import os
+import shutil
+import socket
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+from email.utils import formatdate
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+# The size of the reads and writes of request and object bodies.
+BUFFER_SIZE = 64 * 1024
+# The maximum number of keys returned by a listing.
+MAX_KEYS = 1000
+
+
+class FakeS3Server(object):
+    """
+    An S3-compatible server listening on `host`, storing objects in `path`.
+
+    The server runs from `start` to `stop`, or as a context manager.
+    """
+    def __init__(self, path, host='127.0.0.1', port=0):
+        """
+        :param path: The directory objects are stored in.
+        :param host: The address to listen on.
+        :param port: The port to listen on, a free one if 0.
+        """
+        self.path = path
+        self.buckets = set()
+        # (bucket, key) -> object, see `_store`.
+        self.objects = {}
+        # Upload ID -> (bucket, key, content type, initiated, parts), where
+        # parts maps part numbers to objects.
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+        self.httpd = _HTTPServer((host, port), _Handler)
+        self.httpd.storage = self
+        self.host, self.port = self.httpd.server_address[:2]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._thread.join()
+        # Kept-alive connections would otherwise be waited on forever.
+        with self.lock:
+            connections = list(self.httpd.connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def driver_options(self):
+        """
+        The `driver_options` of the `S3` driver for this server.
+        """
+        return {
+            'key': 'benchmark',
+            'secret': 'benchmark',
+            'host': self.host,
+            'port': self.port,
+            'secure': False
+        }
+
+    def new_file(self):
+        return os.path.join(self.path, uuid.uuid4().hex)
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+        # The connections of the running handlers.
+        self.connections = set()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Kept-alive connections, as with S3.
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.storage.lock:
+            self.server.connections.add(self.connection)
+
+    def finish(self):
+        with self.storage.lock:
+            self.server.connections.discard(self.connection)
+        BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._dispatch('HEAD')
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    @property
+    def storage(self):
+        return self.server.storage
+
+    def _dispatch(self, method):
+        url = urlparse.urlsplit(self.path)
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        self.bucket = urllib.unquote(bucket)
+        self.key = urllib.unquote(key)
+        self.query = dict(urlparse.parse_qsl(
+            url.query, keep_blank_values=True))
+        self.body_read = False
+
+        try:
+            if self.bucket not in self.storage.buckets and not (
+                    method == 'PUT' and not self.key):
+                return self._error(404, 'NoSuchBucket')
+            if not self.key:
+                kind = '_bucket_'
+            elif 'uploads' in self.query or 'uploadId' in self.query:
+                kind = '_multipart_'
+            else:
+                kind = '_object_'
+            handler = getattr(self, kind + method.lower(), None)
+            if handler is None:
+                return self._error(501, 'NotImplemented')
+            handler()
+        finally:
+            # Unread bodies would be taken for the next request.
+            if not self.body_read:
+                self._read_body()
+
+    # Buckets
+
+    def _bucket_head(self):
+        self._send(200)
+
+    def _bucket_put(self):
+        self._read_body()
+        with self.storage.lock:
+            self.storage.buckets.add(self.bucket)
+        self._send(200)
+
+    def _bucket_delete(self):
+        with self.storage.lock:
+            if any(bucket == self.bucket
+                   for bucket, _key in self.storage.objects):
+                return self._error(409, 'BucketNotEmpty')
+            self.storage.buckets.discard(self.bucket)
+        self._send(204)
+
+    def _bucket_get(self):
+        if 'uploads' in self.query:
+            return self._list_uploads()
+
+        prefix = self.query.get('prefix', '')
+        marker = self.query.get('marker', '')
+        with self.storage.lock:
+            keys = sorted(
+                key for bucket, key in self.storage.objects
+                if bucket == self.bucket and key.startswith(prefix) and
+                key > marker
+            )
+            objects = [
+                (key, self.storage.objects[(self.bucket, key)])
+                for key in keys[:MAX_KEYS]
+            ]
+        self._send_xml('ListBucketResult', ''.join(
+            '<Contents><Key>{0}</Key><LastModified>{1}</LastModified>'
+            '<ETag>&quot;{2}&quot;</ETag><Size>{3}</Size>'
+            '<StorageClass>STANDARD</StorageClass></Contents>'.format(
+                escape(key), _iso_date(obj['last_modified']), obj['etag'],
+                obj['size'])
+            for key, obj in objects
+        ) + '<Name>{0}</Name><Prefix>{1}</Prefix><Marker>{2}</Marker>'
+            '<MaxKeys>{3}</MaxKeys><IsTruncated>{4}</IsTruncated>'.format(
+                escape(self.bucket), escape(prefix), escape(marker),
+                MAX_KEYS, _bool(len(keys) > MAX_KEYS)))
+
+    def _list_uploads(self):
+        with self.storage.lock:
+            uploads = sorted(
+                (key, upload_id, initiated)
+                for upload_id, (bucket, key, _type, initiated, _parts)
+                in self.storage.uploads.items()
+                if bucket == self.bucket
+            )
+        self._send_xml('ListMultipartUploadsResult', ''.join(
+            '<Upload><Key>{0}</Key><UploadId>{1}</UploadId>'
+            '<Initiator><DisplayName>benchmark</DisplayName></Initiator>'
+            '<Owner><DisplayName>benchmark</DisplayName></Owner>'
+            '<Initiated>{2}</Initiated></Upload>'.format(
+                escape(key), upload_id, _iso_date(initiated))
+            for key, upload_id, initiated in uploads
+        ) + '<Bucket>{0}</Bucket><IsTruncated>false</IsTruncated>'.format(
+            escape(self.bucket)))
+
+    # Objects
+
+    def _object_head(self):
+        obj = self._get_object()
+        if obj is not None:
+            self._send(200, _object_headers(obj))
+
+    def _object_get(self):
+        obj = self._get_object()
+        if obj is None:
+            return
+        if self.headers.get('If-None-Match') == '"{0}"'.format(obj['etag']):
+            return self._send(304, {'ETag': '"{0}"'.format(obj['etag'])})
+
+        self._send(200, _object_headers(obj), body=None)
+        with open(obj['path'], 'rb') as f:
+            shutil.copyfileobj(f, self.wfile, BUFFER_SIZE)
+
+    def _object_put(self):
+        obj = self._store(self.headers.get('Content-Type'))
+        with self.storage.lock:
+            self._replace((self.bucket, self.key), obj)
+        self._send(200, {'ETag': '"{0}"'.format(obj['etag'])})
+
+    def _object_delete(self):
+        with self.storage.lock:
+            self._replace((self.bucket, self.key), None)
+        self._send(204)
+
+    def _get_object(self):
+        with self.storage.lock:
+            obj = self.storage.objects.get((self.bucket, self.key))
+        if obj is None:
+            self._error(404, 'NoSuchKey')
+        return obj
+
+    # Multipart uploads
+
+    def _multipart_post(self):
+        if 'uploads' in self.query:
+            upload_id = uuid.uuid4().hex
+            with self.storage.lock:
+                self.storage.uploads[upload_id] = (
+                    self.bucket, self.key, self.headers.get('Content-Type'),
+                    time.time(), {})
+            return self._send_xml(
+                'InitiateMultipartUploadResult',
+                '<Bucket>{0}</Bucket><Key>{1}</Key>'
+                '<UploadId>{2}</UploadId>'.format(
+                    escape(self.bucket), escape(self.key), upload_id))
+
+        upload = self._get_upload()
+        if upload is None:
+            return
+        numbers = [
+            int(node.text)
+            for node in ElementTree.fromstring(self._read_body()).iter()
+            if node.tag.endswith('PartNumber')
+        ]
+        _bucket, _key, content_type, _initiated, parts = upload
+        if any(n not in parts for n in numbers):
+            return self._error(400, 'InvalidPart')
+
+        # The parts are copied into a single file, as they are uploaded in
+        # any order, and can be uploaded again.
+        path = self.storage.new_file()
+        size = 0
+        digests = hashlib.md5()
+        with open(path, 'wb') as f:
+            for n in numbers:
+                with open(parts[n]['path'], 'rb') as part:
+                    shutil.copyfileobj(part, f, BUFFER_SIZE)
+                size += parts[n]['size']
+                digests.update(parts[n]['etag'].decode('hex'))
+        etag = '{0}-{1}'.format(digests.hexdigest(), len(numbers))
+
+        with self.storage.lock:
+            self.storage.uploads.pop(self.query['uploadId'], None)
+            self._replace((self.bucket, self.key), {
+                'path': path,
+                'size': size,
+                'etag': etag,
+                'content_type': content_type,
+                'last_modified': time.time()
+            })
+        for part in parts.values():
+            _remove(part['path'])
+        self._send_xml(
+            'CompleteMultipartUploadResult',
+            '<Bucket>{0}</Bucket><Key>{1}</Key>'
+            '<ETag>&quot;{2}&quot;</ETag>'.format(
+                escape(self.bucket), escape(self.key), etag))
+
+    def _multipart_put(self):
+        upload = self._get_upload()
+        if upload is None:
+            return
+        part = self._store()
+        with self.storage.lock:
+            previous = upload[4].get(int(self.query['partNumber']))
+            upload[4][int(self.query['partNumber'])] = part
+        if previous is not None:
+            _remove(previous['path'])
+        self._send(200, {'ETag': '"{0}"'.format(part['etag'])})
+
+    def _multipart_get(self):
+        upload = self._get_upload()
+        if upload is not None:
+            self._send_xml('ListPartsResult', ''.join(
+                '<Part><PartNumber>{0}</PartNumber><ETag>&quot;{1}&quot;'
+                '</ETag><Size>{2}</Size></Part>'.format(
+                    n, part['etag'], part['size'])
+                for n, part in sorted(upload[4].items())
+            ) + '<UploadId>{0}</UploadId>'
+                '<IsTruncated>false</IsTruncated>'.format(
+                    self.query['uploadId']))
+
+    def _multipart_delete(self):
+        with self.storage.lock:
+            upload = self.storage.uploads.pop(self.query['uploadId'], None)
+        if upload is None:
+            return self._error(404, 'NoSuchUpload')
+        for part in upload[4].values():
+            _remove(part['path'])
+        self._send(204)
+
+    def _get_upload(self):
+        with self.storage.lock:
+            upload = self.storage.uploads.get(self.query['uploadId'])
+        if upload is None or upload[:2] != (self.bucket, self.key):
+            self._error(404, 'NoSuchUpload')
+            return None
+        return upload
+
+    # DeleteObjects
+
+    def _bucket_post(self):
+        if 'delete' not in self.query:
+            return self._error(400, 'InvalidRequest')
+        keys = [
+            node.text
+            for node in ElementTree.fromstring(self._read_body()).iter()
+            if node.tag.endswith('Key')
+        ]
+        with self.storage.lock:
+            for key in keys:
+                if isinstance(key, unicode):
+                    key = key.encode('utf-8')
+                self._replace((self.bucket, key), None)
+        # In quiet mode, only failures are listed.
+        self._send_xml('DeleteResult', '')
+
+    # Helpers
+
+    def _store(self, content_type=None):
+        # Write the request body to a new file.
+        path = self.storage.new_file()
+        remaining = int(self.headers.get('Content-Length') or 0)
+        md5 = hashlib.md5()
+        with open(path, 'wb') as f:
+            while remaining > 0:
+                chunk = self.rfile.read(min(BUFFER_SIZE, remaining))
+                if not chunk:
+                    break
+                md5.update(chunk)
+                f.write(chunk)
+                remaining -= len(chunk)
+        self.body_read = True
+        return {
+            'path': path,
+            'size': os.path.getsize(path),
+            'etag': md5.hexdigest(),
+            'content_type': content_type or 'application/octet-stream',
+            'last_modified': time.time()
+        }
+
+    def _replace(self, key, obj):
+        # Called with the lock held.
+        previous = self.storage.objects.pop(key, None)
+        if obj is not None:
+            self.storage.objects[key] = obj
+        if previous is not None:
+            _remove(previous['path'])
+
+    def _read_body(self):
+        self.body_read = True
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else ''
+
+    def _send(self, status, headers=None, body=''):
+        # `body=None` leaves the body to the caller, after the headers.
+        self.send_response(status)
+        headers = dict(headers or {})
+        if body is not None and 'Content-Length' not in headers:
+            headers['Content-Length'] = str(len(body))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _send_xml(self, root, content, status=200):
+        self._send(status, {'Content-Type': 'application/xml'}, (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<{0} xmlns="{1}">{2}</{0}>'.format(root, NAMESPACE, content)
+        ))
+
+    def _error(self, status, code):
+        self._send_xml(
+            'Error', '<Code>{0}</Code><Message>{0}</Message>'.format(code),
+            status=status
+        )
+
+
+def _object_headers(obj):
+    return {
+        'Content-Length': str(obj['size']),
+        'Content-Type': obj['content_type'],
+        'ETag': '"{0}"'.format(obj['etag']),
+        'Last-Modified': formatdate(obj['last_modified'], usegmt=True)
+    }
+
+
+def _iso_date(timestamp):
+    return time.strftime(
+        '%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(timestamp))
+
+
+def _bool(value):
+    return 'true' if value else 'false'
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
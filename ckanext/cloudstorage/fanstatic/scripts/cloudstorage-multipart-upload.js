@@ -4,6 +4,21 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
     return {
         options: {
             cloud: 'S3',
+            direct: false,
+            // Number of parts uploaded at the same time.
+            parallelUploads: 4,
+            // S3 limits: every part but the last one must be at least 5 MB,
+            // and an upload can't have more than 10,000 parts.
+            minChunkSize: 5 * 1024 * 1024,
+            maxChunkSize: 1024 * 1024 * 1024,
+            maxParts: 10000,
+            // Part size is adapted so that a part takes about this long to
+            // upload.
+            targetPartSeconds: 15,
+            maxRetries: 5,
+            retryDelay: 1000,
+            // How often to check on an upload finished in the background.
+            statusPollInterval: 2000,
             i18n: {
                 resource_create: _('Resource has been created.'),
                 resource_update: _('Resource has been updated.'),
@@ -13,9 +28,8 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
             }
         },
 
-        _partNumber: 1,
-
         _uploadId: null,
+        _direct: false,
         _packageId: null,
         _resourceId: null,
         _uploadSize: null,
@@ -45,18 +59,11 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
 
             var self = this;
 
+            // Only used to pick the file, parts are sent by
+            // `_onPerformPartsUpload`.
             this._file.fileupload({
-                url: this.sandbox.client.url('/api/action/cloudstorage_upload_multipart'),
-                maxChunkSize: 5 * 1024 * 1024,
                 replaceFileInput: false,
-                formData: this._onGenerateAdditionalData,
-                submit: this._onUploadFileSubmit,
-                chunkdone: this._onChunkUploaded,
-                add: this._onFileUploadAdd,
-                progressall: this._onFileUploadProgress,
-                done: this._onFinishUpload,
-                fail: this._onUploadFail,
-                always: this._onAnyEndedUpload
+                add: this._onFileUploadAdd
             });
 
             this._save.on('click', this._onSaveClick);
@@ -64,10 +71,6 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
             this._onCheckExistingMultipart('choose');
         },
 
-        _onChunkUploaded: function () {
-            this._uploadedParts = this._partNumber++;
-        },
-
         _onCheckExistingMultipart: function (operation) {
             var self = this;
             var id = this._id.val();
@@ -82,15 +85,10 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
 
                     var name = upload.name.slice(upload.name.lastIndexOf('/')+1);
                     self._uploadId = upload.id;
+                    self._direct = self.options.direct;
                     self._uploadSize = upload.size;
                     self._uploadedParts = upload.parts;
                     self._uploadName = upload.original_name;
-                    self._partNumber = self._uploadedParts + 1;
-
-
-                    var current_chunk_size = self._file.fileupload('option', 'maxChunkSize');
-                    var uploaded_bytes = current_chunk_size * upload.parts;
-                    self._file.fileupload('option', 'uploadedBytes', uploaded_bytes);
 
                     self.sandbox.notify(
                         'Incomplete upload',
@@ -142,54 +140,9 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
             this._onCheckExistingMultipart('resume');
         },
 
-        _onUploadFileSubmit: function (event, data) {
-            if (!this._uploadId) {
-                this._onDisableSave(false);
-                this.sandbox.notify(
-                    'Upload error',
-                    this.i18n('undefined_upload_id'),
-                    'error'
-                );
-                return false;
-            }
-
-            this._setProgressType('info', this._progress);
-            this._progress.show('slow');
-        },
-
-        _onGenerateAdditionalData: function (form) {
-            return [
-                {
-                    name: 'partNumber',
-                    value: this._partNumber
-                },
-                {
-                    name: 'uploadId',
-                    value: this._uploadId
-                },
-                {
-                    name: 'id',
-                    value: this._resourceId
-                }
-
-            ];
-        },
-
-        _onAnyEndedUpload: function () {
-            this._partNumber = 1;
-        },
-
-        _countChunkSize: function (size, chunk) {
-            while (size / chunk > 10000) chunk *= 2;
-            return chunk;
-        },
-
         _onFileUploadAdd: function (event, data) {
             this._setProgress(0, this._bar);
             var file = data.files[0];
-            var target = $(event.target);
-
-            var chunkSize = this._countChunkSize(file.size, target.fileupload('option', 'maxChunkSize'));
 
             if (this._uploadName && this._uploadSize && this._uploadedParts !== null) {
                 if (this._uploadSize !== file.size || this._uploadName !== file.name){
@@ -204,31 +157,17 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
                     throw 'Wrong file';
                 }
 
-
-                var loaded = chunkSize * this._uploadedParts;
-
-                // target.fileupload('option', 'uploadedBytes', loaded);
-                this._onFileUploadProgress(event, {
-                    total: file.size,
-                    loaded: loaded
-                });
-
+                // Only the ranges of the file that are not in a completed
+                // part are sent again, see `_planGaps`.
                 this._progress.show('slow');
                 this._onDisableResumeBtn();
                 this._save.trigger('click');
-
-                if (loaded >= file.size){
-                    this._onFinishUpload();
-                }
-
             }
 
-
-            target.fileupload('option', 'maxChunkSize', chunkSize);
-
+            var self = this;
             this.el.off('multipartstarted.cloudstorage');
             this.el.on('multipartstarted.cloudstorage', function () {
-                data.submit();
+                self._onPerformPartsUpload(file);
             });
         },
 
@@ -311,10 +250,17 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
         _onPerformUpload: function(file) {
             var id = this._id.val();
             var self = this;
+            if (this.options.direct && this._uploadId === null &&
+                    file.size <= this.options.minChunkSize) {
+                // Small enough to be sent in a single request.
+                this._onPerformDirectPut(file, id);
+                return;
+            }
             if (this._uploadId === null)
                 this._onPrepareUpload(file, id).then(
                     function (data) {
                         self._uploadId = data.result.id;
+                        self._direct = !!data.result.direct;
                         self.el.trigger('multipartstarted.cloudstorage');
                     },
                     function (err) {
@@ -341,6 +287,247 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
 
         },
 
+        _onPerformDirectPut: function(file, id) {
+            var self = this;
+            this._setProgressType('info', this._progress);
+            this._progress.show('slow');
+
+            $.ajax({
+                method: 'POST',
+                url: this.sandbox.client.url('/api/action/cloudstorage_presign_upload'),
+                data: JSON.stringify({
+                    id: id,
+                    name: file.name
+                })
+            }).then(
+                function (data) {
+                    return self._onPutBlob(
+                        data.result.url, file, data.result.headers);
+                }
+            ).then(
+                function () {
+                    self._onFileUploadProgress(null, {
+                        total: file.size,
+                        loaded: file.size
+                    });
+                    self._onFinishUpload();
+                },
+                function (err) {
+                    console.log(err);
+                    self._onHandleError('Upload fail');
+                }
+            );
+        },
+
+        _onPerformPartsUpload: function(file) {
+            var self = this;
+            var options = this.options;
+            var parts = [];
+            var loaded = {};
+            var gaps = [];
+            var inFlight = 0;
+            var failed = false;
+            var chunkSize = options.minChunkSize;
+
+            if (!this._uploadId) {
+                this._onDisableSave(false);
+                this.sandbox.notify(
+                    'Upload error',
+                    this.i18n('undefined_upload_id'),
+                    'error'
+                );
+                return;
+            }
+
+            this._setProgressType('info', this._progress);
+            this._progress.show('slow');
+
+            gaps = this._planGaps(this._uploadedParts || [], file.size);
+            $.each(this._uploadedParts || [], function (i, part) {
+                if (part.kept) {
+                    parts.push({partNumber: part.partNumber, ETag: part.ETag});
+                    loaded[part.partNumber] = part.size;
+                }
+            });
+
+            var progress = function () {
+                var total = 0;
+                $.each(loaded, function (n, bytes) { total += bytes; });
+                self._onFileUploadProgress(null, {
+                    total: file.size,
+                    loaded: total
+                });
+            };
+
+            // Take the next range of the first gap, never using more part
+            // numbers than the gap has.
+            var plan = function () {
+                var gap = gaps[0];
+                var remaining = gap.end - gap.start;
+                var partsLeft = gap.lastPart - gap.nextPart + 1;
+                var size = Math.max(chunkSize, Math.ceil(remaining / partsLeft));
+                if (gap.end < file.size &&
+                        remaining - size < options.minChunkSize) {
+                    // Only the last part of the file may be smaller.
+                    size = remaining;
+                }
+                var part = {
+                    number: gap.nextPart++,
+                    start: gap.start,
+                    end: Math.min(gap.start + size, gap.end)
+                };
+                gap.start = part.end;
+                if (gap.start >= gap.end) gaps.shift();
+                return part;
+            };
+
+            var send = function (part, attempt) {
+                var started = Date.now();
+                var blob = file.slice(part.start, part.end);
+                self._onUploadPart(part, blob).then(
+                    function (etag) {
+                        var seconds = Math.max((Date.now() - started) / 1000, 0.001);
+                        var speed = (part.end - part.start) / seconds;
+                        chunkSize = Math.min(
+                            Math.max(speed * options.targetPartSeconds,
+                                     options.minChunkSize),
+                            options.maxChunkSize);
+
+                        parts.push({partNumber: part.number, ETag: etag});
+                        loaded[part.number] = part.end - part.start;
+                        inFlight -= 1;
+                        progress();
+                        pump();
+                    },
+                    function (err) {
+                        if (failed) return;
+                        if (attempt >= options.maxRetries) {
+                            console.log(err);
+                            failed = true;
+                            self._onUploadFail();
+                            return;
+                        }
+                        // Retry this part only, backing off exponentially.
+                        setTimeout(function () {
+                            send(part, attempt + 1);
+                        }, options.retryDelay * Math.pow(2, attempt));
+                    }
+                );
+            };
+
+            var pump = function () {
+                if (failed) return;
+                while (inFlight < options.parallelUploads && gaps.length) {
+                    inFlight += 1;
+                    send(plan(), 0);
+                }
+                if (inFlight === 0 && !gaps.length) {
+                    parts.sort(function (a, b) {
+                        return a.partNumber - b.partNumber;
+                    });
+                    self._onFinishUpload(parts);
+                }
+            };
+
+            pump();
+        },
+
+        // Return the ranges of the file that are not in a completed part,
+        // with the part numbers each one can use: parts are assembled in
+        // the order of their numbers. Completed parts that leave no
+        // usable part number, or less than `minChunkSize`, before them are
+        // sent again, the others are marked as `kept`.
+        _planGaps: function(completed, size) {
+            var options = this.options;
+            var gaps = [];
+            var end = 0;
+            var lastPart = 0;
+
+            $.each(completed, function (i, part) {
+                var gap = part.start - end;
+                part.kept = !(gap > 0 && (
+                    part.partNumber <= lastPart + 1 ||
+                    gap < options.minChunkSize));
+                if (!part.kept) return;
+                if (gap > 0) {
+                    gaps.push({
+                        start: end,
+                        end: part.start,
+                        nextPart: lastPart + 1,
+                        lastPart: part.partNumber - 1
+                    });
+                }
+                end = part.start + part.size;
+                lastPart = part.partNumber;
+            });
+            if (end < size) {
+                gaps.push({
+                    start: end,
+                    end: size,
+                    nextPart: lastPart + 1,
+                    lastPart: options.maxParts
+                });
+            }
+            return gaps;
+        },
+
+        _onUploadPart: function(part, blob) {
+            if (this._direct) {
+                return this._onUploadDirectPart(part, blob);
+            }
+
+            var formData = new FormData();
+            formData.append('partNumber', part.number);
+            formData.append('start', part.start);
+            formData.append('uploadId', this._uploadId);
+            formData.append('id', this._resourceId);
+            formData.append('upload', blob, this._uploadName || 'upload');
+            return $.ajax({
+                method: 'POST',
+                url: this.sandbox.client.url('/api/action/cloudstorage_upload_multipart'),
+                data: formData,
+                processData: false,
+                contentType: false
+            }).then(function (data) {
+                return data.result.ETag;
+            });
+        },
+
+        _onUploadDirectPart: function(part, blob) {
+            var self = this;
+            return this._onSignParts([{
+                partNumber: part.number,
+                start: part.start,
+                size: part.end - part.start
+            }]).then(function (data) {
+                return self._onPutBlob(data.result.urls[part.number], blob, {});
+            });
+        },
+
+        _onSignParts: function(parts) {
+            return $.ajax({
+                method: 'POST',
+                url: this.sandbox.client.url('/api/action/cloudstorage_sign_multipart'),
+                data: JSON.stringify({
+                    uploadId: this._uploadId,
+                    parts: parts
+                })
+            });
+        },
+
+        _onPutBlob: function(url, blob, headers) {
+            return $.ajax({
+                method: 'PUT',
+                url: url,
+                data: blob,
+                headers: headers || {},
+                processData: false,
+                contentType: false
+            }).then(function (data, status, xhr) {
+                return xhr.getResponseHeader('ETag');
+            });
+        },
+
         _onAbortUpload: function(id) {
             var self = this;
             this.sandbox.client.call(
@@ -360,48 +547,24 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
 
         },
 
-        _onFinishUpload: function() {
+        _onFinishUpload: function(parts) {
             var self = this;
             var data_dict = {
                 'uploadId': this._uploadId,
                 'id': this._resourceId,
                 'save_action': this._clickedBtn
             }
+            if ($.isArray(parts)) {
+                // Every part of the file, including those uploaded directly
+                // to the cloud, which CKAN has not seen yet.
+                data_dict.parts = parts;
+            }
             this.sandbox.client.call(
                 'POST',
-                'cloudstorage_finish_multipart',
+                this._uploadId ? 'cloudstorage_finish_multipart' : 'cloudstorage_finish_upload',
                 data_dict,
                 function (data) {
-
-                    self._progress.hide('fast');
-                    self._onDisableSave(false);
-
-                    if (self._resourceId && self._packageId){
-                        self.sandbox.notify(
-                            'Success',
-                            self.i18n('upload_completed'),
-                            'success'
-                        );
-                        // self._form.remove();
-                        if (self._clickedBtn == 'again') {
-                            this._redirect_url = self.sandbox.url(
-                                '/dataset/new_resource/' +
-                                self._packageId
-                            );
-                        } else {
-                            this._redirect_url = self.sandbox.url(
-                                '/dataset/' +
-                                self._packageId
-                            );
-                        }
-                        self._form.attr('action', this._redirect_url);
-                        self._form.attr('method', 'GET');
-                        self.$('[name]').attr('name', null);
-                        setTimeout(function(){
-                            self._form.submit();
-                        }, 3000);
-
-                    }
+                    self._onWaitForCommit(data.result);
                 },
                 function (err) {
                     console.log(err);
@@ -411,6 +574,71 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
             this._setProgressType('success', this._progress);
         },
 
+        _onWaitForCommit: function(result) {
+            var self = this;
+            var status = result && result.status;
+
+            if (!status || status === 'committed') {
+                this._onUploadCommitted();
+                return;
+            }
+            if (status === 'failed') {
+                console.log(result.error);
+                this._onHandleError(this.i18n('unable_to_finish'));
+                return;
+            }
+
+            // The parts are being assembled by a background job.
+            setTimeout(function() {
+                self.sandbox.client.call(
+                    'POST',
+                    'cloudstorage_multipart_status',
+                    {'uploadId': self._uploadId},
+                    function (data) {
+                        self._onWaitForCommit(data.result);
+                    },
+                    function (err) {
+                        console.log(err);
+                        self._onHandleError(self.i18n('unable_to_finish'));
+                    }
+                );
+            }, this.options.statusPollInterval);
+        },
+
+        _onUploadCommitted: function() {
+            var self = this;
+
+            this._progress.hide('fast');
+            this._onDisableSave(false);
+
+            if (this._resourceId && this._packageId){
+                this.sandbox.notify(
+                    'Success',
+                    this.i18n('upload_completed'),
+                    'success'
+                );
+                // self._form.remove();
+                if (this._clickedBtn == 'again') {
+                    this._redirect_url = this.sandbox.url(
+                        '/dataset/new_resource/' +
+                        this._packageId
+                    );
+                } else {
+                    this._redirect_url = this.sandbox.url(
+                        '/dataset/' +
+                        this._packageId
+                    );
+                }
+                this._form.attr('action', this._redirect_url);
+                this._form.attr('method', 'GET');
+                this.$('[name]').attr('name', null);
+                setTimeout(function(){
+                    self._form.submit();
+                }, 3000);
+
+            }
+        },
+
         _onDisableSave: function (value) {
             this._save.attr('disabled', value);
         },
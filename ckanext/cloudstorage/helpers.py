@@ -9,3 +9,10 @@ def use_secure_urls():
         # Currently implemented just AWS version
         'S3' in ResourceCloudStorage.driver_name.fget(None)
     ])
+
+
+def use_direct_uploads():
+    return all([
+        use_secure_urls(),
+        ResourceCloudStorage.use_direct_uploads.fget(None)
+    ])
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Work done once an upload is complete, which can run as a CKAN background
+job instead of inside the request.
+"""
+import logging
+
+from pylons import config
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.cloudstorage.storage import ResourceCloudStorage
+from ckanext.cloudstorage.model import MultipartUpload, MultipartPart
+
+log = logging.getLogger(__name__)
+
+
+def enqueue(fn, args, title=None):
+    """
+    Run `fn(*args)` as a background job, or right away if
+    `ckanext.cloudstorage.job_runner` is `inline` (ex: for tests) or CKAN
+    has no background jobs.
+
+    :param fn: A module-level function, importable by the worker.
+    :param args: The list of arguments of the job.
+    :param title: The title of the job.
+    """
+    runner = config.get('ckanext.cloudstorage.job_runner', 'rq')
+    if runner == 'inline' or not hasattr(toolkit, 'enqueue_job'):
+        fn(*args)
+        return None
+    return toolkit.enqueue_job(fn, args, title=title)
+
+
+def activate_draft_package(context, resource_id):
+    """
+    Make the draft dataset of a resource active, as its form's "Finish"
+    button would.
+    """
+    try:
+        res_dict = toolkit.get_action('resource_show')(
+            context.copy(), {'id': resource_id})
+        pkg_dict = toolkit.get_action('package_show')(
+            context.copy(), {'id': res_dict['package_id']})
+        if pkg_dict['state'] == 'draft':
+            toolkit.get_action('package_patch')(
+                dict(context.copy(), allow_state_change=True),
+                dict(id=pkg_dict['id'], state='active')
+            )
+    except Exception as e:
+        log.error(e)
+
+
+def commit_multipart(upload_id):
+    """
+    Assemble the recorded parts of a multipart upload into the final
+    object, and remove the upload's records.
+
+    :param upload_id: The multipart upload ID.
+    """
+    upload = model.Session.query(MultipartUpload).get(upload_id)
+    chunks = [
+        (part.n, part.etag)
+        for part in model.Session.query(MultipartPart).filter(
+            MultipartPart.upload_id == upload_id,
+            # Parts signed for a direct upload that never completed.
+            MultipartPart.etag != None
+        ).order_by(MultipartPart.n)
+    ]
+    uploader = ResourceCloudStorage({})
+    try:
+        with uploader.checking_container('delete_object'):
+            obj = uploader.container.get_object(upload.name)
+            obj.delete()
+    except Exception:
+        pass
+    etag = uploader.commit_multipart_upload(upload.name, upload_id, chunks)
+    uploader.record_upload(upload.name, int(upload.size), etag)
+    uploader.release_resource_blob(upload.resource_id)
+    upload.delete()
+    upload.commit()
+
+
+def finish_multipart(upload_id, user=None, activate_resource_id=None):
+    """
+    The background job of `cloudstorage_finish_multipart`. Its progress and
+    failures are recorded on the upload, for
+    `cloudstorage_multipart_status`.
+
+    :param upload_id: The multipart upload ID.
+    :param user: The name of the user who finished the upload.
+    :param activate_resource_id: The resource whose draft dataset should
+                                 then be made active, if any.
+    """
+    upload = model.Session.query(MultipartUpload).get(upload_id)
+    if upload is None:
+        return
+    upload.status = u'committing'
+    upload.commit()
+
+    try:
+        commit_multipart(upload_id)
+    except Exception as e:
+        log.exception('Unable to finish multipart upload %s', upload_id)
+        model.Session.rollback()
+        upload = model.Session.query(MultipartUpload).get(upload_id)
+        if upload is not None:
+            upload.status = u'failed'
+            upload.error = unicode(e)
+            upload.commit()
+        return
+
+    if activate_resource_id:
+        activate_draft_package(
+            {'model': model, 'session': model.Session, 'user': user},
+            activate_resource_id
+        )
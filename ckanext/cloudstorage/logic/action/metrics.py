@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.cloudstorage import metrics as cloudstorage_metrics
+
+
+def metrics(context, data_dict):
+    """Return the counters and latency histograms of the calls this process
+    made to the storage provider. Available only for sysadmins.
+
+    :param context:
+    :param data_dict: dict with optional `reset` - forget the recorded
+        calls once they are returned
+    :returns: dict with `enabled`, `calls` and `bytes`, see
+        `ckanext.cloudstorage.metrics.Metrics.snapshot`
+    :rtype: dict
+
+    """
+
+    toolkit.check_access('cloudstorage_metrics', context, data_dict)
+    registry = cloudstorage_metrics.registry
+    result = registry.snapshot()
+    result['enabled'] = registry.enabled
+    if toolkit.asbool(data_dict.get('reset', False)):
+        registry.reset()
+    return result
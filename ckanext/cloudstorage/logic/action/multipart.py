@@ -2,33 +2,52 @@
 # -*- coding: utf-8 -*-
 import logging
 import datetime
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 
 from pylons import config
 from sqlalchemy.orm.exc import NoResultFound
+from libcloud.common.types import LibcloudError
+from libcloud.storage.types import ObjectDoesNotExistError
 import ckan.model as model
 import ckan.lib.helpers as h
 import ckan.plugins.toolkit as toolkit
 
-from ckanext.cloudstorage.storage import ResourceCloudStorage
-from ckanext.cloudstorage.model import MultipartUpload, MultipartPart
+from ckanext.cloudstorage import jobs
+from ckanext.cloudstorage.storage import (
+    ResourceCloudStorage,
+    get_stream_size
+)
+from ckanext.cloudstorage.model import (
+    MultipartUpload,
+    MultipartPart,
+    upsert_parts,
+    discard_parts
+)
 
 log = logging.getLogger(__name__)
 
+# The number of uploads looked up, or removed, with a single query by
+# `clean_multipart`.
+GC_BATCH_SIZE = 1000
+
 
 def _get_max_multipart_lifetime():
     value = float(config.get('ckanext.cloudstorage.max_multipart_lifetime', 7))
     return datetime.timedelta(value)
 
 
+def _finish_in_background():
+    return toolkit.asbool(
+        config.get('ckanext.cloudstorage.finish_in_background', False))
+
+
 def _get_object_url(uploader, name):
-    return '/' + uploader.container_name + '/' + name
+    return uploader.object_path(name)
 
 
 def _delete_multipart(upload, uploader):
-    resp = uploader.driver.connection.request(
-        _get_object_url(uploader, upload.name) + '?uploadId=' + upload.id,
-        method='DELETE'
-    )
+    resp = uploader.abort_multipart_upload(upload.name, upload.id)
     if not resp.success():
         raise toolkit.ValidationError(resp.error)
 
@@ -37,25 +56,105 @@ def _delete_multipart(upload, uploader):
     return resp
 
 
-def _save_part_info(n, etag, upload):
-    try:
-        part = model.Session.query(MultipartPart).filter(
-            MultipartPart.n == n,
-            MultipartPart.upload == upload).one()
-    except NoResultFound:
-        part = MultipartPart(n, etag, upload)
+def _save_part_info(n, etag, upload, start=None, size=None):
+    upsert_parts(upload.id, [(int(n), etag, start, size)])
+    model.Session.commit()
+
+
+def _part_range(part):
+    # The range of a part sent by the client, if it sent one.
+    if part.get('start') is None or part.get('size') is None:
+        return None, None
+    return int(part['start']), int(part['size'])
+
+
+def _get_completed_parts(uploader, upload):
+    """Return the parts of an upload that can be kept when it is resumed,
+    as dicts with `partNumber`, `start`, `size` and `ETag`, ordered by part
+    number.
+
+    On S3, only the parts the provider received are complete, with the
+    size and ETag it reports. Parts whose range is unknown, or overlaps the
+    range of a previous part, have to be sent again.
+    """
+    recorded = model.Session.query(MultipartPart).filter(
+        MultipartPart.upload_id == upload.id,
+        MultipartPart.start != None
+    ).order_by(MultipartPart.n).all()
+
+    if 'S3' in uploader.driver_name:
+        try:
+            received = dict(
+                (n, (size, etag)) for n, size, etag in
+                uploader.iterate_multipart_parts(upload.name, upload.id)
+            )
+        except LibcloudError as e:
+            log.warning(
+                'Unable to list the parts of %s: %s', upload.name, e)
+            received = {}
     else:
-        part.etag = etag
-    part.save()
-    return part
+        received = dict(
+            (part.n, (part.size, part.etag))
+            for part in recorded if part.etag
+        )
+
+    parts = []
+    end = 0
+    for part in recorded:
+        if part.n not in received:
+            continue
+        size, etag = received[part.n]
+        if part.size is not None and part.size != size:
+            continue
+        if part.start < end or part.start + size > upload.size:
+            continue
+        parts.append({
+            'partNumber': part.n,
+            'start': part.start,
+            'size': size,
+            'ETag': etag
+        })
+        end = part.start + size
+    return parts
+
+
+def _get_direct_uploader():
+    uploader = ResourceCloudStorage({})
+    if not (uploader.use_direct_uploads and uploader.can_sign_urls):
+        raise toolkit.ValidationError('Direct uploads are not enabled')
+    return uploader
+
+
+def _record_direct_upload(uploader, resource_id):
+    # The file didn't go through CKAN, so we have to ask the provider what
+    # was uploaded, for the inventory.
+    resource = model.Resource.get(resource_id)
+    if resource is None or resource.url_type != 'upload':
+        return
+    name = uploader.path_from_filename(resource_id, resource.url)
+    if not uploader.use_inventory:
+        # Only forget that the object may have been missing.
+        uploader.record_upload(name)
+        return
+    try:
+        with uploader.checking_container('get_object'):
+            obj = uploader.container.get_object(name)
+    except ObjectDoesNotExistError:
+        return
+    uploader.record_upload(name, obj.size, obj.hash)
 
 
 def check_multipart(context, data_dict):
     """Check whether unfinished multipart upload already exists.
 
+    The parts that don't have to be sent again are reconciled with the
+    ones the provider received.
+
     :param context:
     :param data_dict: dict with required `id`
-    :returns: None or dict with `upload` - existing multipart upload info
+    :returns: None or dict with `upload` - existing multipart upload info,
+        whose `parts` is the list of completed parts, dicts with
+        `partNumber`, `start`, `size` and `ETag`
     :rtype: NoneType or dict
 
     """
@@ -68,8 +167,8 @@ def check_multipart(context, data_dict):
     except NoResultFound:
         return
     upload_dict = upload.as_dict()
-    upload_dict['parts'] = model.Session.query(MultipartPart).filter(
-        MultipartPart.upload == upload).count()
+    upload_dict['parts'] = _get_completed_parts(
+        ResourceCloudStorage({}), upload)
     return {'upload': upload_dict}
 
 
@@ -110,70 +209,212 @@ def initiate_multipart(context, data_dict):
         _rindex = res_name.rfind('/')
         if ~_rindex:
             try:
-                name_prefix = res_name[:_rindex]
-                for cloud_object in uploader.container.iterate_objects():
-                    if cloud_object.name.startswith(name_prefix):
-                        log.info('Removing cloud object: %s' % cloud_object)
-                        cloud_object.delete()
+                name_prefix = res_name[:_rindex + 1]
+                cloud_objects = uploader.iterate_objects(name_prefix)
+                for name, error in uploader.delete_objects(
+                        cloud_object.name for cloud_object in cloud_objects):
+                    if error:
+                        log.warning(
+                            'Unable to remove cloud object %s: %s' % (
+                                name, error))
+                    else:
+                        log.info('Removed cloud object: %s' % name)
             except Exception as e:
                 log.exception('[delete from cloud] %s' % e)
 
-        resp = uploader.driver.connection.request(
-            _get_object_url(uploader, res_name) + '?uploads',
-            method='POST'
-        )
-        if not resp.success():
-            raise toolkit.ValidationError(resp.error)
         try:
-            upload_id = resp.object.find(
-                '{%s}UploadId' % resp.object.nsmap[None]).text
-        except AttributeError:
-            upload_id_list = filter(
-                lambda e: e.tag.endswith('UploadId'),
-                resp.object.getchildren()
-            )
-            upload_id = upload_id_list[0].text
+            upload_id = uploader.initiate_multipart_upload(res_name)
+        except LibcloudError as e:
+            raise toolkit.ValidationError(e.value)
         upload_object = MultipartUpload(upload_id, id, res_name, size, name, user_id)
 
         upload_object.save()
-    return upload_object.as_dict()
+
+    result = upload_object.as_dict()
+    # Parts can be sent straight to the provider, see `sign_multipart`.
+    result['direct'] = uploader.use_direct_uploads
+    return result
 
 
 def upload_multipart(context, data_dict):
+    """Upload a part of a multipart upload through CKAN.
+
+    :param context:
+    :param data_dict: dict with required keys:
+        uploadId: id of Multipart Upload
+        partNumber: number of the part
+        upload: the content of the part
+        and optional `start` - the offset of the part in the file, for
+        `cloudstorage_check_multipart` to resume the upload
+    :returns: dict with `partNumber` and `ETag`
+    :rtype: dict
+
+    """
     h.check_access('cloudstorage_upload_multipart', data_dict)
     upload_id, part_number, part_content = toolkit.get_or_bust(
         data_dict, ['uploadId', 'partNumber', 'upload'])
+    start = data_dict.get('start')
 
     uploader = ResourceCloudStorage({})
     upload = model.Session.query(MultipartUpload).get(upload_id)
 
-    resp = uploader.driver.connection.request(
+    # Stream the part from the request's (spooled) file instead of loading
+    # it in memory.
+    stream = part_content.file
+    stream.seek(0)
+    size = get_stream_size(stream)
+    resp = uploader.stream_request(
         _get_object_url(
             uploader, upload.name) + '?partNumber={0}&uploadId={1}'.format(
                 part_number, upload_id),
-        method='PUT',
-        data=bytearray(part_content.file.read())
+        stream,
+        size,
+        operation='upload_part'
     )
     if resp.status != 200:
         raise toolkit.ValidationError('Upload failed: part %s' % part_number)
 
-    _save_part_info(part_number, resp.headers['etag'], upload)
+    _save_part_info(
+        part_number,
+        resp.headers['etag'],
+        upload,
+        None if start is None else int(start),
+        None if start is None else size
+    )
     return {
         'partNumber': part_number,
         'ETag': resp.headers['etag']
     }
 
 
+def sign_multipart(context, data_dict):
+    """Presign part uploads, so that parts can be sent directly to the
+    provider instead of through `cloudstorage_upload_multipart`.
+
+    The `ETag` header returned by the provider for each part must be sent
+    back to `cloudstorage_finish_multipart`.
+
+    :param context:
+    :param data_dict: dict with required keys:
+        uploadId: id of Multipart Upload
+        partNumbers: list of part numbers to sign, or
+        parts: list of dicts with `partNumber`, `start` and `size` - the
+        range of the file each part holds, recorded so that
+        `cloudstorage_check_multipart` can resume the upload
+    :returns: dict with `urls` - part number to presigned `PUT` URL
+    :rtype: dict
+
+    """
+
+    toolkit.check_access('cloudstorage_sign_multipart', context, data_dict)
+    upload_id = toolkit.get_or_bust(data_dict, 'uploadId')
+    if data_dict.get('parts'):
+        parts = data_dict['parts']
+    else:
+        part_numbers = toolkit.get_or_bust(data_dict, 'partNumbers')
+        if isinstance(part_numbers, basestring):
+            part_numbers = part_numbers.split(',')
+        parts = [{'partNumber': n} for n in part_numbers]
+
+    uploader = _get_direct_uploader()
+    upload = model.Session.query(MultipartUpload).get(upload_id)
+    if upload is None:
+        raise toolkit.ObjectNotFound('Multipart upload not found')
+
+    # The ETags are only known once the parts are uploaded.
+    ranges = [
+        (int(part['partNumber']), None) + _part_range(part)
+        for part in parts
+        if _part_range(part)[0] is not None
+    ]
+    if ranges:
+        upsert_parts(upload_id, ranges)
+        model.Session.commit()
+
+    urls = {}
+    for part in parts:
+        part_number = str(int(part['partNumber']))
+        urls[part_number] = uploader.get_signed_url(
+            upload.name,
+            method='PUT',
+            params={'partNumber': part_number, 'uploadId': upload_id}
+        )
+    return {'urls': urls}
+
+
+def presign_upload(context, data_dict):
+    """Presign the upload of a whole file, for files small enough to be
+    sent directly to the provider in a single request.
+
+    Call `cloudstorage_finish_upload` once the file has been uploaded.
+
+    :param context:
+    :param data_dict: dict with required keys:
+        id: resource's id
+        name: filename
+    :returns: dict with `url`, `method` and `headers` of the request to
+        send the file with
+    :rtype: dict
+
+    """
+
+    toolkit.check_access('cloudstorage_presign_upload', context, data_dict)
+    id, name = toolkit.get_or_bust(data_dict, ['id', 'name'])
+
+    uploader = _get_direct_uploader()
+    headers = {}
+    if uploader.driver_name == 'AZURE_BLOBS':
+        headers['x-ms-blob-type'] = 'BlockBlob'
+
+    return {
+        'url': uploader.get_signed_url(
+            uploader.path_from_filename(id, name),
+            method='PUT'
+        ),
+        'method': 'PUT',
+        'headers': headers
+    }
+
+
+def finish_upload(context, data_dict):
+    """Called after a file has been uploaded with the URL returned by
+    `cloudstorage_presign_upload`.
+
+    :param context:
+    :param data_dict: dict with required key `id` - resource's id
+    :returns: None
+    :rtype: NoneType
+
+    """
+
+    toolkit.check_access('cloudstorage_finish_upload', context, data_dict)
+    id = toolkit.get_or_bust(data_dict, 'id')
+    uploader = ResourceCloudStorage({})
+    _record_direct_upload(uploader, id)
+    # The file was stored under the resource, not as a deduplicated blob.
+    uploader.release_resource_blob(id)
+    model.Session.commit()
+    if data_dict.get('save_action') == 'go-metadata':
+        jobs.activate_draft_package(context, id)
+    return {'commited': True}
+
+
 def finish_multipart(context, data_dict):
     """Called after all parts had been uploaded.
 
     Triggers call to `_commit_multipart` which will convert separate uploaded
-    parts into single file
+    parts into single file. With `ckanext.cloudstorage.finish_in_background`,
+    this is done by a background job whose progress is reported by
+    `cloudstorage_multipart_status`.
 
     :param context:
     :param data_dict: dict with required key `uploadId` - id of Multipart Upload that should be finished
-    :returns: None
-    :rtype: NoneType
+        and optional `parts` - list of dicts with `partNumber` and `ETag`
+        of all the parts of the file, including those uploaded directly to
+        the provider. Other recorded parts are discarded.
+    :returns: dict with `commited` - whether the file is complete, and
+        `status` - see `cloudstorage_multipart_status`
+    :rtype: dict
 
     """
 
@@ -181,38 +422,58 @@ def finish_multipart(context, data_dict):
     upload_id = toolkit.get_or_bust(data_dict, 'uploadId')
     save_action = data_dict.get('save_action', False)
     upload = model.Session.query(MultipartUpload).get(upload_id)
-    chunks = [
-        (part.n, part.etag)
-        for part in model.Session.query(MultipartPart).filter_by(
-            upload_id=upload_id).order_by(MultipartPart.n)
-    ]
-    uploader = ResourceCloudStorage({})
-    try:
-        obj = uploader.container.get_object(upload.name)
-        obj.delete()
-    except Exception:
-        pass
-    uploader.driver._commit_multipart(
-        _get_object_url(uploader, upload.name),
-        upload_id,
-        chunks)
-    upload.delete()
+    if upload is None:
+        raise toolkit.ObjectNotFound('Multipart upload not found')
+    parts = data_dict.get('parts')
+    if parts:
+        upsert_parts(upload_id, [
+            (int(part['partNumber']), part['ETag']) + _part_range(part)
+            for part in parts
+        ])
+        discard_parts(upload_id, [int(part['partNumber']) for part in parts])
+
+    activate_resource_id = None
+    if save_action and save_action == "go-metadata":
+        activate_resource_id = data_dict.get('id')
+
+    if not _finish_in_background():
+        jobs.commit_multipart(upload_id)
+        if activate_resource_id:
+            jobs.activate_draft_package(context, activate_resource_id)
+        return {'commited': True, 'status': 'committed'}
+
+    upload.status = u'queued'
+    upload.error = None
     upload.commit()
+    jobs.enqueue(
+        jobs.finish_multipart,
+        [upload_id, context.get('user'), activate_resource_id],
+        title=u'Finish upload of {0}'.format(upload.name)
+    )
+    status = multipart_status(context, {'uploadId': upload_id})
+    status['commited'] = status['status'] == 'committed'
+    return status
 
-    if save_action and save_action == "go-metadata":
-        try:
-            res_dict = toolkit.get_action('resource_show')(
-                context.copy(), {'id': data_dict.get('id')})
-            pkg_dict = toolkit.get_action('package_show')(
-                context.copy(), {'id': res_dict['package_id']})
-            if pkg_dict['state'] == 'draft':
-                toolkit.get_action('package_patch')(
-                    dict(context.copy(), allow_state_change=True),
-                    dict(id=pkg_dict['id'], state='active')
-                )
-        except Exception as e:
-            log.error(e)
-    return {'commited': True}
+
+def multipart_status(context, data_dict):
+    """Report the progress of a multipart upload, to poll after
+    `cloudstorage_finish_multipart` when it runs in the background.
+
+    :param context:
+    :param data_dict: dict with required key `uploadId` - id of Multipart Upload
+    :returns: dict with `status` - `uploading`, `queued`, `committing`,
+        `failed` or `committed` (once the upload's record is removed), and
+        `error` - the reason of a failure
+    :rtype: dict
+
+    """
+
+    toolkit.check_access('cloudstorage_multipart_status', context, data_dict)
+    upload_id = toolkit.get_or_bust(data_dict, 'uploadId')
+    upload = model.Session.query(MultipartUpload).get(upload_id)
+    if upload is None:
+        return {'status': 'committed', 'error': None}
+    return {'status': upload.status or 'uploading', 'error': upload.error}
 
 
 def abort_multipart(context, data_dict):
@@ -233,41 +494,141 @@ def abort_multipart(context, data_dict):
     return aborted
 
 
+def _abort_expired_upload(job):
+    # Runs in a worker thread, whose uploader gets its own driver. Never
+    # raises, as exceptions would be lost by the pool.
+    name, upload_id, dry_run = job
+    uploader = ResourceCloudStorage({})
+    try:
+        size = sum(
+            part_size for _, part_size, _ in
+            uploader.iterate_multipart_parts(name, upload_id)
+        )
+        if not dry_run:
+            resp = uploader.abort_multipart_upload(name, upload_id)
+            if not resp.success():
+                return upload_id, 0, u'{0}: {1}'.format(name, resp.error)
+    except Exception as e:
+        return upload_id, 0, u'{0}: {1}'.format(name, e)
+    return upload_id, size, None
+
+
+def _find_expired_uploads(uploader, oldest_allowed, result):
+    """Return the `(name, upload id)` of the expired uploads in progress on
+    the provider, and the IDs of expired records of uploads that are not.
+
+    Recorded uploads expire from the time CKAN initiated them, others from
+    the time the provider did.
+    """
+    expired = []
+    seen = set()
+    uploads = uploader.iterate_multipart_uploads()
+    while True:
+        batch = list(islice(uploads, GC_BATCH_SIZE))
+        if not batch:
+            break
+        recorded = dict(model.Session.query(
+            MultipartUpload.id, MultipartUpload.initiated).filter(
+                MultipartUpload.id.in_(
+                    [upload_id for _, upload_id, _ in batch])))
+        for name, upload_id, initiated in batch:
+            seen.add(upload_id)
+            if recorded.get(upload_id, initiated) < oldest_allowed:
+                expired.append((name, upload_id))
+                if upload_id not in recorded:
+                    result['orphaned'] += 1
+
+    stale = [
+        upload_id for upload_id, in model.Session.query(
+            MultipartUpload.id).filter(
+                MultipartUpload.initiated < oldest_allowed)
+        if upload_id not in seen
+    ]
+    return expired, stale
+
+
 def clean_multipart(context, data_dict):
-    """Clean old multipart uploads.
+    """Abort expired multipart uploads.
+
+    On S3, the uploads in progress are listed and reconciled with the ones
+    recorded by CKAN, so that uploads whose record was lost are aborted too,
+    and records of uploads that no longer exist are removed. Uploads are
+    aborted `ckanext.cloudstorage.delete_workers` at a time.
 
     :param context:
-    :param data_dict:
+    :param data_dict: dict with optional keys:
+        older_than - lifetime of uploads, in days. Defaults to
+        `ckanext.cloudstorage.max_multipart_lifetime`.
+        dry_run - only report what would be removed.
     :returns: dict with:
         removed - amount of removed uploads.
         total - total amount of expired uploads.
+        orphaned - amount of expired uploads that CKAN has no record of.
+        stale - amount of expired records of uploads that no longer exist.
+        reclaimed - size of the parts of the removed uploads, in bytes.
         errors - list of errors raised during deletion. Appears when
         `total` and `removed` are different.
     :rtype: dict
 
     """
 
-    h.check_access('cloudstorage_clean_multipart', data_dict)
+    toolkit.check_access('cloudstorage_clean_multipart', context, data_dict)
     uploader = ResourceCloudStorage({})
-    delta = _get_max_multipart_lifetime()
+    if data_dict.get('older_than') is not None:
+        delta = datetime.timedelta(float(data_dict['older_than']))
+    else:
+        delta = _get_max_multipart_lifetime()
     oldest_allowed = datetime.datetime.utcnow() - delta
-
-    uploads_to_remove = model.Session.query(MultipartUpload).filter(
-        MultipartUpload.initiated < oldest_allowed
-    )
+    dry_run = toolkit.asbool(data_dict.get('dry_run', False))
 
     result = {
         'removed': 0,
-        'total': uploads_to_remove.count(),
+        'total': 0,
+        'orphaned': 0,
+        'stale': 0,
+        'reclaimed': 0,
         'errors': []
     }
 
-    for upload in uploads_to_remove:
+    if 'S3' in uploader.driver_name:
+        expired, stale = _find_expired_uploads(
+            uploader, oldest_allowed, result)
+    else:
+        # Only S3 uploads are ever initiated, there is nothing to abort.
+        expired = []
+        stale = [
+            upload_id for upload_id, in model.Session.query(
+                MultipartUpload.id).filter(
+                    MultipartUpload.initiated < oldest_allowed)
+        ]
+
+    result['total'] = len(expired)
+    result['stale'] = len(stale)
+
+    aborted = []
+    if expired:
+        pool = ThreadPool(uploader.delete_workers)
         try:
-            _delete_multipart(upload, uploader)
-        except toolkit.ValidationError as e:
-            result['errors'].append(e.error_summary)
-        else:
-            result['removed'] += 1
+            for upload_id, size, error in pool.imap_unordered(
+                    _abort_expired_upload,
+                    [(name, upload_id, dry_run)
+                     for name, upload_id in expired]):
+                if error is None:
+                    aborted.append(upload_id)
+                    result['removed'] += 1
+                    result['reclaimed'] += size
+                else:
+                    result['errors'].append(error)
+        finally:
+            pool.terminate()
+
+    if not dry_run:
+        # Parts are removed by the database.
+        ids = aborted + stale
+        for i in range(0, len(ids), GC_BATCH_SIZE):
+            model.Session.execute(
+                MultipartUpload.__table__.delete().where(
+                    MultipartUpload.id.in_(ids[i:i + GC_BATCH_SIZE])))
+        model.Session.commit()
 
     return result
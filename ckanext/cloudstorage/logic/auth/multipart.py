@@ -25,3 +25,19 @@ def check_multipart(context, data_dict):
 
 def clean_multipart(context, data_dict):
     return {'success': False}
+
+
+def sign_multipart(context, data_dict):
+    return {'success': check_access('resource_create', context, data_dict)}
+
+
+def presign_upload(context, data_dict):
+    return {'success': check_access('resource_create', context, data_dict)}
+
+
+def finish_upload(context, data_dict):
+    return {'success': check_access('resource_create', context, data_dict)}
+
+
+def multipart_status(context, data_dict):
+    return {'success': check_access('resource_create', context, data_dict)}
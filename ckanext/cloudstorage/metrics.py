@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Counters and latency histograms of the calls made to the storage provider,
+labelled by operation, provider and outcome.
+
+Metrics are kept in memory by each process, and reset when it restarts.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+import ckan.plugins as p
+from libcloud.storage.types import (
+    ObjectDoesNotExistError,
+    ContainerDoesNotExistError
+)
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0
+)
+
+PROMETHEUS_PREFIX = 'ckanext_cloudstorage'
+
+
+def status_outcome(status):
+    """
+    Return the outcome of a call from the HTTP status of its response.
+    """
+    if status == 404:
+        return 'not_found'
+    if status >= 400:
+        return 'error'
+    return 'success'
+
+
+def _exception_outcome(error):
+    if isinstance(error, (ObjectDoesNotExistError,
+                          ContainerDoesNotExistError)):
+        return 'not_found'
+    return 'error'
+
+
+class Metrics(object):
+    """
+    A thread-safe registry of call counts, latency histograms and
+    transferred bytes.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        :param buckets: The upper bounds of the latency buckets, in seconds.
+        """
+        self.buckets = tuple(buckets)
+        self.enabled = True
+        # (operation, provider, outcome) -> [count, total seconds,
+        # per-bucket counts, the last one for slower calls].
+        self._calls = {}
+        # (operation, provider) -> bytes sent or received.
+        self._bytes = {}
+        self._lock = threading.Lock()
+
+    def observe(self, operation, provider, seconds, outcome='success',
+                size=None):
+        """
+        Record a call.
+
+        :param operation: The name of the operation (ex: `upload_part`).
+        :param provider: The libcloud driver name.
+        :param seconds: How long the call took.
+        :param outcome: `success`, `not_found` or `error`.
+        :param size: The number of bytes transferred, if any.
+        """
+        if not self.enabled:
+            return
+        index = bisect.bisect_left(self.buckets, seconds)
+        key = (operation, provider, outcome)
+        with self._lock:
+            entry = self._calls.get(key)
+            if entry is None:
+                entry = self._calls[key] = [
+                    0, 0.0, [0] * (len(self.buckets) + 1)
+                ]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2][index] += 1
+            if size:
+                key = (operation, provider)
+                self._bytes[key] = self._bytes.get(key, 0) + size
+
+    @contextmanager
+    def timed(self, operation, provider, size=None):
+        """
+        Context manager recording the call made in its block. The outcome
+        is `error` (or `not_found`) if the block raises. It yields a dict
+        whose `outcome` and `size` can be changed by the block, ex: from
+        the status of a response.
+
+        Nothing is recorded if `operation` is `None`.
+        """
+        call = {'outcome': 'success', 'size': size}
+        if operation is None or not self.enabled:
+            yield call
+            return
+
+        started = time.time()
+        try:
+            yield call
+        except Exception as e:
+            call['outcome'] = _exception_outcome(e)
+            raise
+        finally:
+            self.observe(
+                operation,
+                provider,
+                time.time() - started,
+                call['outcome'],
+                call['size']
+            )
+
+    def timed_iter(self, iterable, operation, provider):
+        """
+        Iterate over `iterable`, recording the time spent waiting for its
+        items, but not the time spent by the caller on them, as a single
+        call once it is exhausted or closed.
+        """
+        iterator = iter(iterable)
+        seconds = 0.0
+        outcome = 'success'
+        try:
+            while True:
+                started = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    seconds += time.time() - started
+                    return
+                except Exception as e:
+                    seconds += time.time() - started
+                    outcome = _exception_outcome(e)
+                    raise
+                seconds += time.time() - started
+                yield item
+        finally:
+            self.observe(operation, provider, seconds, outcome)
+
+    def snapshot(self):
+        """
+        Return the current values, with the estimated median and 99th
+        percentile latency of each operation.
+
+        :returns: A dict with `calls` - a list of dicts with `operation`,
+                  `provider`, `outcome`, `count`, `seconds`, `p50`, `p99`
+                  and `buckets` (upper bound to cumulative count), and
+                  `bytes` - a list of dicts with `operation`, `provider`
+                  and `bytes`.
+        """
+        with self._lock:
+            calls = [
+                (key, count, seconds, list(counts))
+                for key, (count, seconds, counts) in self._calls.items()
+            ]
+            transferred = self._bytes.items()
+
+        result = {'calls': [], 'bytes': []}
+        for (operation, provider, outcome), count, seconds, counts in sorted(
+                calls):
+            cumulative = self._cumulative(counts)
+            result['calls'].append({
+                'operation': operation,
+                'provider': provider,
+                'outcome': outcome,
+                'count': count,
+                'seconds': seconds,
+                'p50': self._quantile(cumulative, 0.5),
+                'p99': self._quantile(cumulative, 0.99),
+                'buckets': [
+                    [bound, total] for bound, total in zip(
+                        self.buckets + ('+Inf',), cumulative)
+                ]
+            })
+        for (operation, provider), size in sorted(transferred):
+            result['bytes'].append({
+                'operation': operation,
+                'provider': provider,
+                'bytes': size
+            })
+        return result
+
+    def render_prometheus(self):
+        """
+        Return the current values in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = [
+            '# HELP {0}_call_seconds Latency of the calls to the storage '
+            'provider.'.format(PROMETHEUS_PREFIX),
+            '# TYPE {0}_call_seconds histogram'.format(PROMETHEUS_PREFIX)
+        ]
+        for call in snapshot['calls']:
+            labels = _labels(call, ('operation', 'provider', 'outcome'))
+            for bound, total in call['buckets']:
+                lines.append(
+                    '{0}_call_seconds_bucket{{{1},le="{2}"}} {3}'.format(
+                        PROMETHEUS_PREFIX, labels, bound, total))
+            lines.append('{0}_call_seconds_sum{{{1}}} {2!r}'.format(
+                PROMETHEUS_PREFIX, labels, call['seconds']))
+            lines.append('{0}_call_seconds_count{{{1}}} {2}'.format(
+                PROMETHEUS_PREFIX, labels, call['count']))
+
+        lines.extend([
+            '# HELP {0}_bytes_total Bytes sent to or received from the '
+            'storage provider.'.format(PROMETHEUS_PREFIX),
+            '# TYPE {0}_bytes_total counter'.format(PROMETHEUS_PREFIX)
+        ])
+        for transferred in snapshot['bytes']:
+            lines.append('{0}_bytes_total{{{1}}} {2}'.format(
+                PROMETHEUS_PREFIX,
+                _labels(transferred, ('operation', 'provider')),
+                transferred['bytes']
+            ))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """
+        Forget every recorded call.
+        """
+        with self._lock:
+            self._calls.clear()
+            self._bytes.clear()
+
+    @staticmethod
+    def _cumulative(counts):
+        result = []
+        total = 0
+        for count in counts:
+            total += count
+            result.append(total)
+        return result
+
+    def _quantile(self, cumulative, q):
+        # The upper bound of the bucket the quantile falls in, `None` if it
+        # is above the last one.
+        rank = q * cumulative[-1]
+        for bound, total in zip(self.buckets, cumulative):
+            if total >= rank:
+                return bound
+        return None
+
+
+def _labels(values, names):
+    return ','.join(
+        '{0}="{1}"'.format(
+            name,
+            unicode(values[name]).replace('\\', '\\\\').replace('"', '\\"')
+        ) for name in names
+    )
+
+
+# The metrics of this process.
+registry = Metrics()
+
+
+def configure(config):
+    """
+    Enable or disable the recording of metrics, with
+    `ckanext.cloudstorage.metrics`. Called from
+    `CloudStoragePlugin.configure`.
+
+    :param config: The CKAN configuration.
+    """
+    registry.enabled = p.toolkit.asbool(
+        config.get('ckanext.cloudstorage.metrics', True))
+
+
+observe = registry.observe
+timed = registry.timed
+timed_iter = registry.timed_iter
@@ -9,7 +9,13 @@ from sqlalchemy import (
     DateTime,
     ForeignKey,
     Integer,
-    Numeric
+    BigInteger,
+    Boolean,
+    Numeric,
+    text,
+    and_,
+    func,
+    select
 )
 from datetime import datetime
 import ckan.model.meta as meta
@@ -27,23 +33,131 @@ def create_tables():
     metadata.create_all(model.meta.engine)
 
 
+class SchemaVersion(Base):
+    __tablename__ = 'cloudstorage_schema_version'
+
+    version = Column(Integer, primary_key=True)
+
+
+# SQL statements upgrading the tables from the previous version, in order.
+# Version 0 is the layout from before the schema was versioned.
+MIGRATIONS = [
+    # 1: a single row per part, and indexes on the columns uploads are
+    # looked up by.
+    (
+        """DELETE FROM cloudstorage_multipart_part a
+           USING cloudstorage_multipart_part b
+           WHERE a.upload_id = b.upload_id AND a.n = b.n
+           AND a.ctid < b.ctid""",
+        """ALTER TABLE cloudstorage_multipart_part
+           DROP CONSTRAINT IF EXISTS cloudstorage_multipart_part_pkey""",
+        """ALTER TABLE cloudstorage_multipart_part
+           ADD PRIMARY KEY (upload_id, n)""",
+        """ALTER TABLE cloudstorage_multipart_part
+           DROP CONSTRAINT IF EXISTS
+           cloudstorage_multipart_part_upload_id_fkey""",
+        """ALTER TABLE cloudstorage_multipart_part
+           ADD CONSTRAINT cloudstorage_multipart_part_upload_id_fkey
+           FOREIGN KEY (upload_id)
+           REFERENCES cloudstorage_multipart_upload (id) ON DELETE CASCADE""",
+        """CREATE INDEX ix_cloudstorage_multipart_upload_resource_id
+           ON cloudstorage_multipart_upload (resource_id)""",
+        """CREATE INDEX ix_cloudstorage_multipart_upload_name
+           ON cloudstorage_multipart_upload (name)""",
+        """CREATE INDEX ix_cloudstorage_multipart_upload_initiated
+           ON cloudstorage_multipart_upload (initiated)""",
+    ),
+    # 2: the progress of uploads finished in the background.
+    (
+        """ALTER TABLE cloudstorage_multipart_upload
+           ADD COLUMN status text DEFAULT 'uploading'""",
+        """ALTER TABLE cloudstorage_multipart_upload
+           ADD COLUMN error text""",
+    ),
+    # 3: the range of the file each part holds, to resume uploads.
+    (
+        """ALTER TABLE cloudstorage_multipart_part
+           ADD COLUMN start bigint""",
+        """ALTER TABLE cloudstorage_multipart_part
+           ADD COLUMN size bigint""",
+    ),
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Parts, inventory rows and blob references are upserted with
+# `INSERT ... ON CONFLICT`, which needs PostgreSQL 9.5.
+MIN_POSTGRESQL_VERSION = (9, 5)
+
+
+def upgrade_tables():
+    """Create the missing tables and upgrade the existing ones to
+    `SCHEMA_VERSION`, keeping their content, in a single transaction.
+
+    :returns: the version the tables were at, `None` if there were none
+    :raises RuntimeError: if the database is older than PostgreSQL 9.5
+    """
+    with model.meta.engine.begin() as connection:
+        server_version = connection.dialect.server_version_info
+        if server_version is not None and \
+                server_version < MIN_POSTGRESQL_VERSION:
+            raise RuntimeError(
+                'ckanext-cloudstorage needs PostgreSQL {0} or later, the '
+                'database runs {1}'.format(
+                    '.'.join(str(n) for n in MIN_POSTGRESQL_VERSION),
+                    '.'.join(str(n) for n in server_version)
+                )
+            )
+        SchemaVersion.__table__.create(connection, checkfirst=True)
+        version = connection.execute(
+            select([func.max(SchemaVersion.version)])
+        ).scalar()
+        if version is None and connection.dialect.has_table(
+                connection, MultipartUpload.__tablename__):
+            version = 0
+
+        # Fresh tables are created with the latest layout.
+        start = SCHEMA_VERSION if version is None else version
+        for statements in MIGRATIONS[start:]:
+            for statement in statements:
+                connection.execute(text(statement))
+
+        metadata.create_all(connection)
+        connection.execute(SchemaVersion.__table__.delete())
+        connection.execute(
+            SchemaVersion.__table__.insert(),
+            version=SCHEMA_VERSION
+        )
+    return version
+
+
 class MultipartPart(Base, DomainObject):
     __tablename__ = 'cloudstorage_multipart_part'
 
-    def __init__(self, n, etag, upload):
+    def __init__(self, n, etag, upload, start=None, size=None):
         self.n = n
         self.etag = etag
         self.upload = upload
+        self.start = start
+        self.size = size
 
-    n = Column(Integer, primary_key=True)
-    etag = Column(UnicodeText, primary_key=True)
     upload_id = Column(
-        UnicodeText, ForeignKey('cloudstorage_multipart_upload.id'),
+        UnicodeText,
+        ForeignKey('cloudstorage_multipart_upload.id', ondelete='CASCADE'),
         primary_key=True
     )
+    n = Column(Integer, primary_key=True)
+    etag = Column(UnicodeText)
+    # The offset and size of the part in the file.
+    start = Column(BigInteger)
+    size = Column(BigInteger)
     upload = relationship(
         'MultipartUpload',
-        backref=backref('parts', cascade='delete, delete-orphan'),
+        backref=backref(
+            'parts',
+            cascade='delete, delete-orphan',
+            passive_deletes=True
+        ),
         single_parent=True)
 
 
@@ -66,9 +180,271 @@ class MultipartUpload(Base, DomainObject):
         return query
 
     id = Column(UnicodeText, primary_key=True)
-    resource_id = Column(UnicodeText)
-    name = Column(UnicodeText)
-    initiated = Column(DateTime, default=datetime.utcnow)
+    resource_id = Column(UnicodeText, index=True)
+    name = Column(UnicodeText, index=True)
+    initiated = Column(DateTime, default=datetime.utcnow, index=True)
     size = Column(Numeric)
     original_name = Column(UnicodeText)
     user_id = Column(UnicodeText)
+    # uploading, queued, committing or failed. Uploads are removed once
+    # committed.
+    status = Column(UnicodeText, default=u'uploading')
+    error = Column(UnicodeText)
+
+
+def upsert_parts(upload_id, parts):
+    """Record uploaded parts, replacing the ETag of parts sent again, in
+    the current transaction.
+
+    A part's range is only replaced when a new one is given, so that the
+    ETags of parts uploaded directly to the provider can be recorded
+    after their range.
+
+    :param upload_id: the multipart upload ID
+    :param parts: list of `(part number, etag)` or
+                  `(part number, etag, start, size)` tuples
+    """
+    rows = []
+    for part in parts:
+        n, etag = part[:2]
+        start, size = part[2:] or (None, None)
+        rows.append({
+            'upload_id': upload_id,
+            'n': n,
+            'etag': etag,
+            'start': start,
+            'size': size
+        })
+    if not rows:
+        return
+    meta.Session.execute(
+        text("""
+            INSERT INTO cloudstorage_multipart_part
+                (upload_id, n, etag, start, size)
+            VALUES (:upload_id, :n, :etag, :start, :size)
+            ON CONFLICT (upload_id, n) DO UPDATE SET
+                etag = EXCLUDED.etag,
+                start = COALESCE(
+                    EXCLUDED.start, cloudstorage_multipart_part.start),
+                size = COALESCE(
+                    EXCLUDED.size, cloudstorage_multipart_part.size)
+        """),
+        rows
+    )
+
+
+def discard_parts(upload_id, keep):
+    """Remove the recorded parts of an upload that are not in `keep`, in
+    the current transaction.
+
+    :param upload_id: the multipart upload ID
+    :param keep: the part numbers to keep
+    """
+    query = meta.Session.query(MultipartPart).filter(
+        MultipartPart.upload_id == upload_id)
+    if keep:
+        query = query.filter(~MultipartPart.n.in_(list(keep)))
+    query.delete(synchronize_session=False)
+
+
+class InventoryObject(Base, DomainObject):
+    """A copy of the listing of an object in the storage container, kept up
+    to date by uploads, deletions and the `sync-inventory` command."""
+    __tablename__ = 'cloudstorage_inventory'
+
+    name = Column(UnicodeText, primary_key=True)
+    resource_id = Column(UnicodeText, index=True)
+    size = Column(BigInteger)
+    etag = Column(UnicodeText)
+    last_modified = Column(DateTime)
+    synced = Column(DateTime, default=datetime.utcnow)
+
+
+class InventorySync(Base, DomainObject):
+    __tablename__ = 'cloudstorage_inventory_sync'
+
+    id = Column(Integer, primary_key=True)
+    started = Column(DateTime, default=datetime.utcnow)
+    finished = Column(DateTime)
+    full = Column(Boolean, default=False)
+
+    @classmethod
+    def last_finished(cls):
+        return meta.Session.query(cls).filter(
+            cls.finished != None  # noqa
+        ).order_by(cls.started.desc()).first()
+
+
+def _resource_id_from_name(name):
+    parts = name.split('/')
+    if len(parts) > 2 and parts[0] == 'resources':
+        return parts[1]
+
+
+def _naive_utc(value):
+    # Timestamps are stored without a time zone, in UTC.
+    if value is not None and value.tzinfo is not None:
+        value = (value - value.utcoffset()).replace(tzinfo=None)
+    return value
+
+
+def upsert_inventory(objects, synced=None):
+    """Insert or update inventory rows.
+
+    Runs in its own transaction: the inventory mirrors the provider, not
+    the state of the current request.
+
+    :param objects: list of `(name, size, etag, last_modified)` tuples
+    :param synced: time of the sync the objects come from
+    """
+    if not objects:
+        return
+    synced = synced or datetime.utcnow()
+    model.meta.engine.execute(
+        text("""
+            INSERT INTO cloudstorage_inventory
+                (name, resource_id, size, etag, last_modified, synced)
+            VALUES
+                (:name, :resource_id, :size, :etag, :last_modified, :synced)
+            ON CONFLICT (name) DO UPDATE SET
+                resource_id = EXCLUDED.resource_id,
+                size = EXCLUDED.size,
+                etag = EXCLUDED.etag,
+                last_modified = EXCLUDED.last_modified,
+                synced = EXCLUDED.synced
+        """),
+        [{
+            'name': name,
+            'resource_id': _resource_id_from_name(name),
+            'size': size,
+            'etag': etag,
+            'last_modified': _naive_utc(last_modified),
+            'synced': synced
+        } for name, size, etag, last_modified in objects]
+    )
+
+
+def remove_inventory(names):
+    """Remove the inventory rows of deleted objects.
+
+    :param names: list of object names
+    """
+    if not names:
+        return
+    model.meta.engine.execute(
+        InventoryObject.__table__.delete().where(
+            InventoryObject.name.in_(names)
+        )
+    )
+
+
+def prune_inventory(synced_before, prefix=None):
+    """Remove the inventory rows that were not seen by a sync.
+
+    :param synced_before: start time of the sync
+    :param prefix: only remove rows whose name starts with this
+    """
+    condition = InventoryObject.synced < synced_before
+    if prefix:
+        condition = and_(condition, InventoryObject.name.startswith(prefix))
+    return model.meta.engine.execute(
+        InventoryObject.__table__.delete().where(condition)
+    ).rowcount
+
+
+class Blob(Base, DomainObject):
+    """A deduplicated file, stored once under its SHA-256 and shared by the
+    resources that link to it."""
+    __tablename__ = 'cloudstorage_blob'
+
+    sha256 = Column(UnicodeText, primary_key=True)
+    size = Column(BigInteger)
+    refcount = Column(Integer, nullable=False, default=0)
+    created = Column(DateTime, default=datetime.utcnow)
+
+
+class ResourceBlob(Base, DomainObject):
+    __tablename__ = 'cloudstorage_resource_blob'
+
+    resource_id = Column(UnicodeText, primary_key=True)
+    sha256 = Column(UnicodeText, ForeignKey(Blob.sha256), index=True)
+
+
+def add_blob_reference(sha256, size):
+    """Add a reference to a blob, creating it if needed.
+
+    Runs in the current transaction, and locks the blob's row until it
+    ends.
+
+    :returns: the new reference count, `1` if the blob has to be uploaded
+    """
+    return meta.Session.execute(
+        text("""
+            INSERT INTO cloudstorage_blob (sha256, size, refcount, created)
+            VALUES (:sha256, :size, 1, :created)
+            ON CONFLICT (sha256) DO UPDATE SET
+                refcount = cloudstorage_blob.refcount + 1
+            RETURNING refcount
+        """),
+        {'sha256': sha256, 'size': size, 'created': datetime.utcnow()}
+    ).scalar()
+
+
+def remove_blob_reference(sha256):
+    """Remove a reference to a blob, and its row once it is unused.
+
+    Runs in the current transaction, and locks the blob's row until it
+    ends.
+
+    :returns: the remaining reference count
+    """
+    refcount = meta.Session.execute(
+        text("""
+            UPDATE cloudstorage_blob SET refcount = refcount - 1
+            WHERE sha256 = :sha256
+            RETURNING refcount
+        """),
+        {'sha256': sha256}
+    ).scalar()
+    if not refcount:
+        meta.Session.execute(
+            Blob.__table__.delete().where(Blob.sha256 == sha256)
+        )
+    return refcount or 0
+
+
+def get_resource_blob(resource_id):
+    """Return the SHA-256 of the blob a resource links to, if any."""
+    link = meta.Session.query(ResourceBlob).get(resource_id)
+    return link.sha256 if link is not None else None
+
+
+def link_resource_blob(resource_id, sha256):
+    """Point a resource at a blob, in the current transaction. The blob
+    must exist.
+
+    :returns: the SHA-256 of the blob it used to link to, if any
+    """
+    link = meta.Session.query(ResourceBlob).get(resource_id)
+    if link is None:
+        previous = None
+        meta.Session.add(ResourceBlob(resource_id=resource_id, sha256=sha256))
+    else:
+        previous, link.sha256 = link.sha256, sha256
+    # Before the previous blob's row may be removed.
+    meta.Session.flush()
+    return previous
+
+
+def unlink_resource_blob(resource_id):
+    """Remove the link of a resource to its blob, in the current
+    transaction.
+
+    :returns: the SHA-256 of the blob it linked to, if any
+    """
+    link = meta.Session.query(ResourceBlob).get(resource_id)
+    if link is None:
+        return None
+    meta.Session.delete(link)
+    meta.Session.flush()
+    return link.sha256
@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import logging
+import os.path
+
 from ckan import plugins
 from routes.mapper import SubMapper
-import os.path
 from ckanext.cloudstorage import storage
 from ckanext.cloudstorage import helpers
+from ckanext.cloudstorage import metrics
 import ckanext.cloudstorage.logic.action.multipart as m_action
 import ckanext.cloudstorage.logic.auth.multipart as m_auth
+import ckanext.cloudstorage.logic.action.metrics as metrics_action
+import ckanext.cloudstorage.logic.auth.metrics as metrics_auth
+
+log = logging.getLogger(__name__)
 
 
 class CloudStoragePlugin(plugins.SingletonPlugin):
@@ -18,6 +25,7 @@ class CloudStoragePlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.IResourceController, inherit=True)
+    plugins.implements(plugins.IPackageController, inherit=True)
 
     # IConfigurer
 
@@ -29,7 +37,8 @@ class CloudStoragePlugin(plugins.SingletonPlugin):
 
     def get_helpers(self):
         return dict(
-            cloudstorage_use_secure_urls=helpers.use_secure_urls
+            cloudstorage_use_secure_urls=helpers.use_secure_urls,
+            cloudstorage_use_direct_uploads=helpers.use_direct_uploads
         )
 
     def configure(self, config):
@@ -48,6 +57,9 @@ class CloudStoragePlugin(plugins.SingletonPlugin):
                     )
                 )
 
+        storage.configure(config)
+        metrics.configure(config)
+
     def get_resource_uploader(self, data_dict):
         # We provide a custom Resource uploader.
         return storage.ResourceCloudStorage(data_dict)
@@ -76,6 +88,11 @@ class CloudStoragePlugin(plugins.SingletonPlugin):
                 '/dataset/{id}/resource/{resource_id}/download/{filename}',
                 action='resource_download'
             )
+            sm.connect(
+                'cloudstorage_metrics',
+                '/cloudstorage/metrics',
+                action='metrics'
+            )
 
         return map
 
@@ -89,6 +106,11 @@ class CloudStoragePlugin(plugins.SingletonPlugin):
             'cloudstorage_abort_multipart': m_action.abort_multipart,
             'cloudstorage_check_multipart': m_action.check_multipart,
             'cloudstorage_clean_multipart': m_action.clean_multipart,
+            'cloudstorage_sign_multipart': m_action.sign_multipart,
+            'cloudstorage_presign_upload': m_action.presign_upload,
+            'cloudstorage_finish_upload': m_action.finish_upload,
+            'cloudstorage_multipart_status': m_action.multipart_status,
+            'cloudstorage_metrics': metrics_action.metrics,
         }
 
     # IAuthFunctions
@@ -101,11 +123,30 @@ class CloudStoragePlugin(plugins.SingletonPlugin):
             'cloudstorage_abort_multipart': m_auth.abort_multipart,
             'cloudstorage_check_multipart': m_auth.check_multipart,
             'cloudstorage_clean_multipart': m_auth.clean_multipart,
+            'cloudstorage_sign_multipart': m_auth.sign_multipart,
+            'cloudstorage_presign_upload': m_auth.presign_upload,
+            'cloudstorage_finish_upload': m_auth.finish_upload,
+            'cloudstorage_multipart_status': m_auth.multipart_status,
+            'cloudstorage_metrics': metrics_auth.metrics,
         }
 
+    # IResourceController and IPackageController
+
+    def after_update(self, context, data_dict):
+        # Called with a resource or a dataset.
+        storage.invalidate_download_cache(data_dict['id'])
+
+    # IPackageController
+
+    def delete(self, entity):
+        # `after_delete` may only get the dataset's name.
+        storage.invalidate_download_cache(entity.id)
+
     # IResourceController
 
     def before_delete(self, context, resource, resources):
+        storage.invalidate_download_cache(resource['id'])
+
         # let's get all info about our resource. It somewhere in resources
         # but if there is some possibility that it isn't(magic?) we have
         # `else` clause
@@ -143,6 +184,8 @@ class CloudStoragePlugin(plugins.SingletonPlugin):
                 )
             )
 
-            for old_file in uploader.container.iterate_objects():
-                if old_file.name.startswith(upload_path):
-                    old_file.delete()
+            old_files = uploader.iterate_objects(upload_path + '/')
+            for name, error in uploader.delete_objects(
+                    old_file.name for old_file in old_files):
+                if error:
+                    log.warning('Unable to delete %s: %s', name, error)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Minimal, dependency-free request signing for temporary download and upload
+URLs, so that we don't have to build `boto` or `azure-storage` clients just
+to sign a URL.
+"""
+import base64
+import hashlib
+import hmac
+import urllib
+from datetime import datetime, timedelta
+
+AZURE_SAS_VERSION = '2015-04-05'
+
+
+def _quote(value, safe='-_.~'):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return urllib.quote(str(value), safe=safe)
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+
+def _host_header(host, port, secure):
+    if port is None or int(port) == (443 if secure else 80):
+        return host
+    return '{0}:{1}'.format(host, port)
+
+
+def s3_presigned_url(key, secret, host, bucket, path, expires_in,
+                     region='us-east-1', method='GET', params=None,
+                     port=None, secure=True, now=None):
+    """
+    Return an AWS Signature Version 4 presigned URL for an S3 request.
+
+    :param key: The AWS access key ID.
+    :param secret: The AWS secret access key.
+    :param host: The S3 endpoint (ex: s3.amazonaws.com).
+    :param bucket: The bucket name, for a path-style request. `None` for a
+                   virtual-hosted-style request, where the bucket is part
+                   of `host`.
+    :param path: The object key.
+    :param expires_in: The number of seconds the URL stays valid.
+    :param region: The region of the bucket.
+    :param method: The HTTP method the URL will be used with.
+    :param params: Extra query string parameters to sign (ex: partNumber
+                   and uploadId for multipart uploads).
+    :param port: The endpoint port, if not the default one.
+    :param secure: `True` to use HTTPS.
+    :param now: The signing time, defaults to the current UTC time.
+    """
+    now = now or datetime.utcnow()
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    date_stamp = now.strftime('%Y%m%d')
+    scope = '/'.join((date_stamp, region, 's3', 'aws4_request'))
+    host_header = _host_header(host, port, secure)
+
+    query = dict(params or {})
+    query.update({
+        'X-Amz-Algorithm': 'AWS4-HMAC-SHA256',
+        'X-Amz-Credential': '{0}/{1}'.format(key, scope),
+        'X-Amz-Date': amz_date,
+        'X-Amz-Expires': str(int(expires_in)),
+        'X-Amz-SignedHeaders': 'host'
+    })
+    canonical_query = '&'.join(
+        '{0}={1}'.format(_quote(k), _quote(v))
+        for k, v in sorted(query.items())
+    )
+    canonical_uri = '/' + _quote(path, safe='-_.~/')
+    if bucket:
+        canonical_uri = '/' + _quote(bucket) + canonical_uri
+
+    canonical_request = '\n'.join((
+        method,
+        canonical_uri,
+        canonical_query,
+        'host:' + host_header + '\n',
+        'host',
+        'UNSIGNED-PAYLOAD'
+    ))
+    string_to_sign = '\n'.join((
+        'AWS4-HMAC-SHA256',
+        amz_date,
+        scope,
+        hashlib.sha256(canonical_request).hexdigest()
+    ))
+
+    signing_key = _hmac(('AWS4' + secret).encode('utf-8'), date_stamp)
+    for part in (region, 's3', 'aws4_request'):
+        signing_key = _hmac(signing_key, part)
+    signature = hmac.new(
+        signing_key,
+        string_to_sign,
+        hashlib.sha256
+    ).hexdigest()
+
+    return '{scheme}://{host}{uri}?{query}&X-Amz-Signature={signature}'.format(
+        scheme='https' if secure else 'http',
+        host=host_header,
+        uri=canonical_uri,
+        query=canonical_query,
+        signature=signature
+    )
+
+
+def azure_sas_url(account, account_key, host, container, blob, expires_in,
+                  permission='r', secure=True, now=None,
+                  content_disposition=None):
+    """
+    Return a blob URL with a service shared access signature.
+
+    :param account: The storage account name.
+    :param account_key: The base64-encoded storage account key.
+    :param host: The blob service host (ex: <account>.blob.core.windows.net)
+    :param container: The container name.
+    :param blob: The blob name.
+    :param expires_in: The number of seconds the URL stays valid.
+    :param permission: The SAS permissions (ex: `r` to read, `cw` to
+                       create and write).
+    :param secure: `True` to use (and require) HTTPS.
+    :param now: The signing time, defaults to the current UTC time.
+    :param content_disposition: The Content-Disposition header the blob is
+                                sent with, if any (ex: to name the
+                                downloaded file).
+    """
+    now = now or datetime.utcnow()
+    expiry = (now + timedelta(seconds=expires_in)).strftime(
+        '%Y-%m-%dT%H:%M:%SZ'
+    )
+    protocol = 'https' if secure else ''
+    if isinstance(blob, unicode):
+        blob = blob.encode('utf-8')
+
+    string_to_sign = '\n'.join((
+        permission,
+        '',
+        expiry,
+        '/blob/{0}/{1}/{2}'.format(account, container, blob),
+        '',
+        '',
+        protocol,
+        AZURE_SAS_VERSION,
+        '',
+        content_disposition or '',
+        '',
+        '',
+        ''
+    ))
+    signature = base64.b64encode(
+        hmac.new(
+            base64.b64decode(account_key),
+            string_to_sign,
+            hashlib.sha256
+        ).digest()
+    )
+
+    query = [
+        ('sv', AZURE_SAS_VERSION),
+        ('sr', 'b'),
+        ('sp', permission),
+        ('se', expiry)
+    ]
+    if protocol:
+        query.append(('spr', protocol))
+    if content_disposition:
+        query.append(('rscd', content_disposition))
+    query.append(('sig', signature))
+
+    return '{scheme}://{host}/{container}/{blob}?{query}'.format(
+        scheme='https' if secure else 'http',
+        host=host,
+        container=_quote(container),
+        blob=_quote(blob, safe='-_.~/'),
+        query='&'.join(
+            '{0}={1}'.format(k, _quote(v)) for k, v in query
+        )
+    )
@@ -1,29 +1,398 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import base64
 import cgi
+import hashlib
+import httplib
+import logging
 import mimetypes
+import os
 import os.path
-import urlparse
+import threading
+import time
+import urllib
+from StringIO import StringIO
 from ast import literal_eval
-from datetime import datetime, timedelta
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from xml.sax.saxutils import escape
 
 from pylons import config
 from ckan import model
 from ckan.lib import munge
 import ckan.plugins as p
 
-from libcloud.storage.types import Provider, ObjectDoesNotExistError
+from ckanext.cloudstorage import metrics, signing
+from ckanext.cloudstorage.cache import LRUCache
+from ckanext.cloudstorage.model import (
+    upsert_inventory,
+    remove_inventory,
+    add_blob_reference,
+    remove_blob_reference,
+    get_resource_blob,
+    link_resource_blob,
+    unlink_resource_blob
+)
+
+from libcloud.storage.base import Container, Object
+from libcloud.common.types import LibcloudError
+from libcloud.storage.types import (
+    Provider,
+    ObjectDoesNotExistError,
+    ContainerDoesNotExistError
+)
 from libcloud.storage.providers import get_driver
 
+log = logging.getLogger(__name__)
 
-class CloudStorage(object):
+# S3's DeleteObjects accepts at most 1000 keys per request.
+S3_DELETE_BATCH_SIZE = 1000
+# S3 multipart uploads can't have more than 10,000 parts, and every part but
+# the last one must be at least 5 MB.
+S3_MAX_PARTS = 10000
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Deduplicated files are stored under this prefix, named by their SHA-256.
+BLOB_PREFIX = 'blobs/'
+
+# Driver options parsed once by `configure()`, instead of running
+# `literal_eval` on every access.
+_driver_options = None
+
+# (driver name, container name) -> time the container was last confirmed to
+# exist on the provider.
+_verified_containers = {}
+
+# (container name, object path, method) -> signed URL.
+_signed_urls = LRUCache(1000)
+
+# (container name, object path) -> whether the object exists.
+_existing_objects = LRUCache(10000)
+
+# resource id -> (the resource fields a download needs, whether anyone can
+# read the resource). Used when `download_cache_ttl` is set.
+resource_cache = LRUCache(10000)
+
+# (account, key) -> azure-storage BlockBlobService, which is safe to share.
+_blob_services = {}
+
+# Whether it has been logged that the state of kept-alive connections can't
+# be checked.
+_keep_alive_unchecked = False
+
+# Limits the number of downloads streamed at the same time by this process
+# in proxy mode. `None` means no limit.
+_proxy_slots = None
+
+# Response headers passed from the provider to the client in proxy mode.
+PROXY_RESPONSE_HEADERS = (
+    'Accept-Ranges',
+    'Cache-Control',
+    'Content-Disposition',
+    'Content-Encoding',
+    'Content-Length',
+    'Content-Range',
+    'Content-Type',
+    'ETag',
+    'Last-Modified'
+)
+
+
+def configure(config):
+    """
+    Parse the ckanext-cloudstorage settings that are expensive to compute
+    and cache them for the lifetime of the process. Called from
+    `CloudStoragePlugin.configure`.
+
+    :param config: The CKAN configuration.
+    """
+    global _driver_options, _signed_urls, _existing_objects, _proxy_slots
+    global resource_cache
+    _driver_options = literal_eval(
+        config['ckanext.cloudstorage.driver_options']
+    )
+    _signed_urls = LRUCache(
+        int(config.get('ckanext.cloudstorage.secure_url_cache_size', 1000))
+    )
+    _existing_objects = LRUCache(
+        int(config.get('ckanext.cloudstorage.exists_cache_size', 10000))
+    )
+    resource_cache = LRUCache(
+        int(config.get('ckanext.cloudstorage.download_cache_size', 10000))
+    )
+
+    max_concurrency = int(
+        config.get('ckanext.cloudstorage.proxy_max_concurrency', 0)
+    )
+    _proxy_slots = (
+        threading.BoundedSemaphore(max_concurrency)
+        if max_concurrency > 0 else None
+    )
+
+    if p.toolkit.asbool(config.get('ckanext.cloudstorage.warm_up', False)):
+        # Build this worker's driver and open its connection up front so
+        # the first request doesn't pay for it.
+        CloudStorage().container
+
+
+def content_disposition(filename):
+    """
+    Return the Content-Disposition header downloading a file as
+    `filename`.
+
+    :param filename: The name of the file, munged to be safe in a header.
+    """
+    return 'attachment; filename="{0}"'.format(
+        munge.munge_filename(filename))
+
+
+def invalidate_download_cache(id):
+    """
+    Forget what downloads cached about a resource, or about every resource
+    of a dataset.
+
+    :param id: The ID of the resource or dataset.
+    """
+    resource_cache.invalidate(id)
+    resource_cache.invalidate_where(
+        lambda value: value[0].get('package_id') == id)
+
+
+def _keep_alive(connection, timeout):
+    """
+    libcloud opens a brand new HTTP(S) connection (and TLS handshake) for
+    every single request. Wrap `connection.connect` so that an idle socket
+    is reused for the next request, as long as it was last used less than
+    `timeout` seconds ago.
+
+    :param connection: A libcloud `Connection` instance.
+    :param timeout: Maximum idle time of a kept-alive socket, in seconds.
+    """
+    connect = connection.connect
+    state = {'last_used': 0}
+
+    def is_idle(conn):
+        # Only an idle connection whose last response has been fully read
+        # can be used for another request. httplib only exposes that
+        # through private attributes: without them, rely on responses
+        # always being read to the end, or their connection closed (see
+        # `ObjectStream`), and on the idle time.
+        global _keep_alive_unchecked
+        if getattr(conn, 'sock', None) is None:
+            return False
+        try:
+            conn_state = conn._HTTPConnection__state
+            response = conn._HTTPConnection__response
+        except AttributeError:
+            if not _keep_alive_unchecked:
+                _keep_alive_unchecked = True
+                log.warning(
+                    'Unable to check the state of %s connections, reusing '
+                    'them based on their idle time only',
+                    type(conn).__name__
+                )
+            return True
+        return conn_state == 'Idle' and (
+            response is None or response.isclosed())
+
+    def keep_alive_connect(*args, **kwargs):
+        conn = connection.connection
+        now = time.time()
+        reusable = (
+            not args and not kwargs and
+            conn is not None and
+            is_idle(conn) and
+            now - state['last_used'] < timeout
+        )
+        state['last_used'] = now
+        if not reusable:
+            connect(*args, **kwargs)
+
+    connection.connect = keep_alive_connect
+
+
+def acquire_proxy_slot():
+    """
+    Reserve one of the `proxy_max_concurrency` proxied downloads, without
+    waiting.
+
+    :returns: `False` if they are all in use.
+    """
+    if _proxy_slots is None:
+        return True
+    return _proxy_slots.acquire(False)
+
+
+def release_proxy_slot():
+    """
+    Release a download reserved with `acquire_proxy_slot`.
+    """
+    if _proxy_slots is not None:
+        _proxy_slots.release()
+
+
+class ObjectStream(object):
+    """
+    A WSGI iterable over the body of a download, read `chunk_size` bytes at
+    a time so that memory use doesn't depend on the size of the object.
+    """
+    def __init__(self, response, chunk_size, connection=None,
+                 on_close=None):
+        """
+        :param response: A file-like object to read the body from.
+        :param chunk_size: The number of bytes read at a time.
+        :param connection: The HTTP connection of the response, closed if
+                           the body is not read to the end, so that it
+                           isn't kept alive with unread data.
+        :param on_close: Called once, when the stream is closed.
+        """
+        self._response = response
+        self._chunk_size = chunk_size
+        self._connection = connection
+        self._on_close = on_close
+        self._complete = False
+        self._closed = False
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self._response.read(self._chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+            self._complete = True
+        finally:
+            self.close()
+
+    def read_all(self):
+        """
+        Read the (small) remainder of the body and close the stream.
+        """
+        return ''.join(self)
+
+    def close(self):
+        # Called by the WSGI server, even if the client went away.
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if not self._complete and self._connection is not None:
+                self._connection.close()
+            else:
+                self._response.close()
+        finally:
+            if self._on_close is not None:
+                self._on_close()
+
+
+class HashingReader(object):
+    """
+    A file-like wrapper computing the MD5 and SHA-256 digests and the size
+    of the data read through it, in the same pass as the upload.
+    """
+    # The size of the chunks returned when iterated over, as libcloud does.
+    chunk_size = 64 * 1024
+
+    def __init__(self, stream):
+        """
+        :param stream: The file-like object to read from.
+        """
+        self._stream = stream
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        data = self.read(self.chunk_size)
+        if not data:
+            raise StopIteration
+        return data
+
+
+def get_stream_size(stream):
+    """
+    Return the number of bytes left to read in a seekable stream.
+
+    :param stream: A seekable file-like object.
+    """
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell() - position
+    stream.seek(position)
+    return size
+
+
+class DriverPool(object):
+    """
+    A per-process pool of apache-libcloud drivers.
+
+    Drivers, and the HTTP connections they hold, are not safe to share
+    between threads, so every thread gets its own driver for a given
+    configuration, which is then reused for every request that thread
+    serves.
+    """
     def __init__(self):
-        self.driver = get_driver(
-            getattr(
-                Provider,
-                self.driver_name
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+    def get(self, driver_name, driver_options):
+        """
+        Return this thread's driver for the given configuration, creating
+        it on first use.
+
+        :param driver_name: The name of the driver (ex: AZURE_BLOBS, S3).
+        :param driver_options: The dict of options passed to the driver.
+        """
+        if self._pid != os.getpid():
+            # We've been forked (ex: uWSGI without lazy-apps). Never share
+            # sockets with the parent process.
+            self._local = threading.local()
+            self._pid = os.getpid()
+
+        drivers = getattr(self._local, 'drivers', None)
+        if drivers is None:
+            drivers = self._local.drivers = {}
+
+        key = (driver_name, repr(sorted(driver_options.items())))
+        driver = drivers.get(key)
+        if driver is None:
+            driver = get_driver(
+                getattr(
+                    Provider,
+                    driver_name
+                )
+            )(**driver_options)
+
+            timeout = float(
+                config.get('ckanext.cloudstorage.keep_alive_timeout', 15)
             )
-        )(**self.driver_options)
+            connection = getattr(driver, 'connection', None)
+            if timeout > 0 and connection is not None:
+                _keep_alive(connection, timeout)
+
+            drivers[key] = driver
+
+        return driver
+
+
+driver_pool = DriverPool()
+
+
+class CloudStorage(object):
+    def __init__(self):
+        self.driver = driver_pool.get(self.driver_name, self.driver_options)
         self._container = None
 
     def path_from_filename(self, rid, filename):
@@ -33,21 +402,850 @@ class CloudStorage(object):
     def container(self):
         """
         Return the currently configured libcloud container.
+
+        The container is built locally from its name. Its existence is
+        checked with the provider at most once per process every
+        `container_check_ttl` seconds, or again after a call failed because
+        the container could not be found.
         """
         if self._container is None:
-            self._container = self.driver.get_container(
-                container_name=self.container_name
+            self.verify_container()
+            self._container = Container(
+                name=self.container_name,
+                extra={},
+                driver=self.driver
             )
 
         return self._container
 
+    def verify_container(self, force=False):
+        """
+        Ensure the configured container exists, unless it has been verified
+        recently.
+
+        :param force: Check with the provider even if the container has
+                      been verified within the TTL.
+        :raises ContainerDoesNotExistError: If the container doesn't exist.
+        """
+        key = (self.driver_name, self.container_name)
+        verified = _verified_containers.get(key)
+        if not force and verified is not None:
+            if time.time() - verified < self.container_check_ttl:
+                return
+
+        with metrics.timed('get_container', self.driver_name):
+            self.driver.get_container(container_name=self.container_name)
+        _verified_containers[key] = time.time()
+
+    @property
+    def azure_blob_service(self):
+        """
+        Return this process's `azure-storage` BlockBlobService for the
+        configured account. Requires `can_use_advanced_azure`.
+        """
+        key = (self.driver_options['key'], self.driver_options['secret'])
+        blob_service = _blob_services.get(key)
+        if blob_service is None:
+            from azure.storage import blob as azure_blob
+
+            blob_service = _blob_services[key] = azure_blob.BlockBlobService(
+                *key
+            )
+        return blob_service
+
+    def iterate_objects(self, prefix=None):
+        """
+        Iterate over the objects in the container whose name starts with
+        `prefix`.
+
+        The filtering is done by the provider where it is supported, so
+        that the cost of the listing depends on the number of matching
+        objects instead of the size of the container.
+
+        :param prefix: Only return objects whose name starts with this.
+        """
+        with self.checking_container():
+            if not prefix:
+                objects = self.driver.iterate_container_objects(
+                    self.container
+                )
+            elif self.can_use_advanced_azure:
+                objects = self._iterate_azure_objects(prefix)
+            else:
+                try:
+                    objects = self.driver.iterate_container_objects(
+                        self.container,
+                        ex_prefix=prefix
+                    )
+                except TypeError:
+                    # This driver can't filter on the provider's side.
+                    objects = (
+                        obj for obj in self.driver.iterate_container_objects(
+                            self.container
+                        )
+                        if obj.name.startswith(prefix)
+                    )
+
+            for obj in metrics.timed_iter(
+                    objects, 'list_objects', self.driver_name):
+                yield obj
+
+    def stream_request(self, path, stream, size, method='PUT',
+                       headers=None, operation='stream_request'):
+        """
+        Send a request to the provider whose body is read from `stream`
+        `stream_buffer_size` bytes at a time, so that memory use doesn't
+        depend on the size of the body.
+
+        :param path: The request path, including the query string.
+        :param stream: A file-like object to read the body from.
+        :param size: The number of bytes to send from `stream`.
+        :param method: The HTTP method.
+        :param headers: Extra request headers.
+        :param operation: The name the request is recorded under in the
+                          metrics.
+        :returns: The libcloud raw response, whose body has been read.
+        """
+        headers = dict(headers or {})
+        headers['Content-Length'] = str(size)
+
+        with self.checking_container(operation, size) as call:
+            resp = self.driver.connection.request(
+                path,
+                method=method,
+                headers=headers,
+                raw=True
+            )
+
+            remaining = size
+            while remaining > 0:
+                chunk = stream.read(min(self.stream_buffer_size, remaining))
+                if not chunk:
+                    raise IOError(
+                        'Stream ended {0} bytes early'.format(remaining)
+                    )
+                resp.connection.connection.send(chunk)
+                remaining -= len(chunk)
+
+            # Read the (small) response body so the connection can be
+            # reused.
+            resp.response.read()
+            call['outcome'] = metrics.status_outcome(resp.status)
+        return resp
+
+    def open_object(self, name, headers=None, on_close=None):
+        """
+        Start downloading an object, for it to be streamed to a client.
+
+        The request goes through this thread's driver connection, so that
+        kept-alive connections are reused. Conditional and range request
+        headers are passed to the provider as they are.
+
+        :param name: The object name.
+        :param headers: Request headers (ex: Range, If-None-Match).
+        :param on_close: Called once the returned stream is closed.
+        :returns: A `(status, headers, stream)` tuple, where `stream` is an
+                  `ObjectStream` over the response body.
+        """
+        if self.driver_name == 'LOCAL':
+            # No HTTP connection to go through: whole objects only.
+            try:
+                with self.checking_container('get_object'):
+                    obj = self.container.get_object(name)
+            except ObjectDoesNotExistError:
+                return 404, {}, ObjectStream(
+                    StringIO(), 1, on_close=on_close)
+            return 200, {
+                'Content-Length': str(obj.size)
+            }, ObjectStream(
+                open(self.local_path(name), 'rb'),
+                self.stream_buffer_size,
+                on_close=on_close
+            )
+
+        with self.checking_container('open_object') as call:
+            resp = self.driver.connection.request(
+                self.object_path(name),
+                method='GET',
+                headers=dict(headers or {}),
+                raw=True
+            )
+            # Not `resp.response`, which raises for the statuses libcloud
+            # considers errors (ex: 304, 412 and 416), that are answers to
+            # conditional and range requests, for the client.
+            response = resp.connection.connection.getresponse()
+            call['outcome'] = metrics.status_outcome(response.status)
+        response_headers = dict(
+            (header, response.getheader(header))
+            for header in PROXY_RESPONSE_HEADERS
+            if response.getheader(header) is not None
+        )
+        return response.status, response_headers, ObjectStream(
+            response,
+            self.stream_buffer_size,
+            connection=resp.connection.connection,
+            on_close=on_close
+        )
+
+    def local_path(self, name):
+        """
+        Return the path of an object on the filesystem, with the `LOCAL`
+        driver.
+
+        :param name: The object name.
+        :returns: The path, or `None` if the driver isn't `LOCAL` or the
+                  name points outside of the container.
+        """
+        if self.driver_name != 'LOCAL':
+            return None
+        root = os.path.abspath(
+            os.path.join(self.driver.base_path, self.container_name))
+        path = os.path.abspath(os.path.join(root, name))
+        if not path.startswith(root + os.sep):
+            return None
+        return path
+
+    def object_path(self, name):
+        """
+        Return the request path of an object, for raw requests made through
+        the driver's connection.
+
+        :param name: The object name.
+        """
+        return '/' + self.container_name + '/' + name
+
+    def initiate_multipart_upload(self, name, content_type=None):
+        """
+        Start an S3 multipart upload.
+
+        :param name: The object name.
+        :param content_type: The content type of the final object.
+        :returns: The upload ID.
+        """
+        headers = {}
+        if content_type:
+            headers['Content-Type'] = content_type
+
+        with self.checking_container('initiate_multipart') as call:
+            resp = self.driver.connection.request(
+                self.object_path(name) + '?uploads',
+                method='POST',
+                headers=headers
+            )
+            call['outcome'] = metrics.status_outcome(resp.status)
+        if not resp.success():
+            raise LibcloudError(resp.error, driver=self.driver)
+
+        try:
+            return resp.object.find(
+                '{%s}UploadId' % resp.object.nsmap[None]).text
+        except AttributeError:
+            upload_id_list = filter(
+                lambda e: e.tag.endswith('UploadId'),
+                resp.object.getchildren()
+            )
+            return upload_id_list[0].text
+
+    def commit_multipart_upload(self, name, upload_id, parts):
+        """
+        Complete an S3 multipart upload.
+
+        :param name: The object name.
+        :param upload_id: The upload ID.
+        :param parts: A list of `(part number, etag)` tuples.
+        """
+        with self.checking_container('commit_multipart'):
+            return self.driver._commit_multipart(
+                self.object_path(name),
+                upload_id,
+                parts
+            )
+
+    def abort_multipart_upload(self, name, upload_id):
+        """
+        Abort an S3 multipart upload, removing its parts.
+
+        :param name: The object name.
+        :param upload_id: The upload ID.
+        :returns: The libcloud response.
+        """
+        with self.checking_container('abort_multipart') as call:
+            resp = self.driver.connection.request(
+                self.object_path(name) + '?uploadId=' + upload_id,
+                method='DELETE'
+            )
+            call['outcome'] = metrics.status_outcome(resp.status)
+        return resp
+
+    def iterate_multipart_uploads(self):
+        """
+        Iterate over the S3 multipart uploads in progress in the container,
+        requesting as many pages as needed.
+
+        :returns: A generator of `(object name, upload ID, initiated)`
+                  tuples, where `initiated` is a naive UTC datetime.
+        """
+        with self.checking_container():
+            uploads = self.driver.ex_iterate_multipart_uploads(self.container)
+            for upload in metrics.timed_iter(
+                    uploads, 'list_multipart_uploads', self.driver_name):
+                yield upload.key, upload.id, datetime.strptime(
+                    upload.created_at[:19], '%Y-%m-%dT%H:%M:%S')
+
+    def iterate_multipart_parts(self, name, upload_id):
+        """
+        Iterate over the parts of an S3 multipart upload received by the
+        provider, requesting as many pages as needed.
+
+        :param name: The object name.
+        :param upload_id: The upload ID.
+        :returns: A generator of `(part number, size, etag)` tuples.
+        """
+        params = {}
+        while True:
+            with self.checking_container('list_parts') as call:
+                # Markers aren't sub-resources: they must not be part of
+                # the signed path.
+                resp = self.driver.connection.request(
+                    self.object_path(name) + '?uploadId=' + upload_id,
+                    params=params
+                )
+                call['outcome'] = metrics.status_outcome(resp.status)
+            if not resp.success():
+                raise LibcloudError(resp.error, driver=self.driver)
+
+            fields = {}
+            for node in resp.object:
+                tag = node.tag.rsplit('}', 1)[-1]
+                if tag == 'Part':
+                    part = dict(
+                        (child.tag.rsplit('}', 1)[-1], child.text)
+                        for child in node
+                    )
+                    yield (
+                        int(part['PartNumber']),
+                        int(part['Size']),
+                        part['ETag']
+                    )
+                else:
+                    fields[tag] = node.text
+
+            if fields.get('IsTruncated') != 'true':
+                return
+            params = {'part-number-marker': fields['NextPartNumberMarker']}
+
+    @property
+    def can_upload_in_parts(self):
+        """
+        `True` if large files can be uploaded in parallel parts: S3
+        multipart uploads, or Azure blocks if `azure-storage` is installed.
+        """
+        return self.can_use_advanced_azure or 'S3' in self.driver_name
+
+    def upload_in_parts(self, name, stream, size, content_type=None):
+        """
+        Upload `size` bytes read from `stream` in parts of
+        `multipart_part_size` bytes, `upload_workers` parts at a time.
+
+        Uses an S3 multipart upload, or Azure's put_block and
+        put_block_list. Failed parts are retried `part_retries` times. At
+        most `upload_workers + 1` parts are held in memory.
+
+        :param name: The object name.
+        :param stream: A file-like object to read the data from.
+        :param size: The number of bytes to upload.
+        :param content_type: The content type of the object.
+        """
+        part_size = max(
+            self.multipart_part_size,
+            S3_MIN_PART_SIZE,
+            -(-size // S3_MAX_PARTS)
+        )
+
+        if self.can_use_advanced_azure:
+            upload_id = None
+            send_part = lambda n, data: self._put_azure_block(name, n, data)
+        else:
+            upload_id = self.initiate_multipart_upload(name, content_type)
+            send_part = lambda n, data: self._put_s3_part(
+                name, upload_id, n, data)
+
+        try:
+            parts = self._send_parts(stream, size, part_size, send_part)
+        except Exception:
+            if upload_id is not None:
+                try:
+                    self.abort_multipart_upload(name, upload_id)
+                except Exception as e:
+                    log.warning(
+                        'Unable to abort multipart upload %s: %s',
+                        upload_id, e
+                    )
+            raise
+
+        if upload_id is None:
+            from azure.storage.blob.models import BlobBlock, ContentSettings
+
+            content_settings = None
+            if content_type:
+                content_settings = ContentSettings(content_type=content_type)
+            with self.checking_container('commit_multipart'):
+                return self.azure_blob_service.put_block_list(
+                    container_name=self.container_name,
+                    blob_name=name,
+                    block_list=[
+                        BlobBlock(id=block_id) for _, block_id in parts
+                    ],
+                    content_settings=content_settings
+                )
+        return self.commit_multipart_upload(name, upload_id, parts)
+
+    def _send_parts(self, stream, size, part_size, send_part):
+        # Parts are read one after the other from the stream, and sent by
+        # a pool of workers. A new part is only read once a worker is free,
+        # which bounds memory use.
+        workers = self.upload_workers
+        slots = threading.BoundedSemaphore(workers)
+        results = {}
+        errors = []
+
+        def done(result):
+            n, etag, error = result
+            if error is None:
+                results[n] = etag
+            else:
+                errors.append(error)
+            slots.release()
+
+        pool = ThreadPool(workers)
+        try:
+            n = 0
+            remaining = size
+            while remaining > 0:
+                slots.acquire()
+                if errors:
+                    break
+
+                data = stream.read(min(part_size, remaining))
+                if not data:
+                    raise IOError(
+                        'Stream ended {0} bytes early'.format(remaining)
+                    )
+                remaining -= len(data)
+                n += 1
+                pool.apply_async(
+                    self._send_part_with_retries,
+                    (send_part, n, data),
+                    callback=done
+                )
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+
+        if errors:
+            raise errors[0]
+        return sorted(results.items())
+
+    def _send_part_with_retries(self, send_part, n, data):
+        # Never raises, as exceptions would be lost by the pool.
+        for attempt in range(self.part_retries + 1):
+            try:
+                return n, send_part(n, data), None
+            except Exception as e:
+                log.warning(
+                    'Upload of part %s failed (attempt %s): %s',
+                    n, attempt + 1, e
+                )
+                error = e
+                if attempt < self.part_retries:
+                    time.sleep(min(2 ** attempt, 30))
+        return n, None, error
+
+    def _put_s3_part(self, name, upload_id, n, data):
+        # Runs in a worker thread, which needs its own driver.
+        driver = driver_pool.get(self.driver_name, self.driver_options)
+        with metrics.timed('upload_part', self.driver_name,
+                           len(data)) as call:
+            resp = driver.connection.request(
+                self.object_path(name) + '?partNumber={0}&uploadId={1}'.format(
+                    n, upload_id),
+                method='PUT',
+                data=data,
+                headers={
+                    'Content-MD5': base64.b64encode(
+                        hashlib.md5(data).digest())
+                }
+            )
+            call['outcome'] = metrics.status_outcome(resp.status)
+        if resp.status != 200:
+            raise LibcloudError(
+                'Upload failed: part {0}'.format(n),
+                driver=driver
+            )
+        return resp.headers['etag']
+
+    def _put_azure_block(self, name, n, data):
+        block_id = '{0:06d}'.format(n)
+        with metrics.timed('upload_part', self.driver_name, len(data)):
+            self.azure_blob_service.put_block(
+                container_name=self.container_name,
+                blob_name=name,
+                block=data,
+                block_id=block_id
+            )
+        return block_id
+
+    def delete_objects(self, names):
+        """
+        Delete many objects from the container.
+
+        On S3, keys are deleted in batches of up to 1000 with a single
+        DeleteObjects request per batch. Elsewhere (or if a batch request
+        fails) objects are deleted one by one, `delete_workers` at a time.
+
+        Objects that don't exist are considered deleted.
+
+        :param names: An iterable of object names, consumed lazily.
+        :returns: A generator of `(name, error)` tuples, where `error` is
+                  `None` if the object has been deleted.
+        """
+        names = iter(names)
+        pool = None
+        try:
+            while True:
+                batch = list(islice(names, S3_DELETE_BATCH_SIZE))
+                if not batch:
+                    break
+
+                results = None
+                if 'S3' in self.driver_name:
+                    try:
+                        results = self._delete_s3_batch(batch)
+                    except Exception as e:
+                        log.warning(
+                            'Batch delete failed, deleting objects one by '
+                            'one: %s', e
+                        )
+
+                if results is None:
+                    if pool is None:
+                        pool = ThreadPool(self.delete_workers)
+                    results = pool.imap_unordered(self._delete_object, batch)
+
+                deleted = []
+                for name, error in results:
+                    if error is None:
+                        deleted.append(name)
+                    yield name, error
+                self.record_deletions(deleted)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def record_upload(self, name, size=None, etag=None, last_modified=None):
+        """
+        Forget the cached existence of an object that has just been
+        uploaded, and add it to the inventory if it is enabled. Inventory
+        failures are logged, as it can always be rebuilt with the
+        `sync-inventory` command.
+
+        :param name: The object name.
+        :param size: The object size, in bytes.
+        :param etag: The object ETag, or block list/multipart hash.
+        :param last_modified: Defaults to the current UTC time.
+        """
+        _existing_objects.invalidate((self.container_name, name))
+        if not self.use_inventory:
+            return
+        try:
+            upsert_inventory([
+                (name, size, etag, last_modified or datetime.utcnow())
+            ])
+        except Exception as e:
+            log.warning('Unable to add %s to the inventory: %s', name, e)
+
+    def record_deletions(self, names):
+        """
+        Forget the cached existence of deleted objects, and remove them from
+        the inventory if it is enabled.
+
+        :param names: A list of object names.
+        """
+        for name in names:
+            _existing_objects.invalidate((self.container_name, name))
+        if not self.use_inventory or not names:
+            return
+        try:
+            remove_inventory(names)
+        except Exception as e:
+            log.warning('Unable to remove objects from the inventory: %s', e)
+
+    def blob_path(self, sha256):
+        """
+        Return the object path of the deduplicated blob with the given
+        SHA-256.
+
+        :param sha256: The hex SHA-256 of the blob's content.
+        """
+        return '{0}{1}/{2}'.format(BLOB_PREFIX, sha256[:2], sha256)
+
+    def release_blob(self, sha256):
+        """
+        Remove a reference to a deduplicated blob, and delete the blob once
+        no resource uses it anymore.
+
+        The blob is deleted right away while its row is locked, so that no
+        upload can link to it in the meantime.
+
+        :param sha256: The hex SHA-256 of the blob's content.
+        """
+        if remove_blob_reference(sha256):
+            return
+
+        name = self.blob_path(sha256)
+        try:
+            with self.checking_container('delete_object'):
+                self.container.delete_object(self.container.get_object(name))
+        except ObjectDoesNotExistError:
+            pass
+        self.record_deletions([name])
+
+    def _delete_s3_batch(self, names):
+        data = '<Delete><Quiet>true</Quiet>{0}</Delete>'.format(''.join(
+            '<Object><Key>{0}</Key></Object>'.format(
+                escape(name.encode('utf-8') if isinstance(name, unicode)
+                       else name)
+            ) for name in names
+        ))
+        with self.checking_container('delete_batch') as call:
+            resp = self.driver.connection.request(
+                '/{0}?delete'.format(self.container_name),
+                method='POST',
+                data=data,
+                headers={
+                    'Content-MD5': base64.b64encode(
+                        hashlib.md5(data).digest()
+                    ),
+                    'Content-Type': 'application/xml'
+                }
+            )
+            call['outcome'] = metrics.status_outcome(resp.status)
+        # libcloud considers some errors (ex: 400) successful on S3, with
+        # an <Error> document as the body.
+        if resp.status != httplib.OK:
+            raise RuntimeError(u'Status {0}: {1}'.format(
+                resp.status, resp.body))
+
+        # In quiet mode, only the keys that failed are returned.
+        errors = {}
+        for node in resp.object:
+            if node.tag.endswith('Error'):
+                fields = dict(
+                    (child.tag.rsplit('}', 1)[-1], child.text)
+                    for child in node
+                )
+                errors[fields.get('Key')] = u'{0}: {1}'.format(
+                    fields.get('Code'),
+                    fields.get('Message')
+                )
+
+        return [(name, errors.get(name)) for name in names]
+
+    def _delete_object(self, name):
+        # Runs in a worker thread, which needs its own driver.
+        driver = driver_pool.get(self.driver_name, self.driver_options)
+        obj = Object(
+            name=name,
+            size=None,
+            hash=None,
+            extra={},
+            meta_data={},
+            container=Container(
+                name=self.container_name,
+                extra={},
+                driver=driver
+            ),
+            driver=driver
+        )
+        try:
+            with metrics.timed('delete_object', self.driver_name) as call:
+                if not driver.delete_object(obj):
+                    call['outcome'] = 'error'
+                    return name, u'Unable to delete object'
+        except ObjectDoesNotExistError:
+            pass
+        except Exception as e:
+            return name, u'{0}: {1}'.format(type(e).__name__, e)
+        return name, None
+
+    def _iterate_azure_objects(self, prefix):
+        # libcloud's Azure driver doesn't support prefixes, azure-storage
+        # does.
+        for blob in self.azure_blob_service.list_blobs(
+                container_name=self.container_name,
+                prefix=prefix):
+            yield Object(
+                name=blob.name,
+                size=blob.properties.content_length,
+                hash=blob.properties.etag,
+                extra={'last_modified': blob.properties.last_modified},
+                meta_data=blob.metadata or {},
+                container=self.container,
+                driver=self.driver
+            )
+
+    def get_signed_url(self, path, method='GET', params=None,
+                       filename=None):
+        """
+        Return a temporary signed URL for the object at `path`.
+
+        Download URLs are cached and handed out again until only
+        `1 - secure_url_reuse` of their validity is left.
+
+        :param path: The object path in the container.
+        :param method: The HTTP method the URL will be used with, `GET` to
+                       download or `PUT` to upload.
+        :param params: Extra query string parameters to sign (S3 only).
+        :param filename: The name the provider should send the object
+                         under, when it isn't named after the file (ex: a
+                         deduplicated blob).
+        """
+        cacheable = method == 'GET' and not params
+        key = (self.container_name, path, method, filename)
+        disposition = content_disposition(filename) if filename else None
+        if cacheable:
+            url = _signed_urls.get(key)
+            if url is not None:
+                return url
+
+        expires_in = self.secure_url_ttl
+        if self.driver_name == 'AZURE_BLOBS':
+            url = signing.azure_sas_url(
+                account=self.driver_options['key'],
+                account_key=self.driver_options['secret'],
+                host=self.driver.connection.host,
+                container=self.container_name,
+                blob=path,
+                expires_in=expires_in,
+                permission='r' if method == 'GET' else 'cw',
+                secure=bool(self.driver.connection.secure),
+                content_disposition=disposition
+            )
+        else:
+            if disposition:
+                params = dict(params or {})
+                params['response-content-disposition'] = disposition
+            url = signing.s3_presigned_url(
+                key=self.driver_options['key'],
+                secret=self.driver_options['secret'],
+                host=self.driver.connection.host,
+                bucket=self.container_name,
+                path=path,
+                expires_in=expires_in,
+                region=self.s3_region,
+                method=method,
+                params=params,
+                port=self.driver.connection.port,
+                secure=bool(self.driver.connection.secure)
+            )
+
+        if cacheable:
+            _signed_urls.set(key, url, expires_in * self.secure_url_reuse)
+        return url
+
+    def get_public_url(self, path):
+        """
+        Return the public URL of the object at `path`, built without a
+        request to the provider: under `public_url_base` if it is set (ex:
+        a CDN), otherwise on the S3 or Azure endpoint.
+
+        :param path: The object path in the container.
+        :returns: The URL, or `None` if it can't be built for this driver.
+        """
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        path = urllib.quote(path, safe='/-_.~')
+
+        if self.public_url_base:
+            return '{0}/{1}'.format(self.public_url_base.rstrip('/'), path)
+
+        if self.driver_name != 'AZURE_BLOBS' and 'S3' not in self.driver_name:
+            return None
+
+        connection = self.driver.connection
+        secure = bool(connection.secure)
+        host = connection.host
+        if connection.port and int(connection.port) != (443 if secure else 80):
+            host = '{0}:{1}'.format(host, connection.port)
+        return '{scheme}://{host}/{container}/{path}'.format(
+            scheme='https' if secure else 'http',
+            host=host,
+            container=self.container_name,
+            path=path
+        )
+
+    def object_exists(self, path):
+        """
+        `True` if the object at `path` exists. The answer is cached for
+        `exists_cache_ttl` seconds, or `missing_cache_ttl` seconds if the
+        object is missing, unless it is uploaded or deleted in the meantime
+        by this process.
+
+        :param path: The object path in the container.
+        """
+        key = (self.container_name, path)
+        exists = _existing_objects.get(key)
+        if exists is None:
+            try:
+                with self.checking_container('get_object'):
+                    self.container.get_object(path)
+                exists = True
+            except ObjectDoesNotExistError:
+                exists = False
+            _existing_objects.set(
+                key,
+                exists,
+                self.exists_cache_ttl if exists else self.missing_cache_ttl
+            )
+        return exists
+
+    def invalidate_container(self):
+        """
+        Forget that the container has been verified, so that it will be
+        checked again on next use.
+        """
+        _verified_containers.pop((self.driver_name, self.container_name), None)
+        self._container = None
+
+    @contextmanager
+    def checking_container(self, operation=None, size=None):
+        """
+        Context manager for provider calls, re-verifying the container on
+        the next use if the call failed because it was not found.
+
+        If `operation` is given, the call is recorded in the metrics under
+        that name, see `metrics.Metrics.timed`.
+
+        :param operation: The name of the operation.
+        :param size: The number of bytes the call transfers, if any.
+        """
+        with metrics.timed(operation, self.driver_name, size) as call:
+            try:
+                yield call
+            except ContainerDoesNotExistError:
+                self.invalidate_container()
+                raise
+
     @property
     def driver_options(self):
         """
         A dictionary of options ckanext-cloudstorage has been configured to
         pass to the apache-libcloud driver.
         """
-        return literal_eval(config['ckanext.cloudstorage.driver_options'])
+        if _driver_options is None:
+            return literal_eval(config['ckanext.cloudstorage.driver_options'])
+        return _driver_options
 
     @property
     def driver_name(self):
@@ -71,6 +1269,16 @@ class CloudStorage(object):
         """
         return config['ckanext.cloudstorage.container_name']
 
+    @property
+    def container_check_ttl(self):
+        """
+        The number of seconds for which the container is assumed to still
+        exist after it has been verified with the provider.
+        """
+        return float(
+            config.get('ckanext.cloudstorage.container_check_ttl', 3600)
+        )
+
     @property
     def use_secure_urls(self):
         """
@@ -81,6 +1289,204 @@ class CloudStorage(object):
             config.get('ckanext.cloudstorage.use_secure_urls', False)
         )
 
+    @property
+    def public_url_base(self):
+        """
+        The base URL of public download links (ex: a CDN in front of the
+        container), if configured.
+        """
+        return config.get('ckanext.cloudstorage.public_url_base')
+
+    @property
+    def check_exists(self):
+        """
+        `True` if ckanext-cloudstorage is configured to check that an
+        object exists before linking to it, `False` otherwise.
+        """
+        return p.toolkit.asbool(
+            config.get('ckanext.cloudstorage.check_exists', False)
+        )
+
+    @property
+    def exists_cache_ttl(self):
+        """
+        The number of seconds an object is assumed to still exist after it
+        has been found.
+        """
+        return float(
+            config.get('ckanext.cloudstorage.exists_cache_ttl', 300)
+        )
+
+    @property
+    def missing_cache_ttl(self):
+        """
+        The number of seconds an object is assumed to still be missing
+        after it wasn't found.
+        """
+        return float(
+            config.get('ckanext.cloudstorage.missing_cache_ttl', 10)
+        )
+
+    @property
+    def can_sign_urls(self):
+        """
+        `True` if ckanext-cloudstorage can sign temporary URLs for the
+        configured driver (Azure or S3), otherwise `False`.
+        """
+        return self.driver_name == 'AZURE_BLOBS' or 'S3' in self.driver_name
+
+    @property
+    def secure_url_ttl(self):
+        """
+        The number of seconds a signed URL stays valid.
+        """
+        return int(config.get('ckanext.cloudstorage.secure_url_ttl', 3600))
+
+    @property
+    def secure_url_reuse(self):
+        """
+        The fraction of a signed download URL's validity during which it is
+        reused for other downloads of the same object.
+        """
+        return float(
+            config.get('ckanext.cloudstorage.secure_url_reuse', 0.5)
+        )
+
+    @property
+    def s3_region(self):
+        """
+        The region used to sign S3 URLs. Taken from the
+        `ckanext.cloudstorage.s3_region` option, or guessed from the driver.
+        """
+        region = config.get('ckanext.cloudstorage.s3_region')
+        if region:
+            return region
+
+        region = (
+            getattr(self.driver, 'region_name', None) or
+            getattr(self.driver, 'ex_location_name', None) or
+            ''
+        )
+        return {'': 'us-east-1', 'EU': 'eu-west-1'}.get(region, region)
+
+    @property
+    def download_cache_ttl(self):
+        """
+        The number of seconds the resource and its permissions are cached
+        for by the download controller. `0` disables the cache.
+        """
+        return float(
+            config.get('ckanext.cloudstorage.download_cache_ttl', 0)
+        )
+
+    @property
+    def download_mode(self):
+        """
+        How resource downloads are served: `redirect` to the provider (or
+        to a signed URL), `proxy` to stream them through CKAN, or, with the
+        `LOCAL` driver, `x-accel-redirect` (nginx) or `x-sendfile` (Apache,
+        lighttpd) to have the front-end server send the file.
+        """
+        return config.get('ckanext.cloudstorage.download_mode', 'redirect')
+
+    @property
+    def accel_redirect_prefix(self):
+        """
+        The nginx `internal` location the `LOCAL` driver's directory is
+        served from, in `x-accel-redirect` download mode.
+        """
+        return config.get(
+            'ckanext.cloudstorage.accel_redirect_prefix',
+            '/_cloudstorage/'
+        )
+
+    @property
+    def stream_buffer_size(self):
+        """
+        The number of bytes read and sent at a time when streaming a
+        request body to the provider, or a download to a client.
+        """
+        return int(
+            config.get('ckanext.cloudstorage.stream_buffer_size', 64 * 1024)
+        )
+
+    @property
+    def multipart_threshold(self):
+        """
+        Files of at least this many bytes are uploaded in parallel parts by
+        `ResourceCloudStorage.upload`, where supported.
+        """
+        return int(config.get(
+            'ckanext.cloudstorage.multipart_threshold',
+            64 * 1024 * 1024
+        ))
+
+    @property
+    def multipart_part_size(self):
+        """
+        The size of the parts of server-side multipart uploads, in bytes.
+        """
+        return int(config.get(
+            'ckanext.cloudstorage.multipart_part_size',
+            16 * 1024 * 1024
+        ))
+
+    @property
+    def upload_workers(self):
+        """
+        The number of parts of a server-side multipart upload sent at the
+        same time.
+        """
+        return int(config.get('ckanext.cloudstorage.upload_workers', 4))
+
+    @property
+    def part_retries(self):
+        """
+        The number of times the upload of a part is retried before the
+        whole upload fails.
+        """
+        return int(config.get('ckanext.cloudstorage.part_retries', 3))
+
+    @property
+    def delete_workers(self):
+        """
+        The number of objects deleted concurrently when the provider has no
+        batch delete.
+        """
+        return int(config.get('ckanext.cloudstorage.delete_workers', 8))
+
+    @property
+    def use_direct_uploads(self):
+        """
+        `True` if ckanext-cloudstorage is configured to let browsers upload
+        files directly to the provider using presigned URLs, `False`
+        otherwise.
+        """
+        return p.toolkit.asbool(
+            config.get('ckanext.cloudstorage.direct_uploads', False)
+        )
+
+    @property
+    def use_inventory(self):
+        """
+        `True` if ckanext-cloudstorage is configured to keep a copy of the
+        container listing in the database (see the `sync-inventory`
+        command), `False` otherwise.
+        """
+        return p.toolkit.asbool(
+            config.get('ckanext.cloudstorage.use_inventory', False)
+        )
+
+    @property
+    def use_dedupe(self):
+        """
+        `True` if ckanext-cloudstorage is configured to store each distinct
+        uploaded file once, under its SHA-256, `False` otherwise.
+        """
+        return p.toolkit.asbool(
+            config.get('ckanext.cloudstorage.dedupe', False)
+        )
+
     @property
     def leave_files(self):
         """
@@ -168,7 +1574,8 @@ class ResourceCloudStorage(CloudStorage):
             resource['url'] = self.filename
             resource['url_type'] = 'upload'
             resource['last_modified'] = datetime.utcnow()
-        elif multipart_name and self.can_use_advanced_aws:
+        elif multipart_name and (self.can_use_advanced_aws or
+                                 self.use_direct_uploads):
             # This means that file was successfully uploaded and stored
             # at cloud.
             # Currently implemented just AWS version
@@ -200,6 +1607,47 @@ class ResourceCloudStorage(CloudStorage):
             munge.munge_filename(filename)
         )
 
+    def resolve_path(self, rid, filename):
+        """
+        Returns the path of the object holding the file of a resource: its
+        blob in deduplicated mode, if it has one, otherwise the path given
+        by `path_from_filename`.
+
+        :param rid: The resource ID.
+        :param filename: The unmunged resource filename.
+        """
+        if self.use_dedupe:
+            sha256 = get_resource_blob(rid)
+            if sha256 is not None:
+                return self.blob_path(sha256)
+        return self.path_from_filename(rid, filename)
+
+    def needs_proxy(self, rid):
+        """
+        `True` if downloads of the resource can't be redirected to the
+        provider: its file is a deduplicated blob, named after its hash,
+        and only signed URLs can have it sent under another name.
+
+        :param rid: The resource ID.
+        """
+        return (
+            self.use_dedupe and
+            not (self.use_secure_urls and self.can_sign_urls) and
+            get_resource_blob(rid) is not None
+        )
+
+    def release_resource_blob(self, rid):
+        """
+        Unlink a resource from its deduplicated blob, if it has one.
+
+        :param rid: The resource ID.
+        """
+        if not self.use_dedupe:
+            return
+        sha256 = unlink_resource_blob(rid)
+        if sha256 is not None:
+            self.release_blob(sha256)
+
     def upload(self, id, max_size=10):
         """
         Complete the file upload, or clear an existing upload.
@@ -208,57 +1656,175 @@ class ResourceCloudStorage(CloudStorage):
         :param max_size: Ignored.
         """
         if self.filename:
-            if self.can_use_advanced_azure:
-                from azure.storage import blob as azure_blob
-                from azure.storage.blob.models import ContentSettings
+            content_type = None
+            if self.guess_mimetype:
+                content_type, _ = mimetypes.guess_type(self.filename)
 
-                blob_service = azure_blob.BlockBlobService(
-                    self.driver_options['key'],
-                    self.driver_options['secret']
-                )
-                content_settings = None
-                if self.guess_mimetype:
-                    content_type, _ = mimetypes.guess_type(self.filename)
-                    if content_type:
-                        content_settings = ContentSettings(
-                            content_type=content_type
-                        )
+            try:
+                size = get_stream_size(self.file_upload)
+            except (AttributeError, IOError, ValueError):
+                # Not seekable, we can't split it in parts.
+                size = None
 
-                return blob_service.create_blob_from_stream(
-                    container_name=self.container_name,
-                    blob_name=self.path_from_filename(
-                        id,
-                        self.filename
-                    ),
-                    stream=self.file_upload,
-                    content_settings=content_settings
-                )
-            else:
-                self.container.upload_object_via_stream(
-                    self.file_upload,
-                    object_name=self.path_from_filename(
-                        id,
-                        self.filename
-                    )
-                )
+            if self.use_dedupe and size is not None:
+                self._upload_deduplicated(id, size, content_type)
+                return
+
+            stream = self._upload_file(
+                self.path_from_filename(id, self.filename),
+                size,
+                content_type
+            )
+            self._save_hash(id, stream)
+            # The resource doesn't use a blob anymore.
+            self.release_resource_blob(id)
 
         elif self._clear and self.old_filename and not self.leave_files:
             # This is only set when a previously-uploaded file is replace
             # by a link. We want to delete the previously-uploaded file.
+            self.release_resource_blob(id)
+            name = self.path_from_filename(id, self.old_filename)
             try:
-                self.container.delete_object(
-                    self.container.get_object(
-                        self.path_from_filename(
-                            id,
-                            self.old_filename
-                        )
+                with self.checking_container('delete_object'):
+                    self.container.delete_object(
+                        self.container.get_object(name)
                     )
-                )
             except ObjectDoesNotExistError:
                 # It's possible for the object to have already been deleted, or
                 # for it to not yet exist in a committed state due to an
                 # outstanding lease.
-                return
+                pass
+            self.record_deletions([name])
+
+    def _upload_file(self, name, size, content_type):
+        """
+        Upload `file_upload` as the object `name`.
+
+        :returns: The `HashingReader` the file was read through.
+        """
+        stream = HashingReader(self.file_upload)
+
+        if (size is not None and size >= self.multipart_threshold and
+                self.can_upload_in_parts):
+            with metrics.timed('upload_object', self.driver_name, size):
+                result = self.upload_in_parts(
+                    name,
+                    stream,
+                    size,
+                    content_type
+                )
+            self.record_upload(
+                name,
+                size,
+                getattr(result, 'etag', result)
+            )
+        elif self.can_use_advanced_azure:
+            from azure.storage.blob.models import ContentSettings
+
+            blob_service = self.azure_blob_service
+            content_settings = None
+            if content_type:
+                content_settings = ContentSettings(
+                    content_type=content_type
+                )
+
+            # The stream must be read in order to be hashed, so blocks are
+            # sent one at a time. Large files are sent in parallel by
+            # `upload_in_parts`.
+            with self.checking_container('upload_object', size):
+                result = blob_service.create_blob_from_stream(
+                    container_name=self.container_name,
+                    blob_name=name,
+                    stream=stream,
+                    count=size,
+                    content_settings=content_settings,
+                    max_connections=1
+                )
+            self.record_upload(
+                name,
+                stream.size,
+                result.etag,
+                result.last_modified
+            )
+        else:
+            with self.checking_container('upload_object') as call:
+                obj = self.container.upload_object_via_stream(
+                    stream,
+                    object_name=name
+                )
+                call['size'] = stream.size
+
+            # A plain PUT's ETag is the MD5 of the object (multipart ones
+            # contain a dash). libcloud checks it in some cases only.
+            etag = (obj.hash or '').strip('"')
+            if (etag and '-' not in etag and len(etag) == 32 and
+                    etag != stream.md5.hexdigest()):
+                raise LibcloudError(
+                    'MD5 mismatch for {0}: sent {1}, stored {2}'.format(
+                        name, stream.md5.hexdigest(), etag),
+                    driver=self.driver
+                )
+
+            self.record_upload(name, stream.size, obj.hash)
+
+        return stream
+
+    def _upload_deduplicated(self, id, size, content_type):
+        """
+        Store the file under its SHA-256, unless a blob with the same
+        content already exists, and point the resource at that blob.
+        """
+        # Hash the (local) file first, to know whether it has to be sent.
+        position = self.file_upload.tell()
+        hashed = HashingReader(self.file_upload)
+        for _ in hashed:
+            pass
+        self.file_upload.seek(position)
+        sha256 = hashed.sha256.hexdigest()
+
+        previous = get_resource_blob(id)
+        if previous != sha256:
+            # Taking the reference locks the blob's row, so that it can't
+            # be removed while we upload it or link to it.
+            if add_blob_reference(sha256, size) == 1:
+                stream = self._upload_file(
+                    self.blob_path(sha256),
+                    size,
+                    content_type
+                )
+                if stream.sha256.hexdigest() != sha256:
+                    raise IOError(
+                        'The file changed while it was being uploaded'
+                    )
+            link_resource_blob(id, sha256)
+            if previous is not None:
+                self.release_blob(previous)
+
+        self._save_hash(id, hashed)
+
+    def _save_hash(self, id, stream):
+        """
+        Record the SHA-256 and size of an uploaded file on the resource.
+
+        They are saved with `resource_patch`, so that the search index and
+        the activity stream follow, including when the file isn't uploaded
+        by an action (ex: by `migrate`). Nothing is saved if they didn't
+        change.
+        """
+        sha256 = stream.sha256.hexdigest()
+        self.resource['hash'] = sha256
+        self.resource['size'] = stream.size
+
+        resource = model.Resource.get(id)
+        if resource is None or (
+                resource.hash == sha256 and resource.size == stream.size):
+            return
+        site_user = p.toolkit.get_action('get_site_user')(
+            {'ignore_auth': True}, {})
+        p.toolkit.get_action('resource_patch')(
+            {'ignore_auth': True, 'user': site_user['name']},
+            {'id': id, 'hash': sha256, 'size': stream.size}
+        )
 
     def get_url_from_filename(self, rid, filename):
         """
@@ -267,8 +1833,9 @@ class ResourceCloudStorage(CloudStorage):
 
         .. note::
 
-            Works for Azure and any libcloud driver that implements
-            support for get_object_cdn_url (ex: AWS S3).
+            Works for Azure, S3 and any libcloud driver that implements
+            support for get_object_cdn_url. Secure URLs are only supported
+            on Azure and S3.
 
         :param rid: The resource ID.
         :param filename: The resource filename.
@@ -276,44 +1843,29 @@ class ResourceCloudStorage(CloudStorage):
         :returns: Externally accessible URL or None.
         """
         # Find the key the file *should* be stored at.
-        path = self.path_from_filename(rid, filename)
+        path = self.resolve_path(rid, filename)
 
-        # If advanced azure features are enabled, generate a temporary
-        # shared access link instead of simply redirecting to the file.
-        if self.can_use_advanced_azure and self.use_secure_urls:
-            from azure.storage import blob as azure_blob
+        if self.check_exists and not self.object_exists(path):
+            return
 
-            blob_service = azure_blob.BlockBlobService(
-                self.driver_options['key'],
-                self.driver_options['secret']
+        # If secure URLs are enabled, generate a temporary signed link
+        # instead of simply redirecting to the file. Deduplicated blobs are
+        # named after their hash, so the provider is asked to send them
+        # under the resource's file name.
+        if self.use_secure_urls and self.can_sign_urls:
+            return self.get_signed_url(
+                path,
+                filename=filename if path.startswith(BLOB_PREFIX) else None
             )
 
-            return blob_service.make_blob_url(
-                container_name=self.container_name,
-                blob_name=path,
-                sas_token=blob_service.generate_blob_shared_access_signature(
-                    container_name=self.container_name,
-                    blob_name=path,
-                    expiry=datetime.utcnow() + timedelta(hours=1),
-                    permission=azure_blob.BlobPermissions.READ
-                )
-            )
-        elif self.can_use_advanced_aws and self.use_secure_urls:
-            from boto.s3.connection import S3Connection
-            s3_connection = S3Connection(
-                self.driver_options['key'],
-                self.driver_options['secret']
-            )
-            return s3_connection.generate_url(
-                expires_in=60 * 60,
-                method='GET',
-                bucket=self.container_name,
-                query_auth=True,
-                key=path
-            )
+        # Public URLs on S3, Azure or a CDN don't depend on the object.
+        url = self.get_public_url(path)
+        if url is not None:
+            return url
 
         # Find the object for the given key.
-        obj = self.container.get_object(path)
+        with self.checking_container('get_object'):
+            obj = self.container.get_object(path)
         if obj is None:
             return
 
@@ -321,17 +1873,9 @@ class ResourceCloudStorage(CloudStorage):
         try:
             return self.driver.get_object_cdn_url(obj)
         except NotImplementedError:
-            if 'S3' in self.driver_name:
-                return urlparse.urljoin(
-                    'https://' + self.driver.connection.host,
-                    '{container}/{path}'.format(
-                        container=self.container_name,
-                        path=path
-                    )
-                )
             # This extra 'url' property isn't documented anywhere, sadly.
             # See azure_blobs.py:_xml_to_object for more.
-            elif 'url' in obj.extra:
+            if 'url' in obj.extra:
                 return obj.extra['url']
             raise
 
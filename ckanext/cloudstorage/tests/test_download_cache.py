@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import unittest
+
+import mock
+from webob.exc import HTTPException
+
+from ckan import logic
+
+from ckanext.cloudstorage import controller, storage
+from ckanext.cloudstorage.cache import LRUCache
+
+RESOURCE = {
+    'id': 'resource-id',
+    'package_id': 'package-id',
+    'url': 'data.csv',
+    'url_type': 'upload'
+}
+
+
+@mock.patch.object(storage, 'resource_cache', LRUCache(10))
+class TestInvalidate(unittest.TestCase):
+    def setUp(self):
+        storage.resource_cache.clear()
+        storage.resource_cache.set('resource-id', (RESOURCE, True), 60)
+        storage.resource_cache.set(
+            'other-id', (dict(RESOURCE, package_id='other'), True), 60)
+
+    def test_resource(self):
+        storage.invalidate_download_cache('resource-id')
+        self.assertIsNone(storage.resource_cache.get('resource-id'))
+        self.assertIsNotNone(storage.resource_cache.get('other-id'))
+
+    def test_dataset(self):
+        storage.invalidate_download_cache('package-id')
+        self.assertIsNone(storage.resource_cache.get('resource-id'))
+        self.assertIsNotNone(storage.resource_cache.get('other-id'))
+
+
+@mock.patch.object(storage, 'resource_cache', LRUCache(10))
+@mock.patch.object(storage, 'config', {
+    'ckanext.cloudstorage.download_cache_ttl': '60'
+})
+@mock.patch.object(controller, '_', lambda message: message)
+@mock.patch.object(controller.base, 'abort',
+                   side_effect=HTTPException('', None))
+@mock.patch.object(controller.logic, 'check_access')
+class TestGetResource(unittest.TestCase):
+    def setUp(self):
+        storage.resource_cache.clear()
+
+    def _get(self):
+        return controller.StorageController()._get_resource(
+            {'user': 'someone'}, 'package-id', 'resource-id')
+
+    def test_public(self, check_access, abort):
+        storage.resource_cache.set('resource-id', (RESOURCE, True), 60)
+        self.assertEqual(self._get(), RESOURCE)
+        self.assertFalse(check_access.called)
+
+    def test_private(self, check_access, abort):
+        storage.resource_cache.set('resource-id', (RESOURCE, False), 60)
+        self.assertEqual(self._get(), RESOURCE)
+        self.assertTrue(check_access.called)
+
+        check_access.side_effect = logic.NotAuthorized
+        self.assertRaises(HTTPException, self._get)
+        self.assertEqual(abort.call_args[0][0], 401)
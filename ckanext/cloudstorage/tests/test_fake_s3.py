@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the S3-compatible server the benchmarks run against, through
+libcloud's S3 driver.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from libcloud.storage.providers import get_driver
+from libcloud.storage.types import Provider
+
+from ckanext.cloudstorage.fake_s3 import FakeS3Server
+
+
+class TestFakeS3Server(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.server = FakeS3Server(self.path).start()
+        self.driver = get_driver(Provider.S3)(**self.server.driver_options)
+        self.container = self.driver.create_container('test')
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.path)
+
+    def test_multipart_upload(self):
+        # libcloud uploads streams in parts of 5 MB.
+        data = os.urandom(5 * 1024 * 1024 + 10)
+        obj = self.driver.upload_object_via_stream(
+            iter([data]), self.container, 'a/data.bin')
+
+        self.assertTrue(obj.hash.endswith('-2'))
+        obj = self.driver.get_object('test', 'a/data.bin')
+        self.assertEqual(int(obj.size), len(data))
+        self.assertEqual(
+            ''.join(self.driver.download_object_as_stream(obj)), data)
+        self.assertEqual(list(self.driver.ex_iterate_multipart_uploads(
+            self.container)), [])
+
+    def test_list_and_delete_objects(self):
+        for name in ('a/1', 'a/2', 'b/1'):
+            self.driver.upload_object_via_stream(
+                iter([name]), self.container, name)
+
+        self.assertEqual(
+            [obj.name for obj in self.driver.iterate_container_objects(
+                self.container, ex_prefix='a/')],
+            ['a/1', 'a/2']
+        )
+
+        resp = self.driver.connection.request(
+            '/test?delete',
+            method='POST',
+            data='<Delete><Quiet>true</Quiet><Object><Key>a/1</Key></Object>'
+                 '<Object><Key>b/1</Key></Object></Delete>'
+        )
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(
+            [obj.name for obj in self.driver.list_container_objects(
+                self.container)],
+            ['a/2']
+        )
+        # Only the remaining object is left on disk.
+        self.assertEqual(len(os.listdir(self.path)), 1)
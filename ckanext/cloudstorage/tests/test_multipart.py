@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import unittest
+
+import mock
+
+from ckanext.cloudstorage import storage
+from ckanext.cloudstorage.cache import LRUCache
+from ckanext.cloudstorage.logic.action import multipart
+
+CONFIG = {
+    'ckanext.cloudstorage.driver': 'S3',
+    'ckanext.cloudstorage.container_name': 'test'
+}
+
+NAME = 'resources/resource-id/data.csv'
+
+
+@mock.patch.object(storage, 'config', CONFIG)
+@mock.patch.object(storage, '_existing_objects', LRUCache(10))
+class TestRecordDirectUpload(unittest.TestCase):
+    def _record(self, use_inventory):
+        uploader = storage.ResourceCloudStorage.__new__(
+            storage.ResourceCloudStorage)
+        uploader.driver = mock.Mock()
+        uploader.path_from_filename = lambda rid, filename: NAME
+        resource = mock.Mock(url='data.csv', url_type='upload')
+
+        storage._existing_objects.set(('test', NAME), False, 60)
+        with mock.patch.object(multipart.model.Resource, 'get',
+                               return_value=resource), \
+                mock.patch.object(storage.ResourceCloudStorage,
+                                  'use_inventory',
+                                  new_callable=mock.PropertyMock,
+                                  return_value=use_inventory), \
+                mock.patch.object(
+                    storage.CloudStorage, 'container',
+                    new_callable=mock.PropertyMock) as container, \
+                mock.patch.object(storage, 'upsert_inventory') as upsert:
+            container.return_value.get_object.return_value = mock.Mock(
+                size=4, hash='"etag"')
+            multipart._record_direct_upload(uploader, 'resource-id')
+        return container, upsert
+
+    def test_without_inventory(self):
+        container, upsert = self._record(False)
+        self.assertIsNone(storage._existing_objects.get(('test', NAME)))
+        self.assertFalse(container.called)
+        self.assertFalse(upsert.called)
+
+    def test_with_inventory(self):
+        container, upsert = self._record(True)
+        self.assertIsNone(storage._existing_objects.get(('test', NAME)))
+        self.assertEqual(upsert.call_args[0][0][0][:3], (NAME, 4, '"etag"'))
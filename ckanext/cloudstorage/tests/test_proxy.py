@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of downloads streamed through CKAN, with `download_mode = proxy`.
+"""
+import unittest
+
+import mock
+from webob import Response
+from webob.exc import HTTPException
+
+from libcloud.common.types import LibcloudError
+
+from ckanext.cloudstorage import controller, storage
+
+CONFIG = {
+    'ckanext.cloudstorage.driver': 'S3',
+    'ckanext.cloudstorage.container_name': 'test'
+}
+
+
+class FakeResponse(object):
+    # An httplib response.
+    def __init__(self, status, headers=None, body=''):
+        self.status = status
+        self.headers = headers or {}
+        self.body = body
+        self.closed = False
+
+    def getheader(self, name):
+        return self.headers.get(name)
+
+    def read(self, size):
+        data, self.body = self.body[:size], self.body[size:]
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+def _uploader(status, headers=None, body=''):
+    # A `CloudStorage` whose driver answers every request with `status`.
+    # Reading `response` on the raw response fails like libcloud does for
+    # the statuses it considers errors.
+    raw = mock.Mock()
+    raw.connection.connection.getresponse.return_value = FakeResponse(
+        status, headers, body)
+    type(raw).response = mock.PropertyMock(
+        side_effect=LibcloudError('Unknown error. Status code: %d' % status))
+
+    uploader = storage.CloudStorage.__new__(storage.CloudStorage)
+    uploader.driver = mock.Mock()
+    uploader.driver.connection.request.return_value = raw
+    uploader.object_path = lambda name: '/test/' + name
+    uploader.resolve_path = lambda resource_id, filename: filename
+    return uploader
+
+
+@mock.patch.object(storage, 'config', CONFIG)
+class TestOpenObject(unittest.TestCase):
+    def test_returns_status_and_headers(self):
+        uploader = _uploader(
+            206, {'Content-Range': 'bytes 0-1/4', 'Content-Length': '2'},
+            'ab')
+        status, headers, body = uploader.open_object('data.txt', {
+            'Range': 'bytes=0-1'
+        })
+
+        self.assertEqual(status, 206)
+        self.assertEqual(headers, {
+            'Content-Range': 'bytes 0-1/4',
+            'Content-Length': '2'
+        })
+        self.assertEqual(body.read_all(), 'ab')
+        uploader.driver.connection.request.assert_called_once_with(
+            '/test/data.txt',
+            method='GET',
+            headers={'Range': 'bytes=0-1'},
+            raw=True
+        )
+
+    def test_passes_error_statuses(self):
+        for status in (304, 412, 416, 500):
+            uploader = _uploader(status, {'ETag': '"abc"'})
+            result, headers, body = uploader.open_object('data.txt')
+            self.assertEqual(result, status)
+            self.assertEqual(headers, {'ETag': '"abc"'})
+            body.close()
+
+
+@mock.patch.object(storage, 'config', CONFIG)
+@mock.patch.object(storage, 'acquire_proxy_slot', return_value=True)
+@mock.patch.object(storage, 'release_proxy_slot')
+class TestProxyDownload(unittest.TestCase):
+    def _download(self, uploader, request_headers=None, filename='data.txt'):
+        request = mock.Mock(headers=request_headers or {})
+        response = Response()
+        with mock.patch.object(controller, 'request', request), \
+                mock.patch.object(controller, 'response', response), \
+                mock.patch.object(controller, '_', lambda message: message):
+            result = controller.StorageController()._proxy_download(
+                uploader, 'resource-id', filename)
+        return result, response
+
+    def _assert_empty(self, status, request_headers, response_headers,
+                      release):
+        uploader = _uploader(status, response_headers, 'error')
+        result, response = self._download(uploader, request_headers)
+
+        self.assertEqual(result, '')
+        self.assertEqual(response.status_int, status)
+        for header, value in response_headers.items():
+            if header != 'Content-Length':
+                self.assertEqual(response.headers[header], value)
+        self.assertTrue(release.called)
+
+    def test_not_modified(self, release, acquire):
+        self._assert_empty(
+            304,
+            {'If-None-Match': '"abc"'},
+            {'ETag': '"abc"', 'Last-Modified': 'Wed, 01 Jan 2020 00:00:00'},
+            release
+        )
+
+    def test_precondition_failed(self, release, acquire):
+        self._assert_empty(
+            412,
+            {'If-Match': '"abc"', 'Range': 'bytes=0-1'},
+            {'Content-Length': '5'},
+            release
+        )
+
+    def test_range_not_satisfiable(self, release, acquire):
+        self._assert_empty(
+            416,
+            {'Range': 'bytes=10-20'},
+            {'Content-Range': 'bytes */4', 'Content-Length': '5'},
+            release
+        )
+
+    def test_keeps_content_length(self, release, acquire):
+        uploader = _uploader(
+            200,
+            {'Content-Length': '4', 'Content-Type': 'text/plain'},
+            'data'
+        )
+        result, response = self._download(uploader)
+
+        self.assertIsNone(result)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_length, 4)
+        self.assertEqual(response.headers['Content-Type'], 'text/plain')
+        self.assertEqual(''.join(response.app_iter), 'data')
+        self.assertTrue(release.called)
+
+    def test_blob_named_after_file(self, release, acquire):
+        uploader = _uploader(200, {'Content-Length': '4'}, 'data')
+        uploader.resolve_path = (
+            lambda resource_id, filename: 'blobs/ab/abcdef')
+        result, response = self._download(uploader, filename='data.txt')
+
+        self.assertEqual(
+            response.headers['Content-Disposition'],
+            'attachment; filename="data.txt"'
+        )
+        self.assertEqual(''.join(response.app_iter), 'data')
+
+    def test_provider_error(self, release, acquire):
+        uploader = _uploader(500, {}, 'error')
+        with mock.patch.object(controller.base, 'abort',
+                               side_effect=HTTPException('', None)) as abort:
+            self.assertRaises(HTTPException, self._download, uploader)
+        self.assertEqual(abort.call_args[0][0], 502)
+        self.assertTrue(release.called)